@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+mock_server.py — 本地模拟微信公众号接口 + OpenAI 兼容的 LLM 接口
+
+实现的接口：
+    GET  /cgi-bin/token
+    POST /cgi-bin/material/add_material
+    POST /cgi-bin/material/del_material     ← 被质量门槛拦下的文章删封面
+    POST /cgi-bin/media/uploadimg           ← 正文图片，返回 url
+    POST /cgi-bin/draft/add
+    POST /cgi-bin/draft/update              ← media_id 必须是 draft/add 返回过的，否则 40007
+    POST /<任意前缀>/chat/completions       ← OpenAI 兼容（带 response_format 时回 JSON）
+    GET  /__stats                           ← 各接口调用次数 / 注入错误次数
+
+用法：
+    python bench/mock_server.py --port 8900
+    python bench/mock_server.py --wechat-latency-ms 80 --llm-latency-ms 1500 --jitter 0.3
+    python bench/mock_server.py --error-rate 0.05 --errors 40001,45009,timeout
+    python bench/mock_server.py --error-rate 0.2 --errors=-1     # 系统繁忙，客户端会重试
+    python bench/mock_server.py --throughput     # 零延迟、不注入错误、不打日志
+    python bench/mock_server.py --vary           # 每篇正文长度、图表行数 / 步数和数字都随机（浸泡测试用）
+
+把流水线指向它：
+    export WECHAT_API_BASE=http://127.0.0.1:8900
+    export DEEPSEEK_BASE_URL=http://127.0.0.1:8900/v1
+    export DEEPSEEK_API_KEY=mock
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+# ── 模拟数据 ──────────────────────────────────────────
+
+ARTICLE_TEMPLATE = """【标题】
+{topic}：我踩过的坑都在这了
+
+【开头引言钩子】
+别急着动手，先把这几件事想清楚
+
+【摘要】
+这篇文章把{topic}从头到尾拆了一遍：为什么要做、怎么开始、哪些坑最容易踩、踩了怎么爬出来。没有鸡汤，只有真实经历和具体数字，适合正在犹豫要不要开始的你。看完至少能少走三个月弯路，也能判断这件事到底适不适合你。
+
+【正文】
+## 先说结论
+
+{topic}这件事，难的不是技术，是坚持。
+
+## 我是怎么开始的
+
+第一个月几乎没有结果，第二个月开始有零星反馈。
+
+- 每天固定投入 2 小时
+- 每周复盘一次数据
+- 每月砍掉一个没效果的动作
+
+## 最容易踩的坑
+
+一上来就追求完美，结果三个月都没上线。
+{extra}
+【结尾问句互动钩子】
+你现在卡在哪一步？评论区聊聊
+
+【配图需求】
+- 封面图（16:9）：深色科技风，主标题"{topic}"
+- 正文配图1：三种做法对比表
+- 正文配图2：从零开始的工作流程图
+"""
+
+EVAL_TEXT = """标题得分: 17/20
+开头得分: 16/20
+正文得分: 24/30
+语言得分: 17/20
+结尾得分: 8/10
+综合得分: 82/100
+结论: 小改再发
+主要问题:
+- 标题可以加具体数字
+- 正文案例偏少
+"""
+
+CHART_JSON = json.dumps({
+    "comparison": {
+        "title": "三种做法对比", "note": "* 先跑通再优化",
+        "headers": ["对比项", "全职投入", "业余兼职", "外包起步"],
+        "rows": [["启动成本", "高", "低", "中"], ["见效周期", "3 个月", "6 个月", "1 个月"],
+                 ["风险", "高", "低", "中"]],
+    },
+    "workflow": {
+        "title": "从零开始的工作流程", "subtitle": "每一步都有可量化的目标",
+        "steps": [{"title": "选方向", "desc": "找一个\n真实需求"}, {"title": "做验证", "desc": "两周内\n拿到反馈"},
+                  {"title": "上线", "desc": "先收费\n再完善"}, {"title": "复盘", "desc": "每周看\n一次数据"}],
+    },
+}, ensure_ascii=False)
+
+EVAL_JSON = json.dumps({
+    "title_score": 17, "hook_score": 16, "body_score": 24, "lang_score": 17, "closing_score": 8,
+    "total_score": 82, "conclusion": "小改再发", "issues": ["标题可以加具体数字", "正文案例偏少"],
+}, ensure_ascii=False)
+
+
+def topics_json(prompt: str) -> str:
+    """选题库请求：给【内容方向】里的每个方向各出 n 个选题（标题带随机编号，避免被去重吃掉）"""
+    pillars = re.findall(r"^- (.+)$", prompt.split("【内容方向】")[-1], re.M)
+    m = re.search(r"各提 (\d+) 个", prompt)
+    n = int(m.group(1)) if m else 3
+    return json.dumps({"topics": [
+        {"pillar": p, "title": f"{p}：第{i+1}个真实案例拆解（{uuid.uuid4().hex[:6]}）",
+         "angle": "用具体数字讲清楚", "reason": "读者关心", "score": random.randint(4, 9)}
+        for p in pillars for i in range(n)]}, ensure_ascii=False)
+
+
+def article_text(topic: str, vary: bool = False) -> str:
+    """
+    文本格式的文章。vary 时正文末尾多几段随机长度、随机数字的复盘，
+    每篇的正文、摘要长度和渲染出的图都不一样，内容相关的缓存才会真的被填满。
+    """
+    extra = ""
+    if vary:
+        extra = "".join(f"\n## 第{i+1}次复盘\n\n" + f"这一轮投入 {random.randint(1, 99)} 小时，"
+                        f"收入 {random.randint(100, 99999)} 元。" * random.randint(1, 20) + "\n"
+                        for i in range(random.randint(0, 4)))
+    return ARTICLE_TEMPLATE.format(topic=topic, extra=extra)
+
+
+def chart_json(vary: bool = False) -> str:
+    """图表数据；vary 时对比表行数、流程步数和里面的数字每次随机"""
+    if not vary:
+        return CHART_JSON
+    data = json.loads(CHART_JSON)
+    data["comparison"]["rows"] = [
+        [f"指标{i+1}"] + [f"{random.randint(1, 9999)} 元" for _ in range(3)] for i in range(random.randint(2, 8))]
+    data["workflow"]["steps"] = [
+        {"title": f"第{i+1}步", "desc": f"{random.randint(1, 30)} 天内\n完成 {random.randint(1, 9)} 项"}
+        for i in range(random.randint(3, 8))]
+    return json.dumps(data, ensure_ascii=False)
+
+
+def article_json(topic: str, vary: bool = False) -> str:
+    """结构化输出模式下的文章：把 article_text 的各段拆成 JSON 字段"""
+    text = article_text(topic, vary)
+    keys = {"标题": "title", "开头引言钩子": "hook", "摘要": "digest", "正文": "body",
+            "结尾问句互动钩子": "cta", "配图需求": "image_requirements"}
+    parts = dict(re.findall(r"【(.+?)】\n(.*?)(?=\n【|\Z)", text, re.DOTALL))
+    return json.dumps({keys[k]: v.strip() for k, v in parts.items()}, ensure_ascii=False)
+
+
+def combined_json(topic: str, vary: bool = False) -> str:
+    data = json.loads(article_json(topic, vary))
+    data["evaluation"] = json.loads(EVAL_JSON)
+    return json.dumps(data, ensure_ascii=False)
+
+
+WECHAT_ERRORS = {
+    -1:    "system error",
+    40001: "invalid credential, access_token is invalid or not latest",
+    40007: "invalid media_id",
+    45009: "reach max api daily quota limit",
+}
+
+
+# ── 服务端 ────────────────────────────────────────────
+
+def default_config() -> dict:
+    return {
+        "wechat_latency_ms": 50.0,
+        "llm_latency_ms":    800.0,
+        "jitter":            0.2,      # 延迟随机抖动比例
+        "error_rate":        0.0,      # 每个请求注入错误的概率
+        "errors":            ["40001", "45009", "timeout"],
+        "timeout_seconds":   35.0,     # 注入 timeout 时挂起的时长，应大于客户端超时
+        "throughput":        False,
+        "vary":              False,    # 文章和图表内容每次随机
+        "quiet":             False,
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server_version = "WechatMock/1.0"
+    protocol_version = "HTTP/1.1"
+
+    # ── 工具 ──
+    @property
+    def cfg(self) -> dict:
+        return self.server.config
+
+    def log_message(self, fmt, *args):
+        if not (self.cfg["quiet"] or self.cfg["throughput"]):
+            super().log_message(fmt, *args)
+
+    def _count(self, key: str):
+        with self.server.stats_lock:
+            self.server.stats[key] += 1
+
+    def _sleep(self, base_ms: float):
+        if self.cfg["throughput"] or base_ms <= 0:
+            return
+        jitter = self.cfg["jitter"]
+        time.sleep(max(0.0, base_ms * random.uniform(1 - jitter, 1 + jitter)) / 1000)
+
+    def _send_json(self, obj: dict, status: int = 200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _inject_error(self, endpoint: str, wechat: bool) -> bool:
+        """按 error_rate 注入错误，已经回包（或挂起）时返回 True"""
+        if self.cfg["throughput"] or random.random() >= self.cfg["error_rate"]:
+            return False
+        choices = [e for e in self.cfg["errors"] if wechat or e == "timeout"]
+        if not choices:
+            return False
+        err = random.choice(choices)
+        self._count(f"injected:{endpoint}:{err}")
+        if err == "timeout":
+            time.sleep(self.cfg["timeout_seconds"])
+            self.close_connection = True
+            return True
+        code = int(err)
+        self._send_json({"errcode": code, "errmsg": WECHAT_ERRORS.get(code, "mock error")})
+        return True
+
+    # ── 路由 ──
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/__stats":
+            with self.server.stats_lock:
+                return self._send_json(dict(self.server.stats))
+        if path == "/cgi-bin/token":
+            self._count("token")
+            self._sleep(self.cfg["wechat_latency_ms"])
+            if self._inject_error("token", wechat=True):
+                return
+            return self._send_json({"access_token": f"mock_{uuid.uuid4().hex}", "expires_in": 7200})
+        self._send_json({"errcode": 404, "errmsg": f"unknown path {path}"}, status=404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+
+        if path.endswith("/chat/completions"):
+            self._count("chat/completions")
+            self._sleep(self.cfg["llm_latency_ms"])
+            if self._inject_error("chat/completions", wechat=False):
+                return
+            return self._send_json(self._chat_completion(body))
+
+        endpoint = path.removeprefix("/cgi-bin/")
+        if endpoint not in ("material/add_material", "material/del_material", "media/uploadimg",
+                            "draft/add", "draft/update"):
+            return self._send_json({"errcode": 404, "errmsg": f"unknown path {path}"}, status=404)
+
+        self._count(endpoint)
+        with self.server.stats_lock:
+            self.server.stats[f"bytes:{endpoint}"] += len(body)
+        self._sleep(self.cfg["wechat_latency_ms"])
+        if self._inject_error(endpoint, wechat=True):
+            return
+
+        media_id = uuid.uuid4().hex
+        if endpoint == "media/uploadimg":
+            return self._send_json({"url": f"http://mmbiz.qpic.cn/mock/{media_id}/0"})
+        if endpoint == "draft/update":
+            with self.server.stats_lock:
+                known = json.loads(body or b"{}").get("media_id") in self.server.drafts
+            return self._send_json({"errcode": 0, "errmsg": "ok"} if known
+                                   else {"errcode": 40007, "errmsg": WECHAT_ERRORS[40007]})
+        if endpoint == "material/del_material":
+            return self._send_json({"errcode": 0, "errmsg": "ok"})
+        if endpoint == "material/add_material":
+            return self._send_json({"media_id": media_id,
+                                    "url": f"http://mmbiz.qpic.cn/mock/{media_id}/0"})
+        with self.server.stats_lock:
+            self.server.drafts.add(media_id)
+        return self._send_json({"media_id": media_id})
+
+    def _chat_completion(self, body: bytes) -> dict:
+        req = json.loads(body or b"{}")
+        messages = req.get("messages", [])
+        user = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        if isinstance(user, list):
+            user = "".join(part.get("text", "") for part in user)
+
+        m = re.search(r"「(.+?)」", user)
+        topic = m.group(1) if m else "独立开发"
+        structured = "response_format" in req     # 结构化输出模式直接回 JSON
+        vary = self.cfg["vary"]
+        if "整理成 JSON" in user:                  # 格式修复调用
+            if '"evaluation"' in user:
+                content = combined_json(topic, vary)
+            else:
+                content = EVAL_JSON if "total_score" in user else article_json(topic, vary)
+        elif "自评" in user:                       # 单次调用模式：文章 + 自评
+            content = (combined_json(topic, vary) if structured
+                       else article_text(topic, vary) + "\n【自评】\n" + EVAL_TEXT)
+        elif "评估" in user:
+            content = EVAL_JSON if structured else EVAL_TEXT
+        elif "【内容方向】" in user:               # 选题库
+            content = topics_json(user)
+        elif "图表数据" in user:
+            content = chart_json(vary)
+        else:
+            content = article_json(topic, vary) if structured else article_text(topic, vary)
+
+        prompt_tokens = sum(len(str(x.get("content", ""))) for x in messages) // 2
+        completion_tokens = len(content) // 2
+        # 模拟服务商前缀缓存：同样的 system 前缀第二次出现起按命中计
+        system = str(messages[0].get("content", "")) if messages and messages[0].get("role") == "system" else ""
+        cached = 0
+        if system:
+            with self.server.stats_lock:
+                if system in self.server.prefixes:
+                    cached = len(system) // 2
+                self.server.prefixes.add(system)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": req.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached}},
+        }
+
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, **config) -> ThreadingHTTPServer:
+    """在后台线程启动 mock 服务，返回 server（server.server_address 里有实际端口）"""
+    cfg = default_config()
+    cfg.update(config)
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.config = cfg
+    server.stats = Counter()
+    server.stats_lock = threading.Lock()
+    server.drafts = set()   # draft/add 发出去的 media_id，draft/update 用来校验
+    server.prefixes = set()
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+# ── 主函数 ─────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟微信 + LLM 接口")
+    parser.add_argument("--host",              default="127.0.0.1")
+    parser.add_argument("--port",              type=int, default=8900)
+    parser.add_argument("--wechat-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-latency-ms",    type=float, default=800.0)
+    parser.add_argument("--jitter",            type=float, default=0.2, help="延迟抖动比例")
+    parser.add_argument("--error-rate",        type=float, default=0.0, help="错误注入概率 0~1")
+    parser.add_argument("--errors",            default="40001,45009,timeout", help="可注入的错误类型")
+    parser.add_argument("--timeout-seconds",   type=float, default=35.0, help="timeout 错误挂起时长")
+    parser.add_argument("--throughput",        action="store_true", help="吞吐模式：零延迟、无错误、无日志")
+    parser.add_argument("--vary",              action="store_true", help="文章和图表内容每次随机")
+    args = parser.parse_args()
+
+    server = start_mock_server(
+        args.host, args.port,
+        wechat_latency_ms=args.wechat_latency_ms,
+        llm_latency_ms=args.llm_latency_ms,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        errors=[e.strip() for e in args.errors.split(",") if e.strip()],
+        timeout_seconds=args.timeout_seconds,
+        throughput=args.throughput,
+        vary=args.vary,
+    )
+    print(f"🧪 mock 服务已启动：{server_url(server)}")
+    print(f"   export WECHAT_API_BASE={server_url(server)}")
+    print(f"   export DEEPSEEK_BASE_URL={server_url(server)}/v1 DEEPSEEK_API_KEY=mock ACTIVE_MODEL=deepseek")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+run_bench.py — 渲染 / HTML 热路径本地基准测试
+
+覆盖 render_cover、render_comparison、render_workflow、_wrap、markdown_to_wechat_html，
+输入规模固定：长短标题、5~50 行表格、2~8 步流程、1k~50k 字正文。
+报告吞吐量、延迟分位数（p50/p95/p99）和峰值内存，结果写 JSON，并与基线对比。
+
+用法：
+    python bench/run_bench.py
+    python bench/run_bench.py --case cover      # 只跑名字包含 cover 的用例
+    python bench/run_bench.py --iterations 50
+    python bench/run_bench.py --save-baseline   # 把本次结果存为基线
+    python bench/run_bench.py --threshold 0.2   # p50 变慢超过 20% 视为退化
+
+完全离线运行，需要 Linux + Noto CJK 字体：
+    apt install fonts-noto-cjk
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT          = Path(__file__).parent.parent
+RESULTS_JSON  = ROOT / "bench" / "results.json"
+BASELINE_JSON = ROOT / "bench" / "baseline.json"
+
+# 基准测试不调用任何接口，微信配置给个占位值即可
+os.environ.setdefault("WECHAT_APP_ID", "bench")
+os.environ.setdefault("WECHAT_APP_SECRET", "bench")
+sys.path.insert(0, str(ROOT))
+
+import main  # noqa: E402
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+
+
+# ── 固定输入 ──────────────────────────────────────────
+
+SHORT_TITLE = "独立开发第一步"
+LONG_TITLE  = "刚开源2700 Star，这个Agent框架能让AI替你自动干活，一个人管多条流程产出相当于一个团队"
+SUBTITLE    = "一个人管多条流程，产出相当于一个团队"
+
+PARAGRAPH = "前不久我写过ZeroClaw，用Rust重写之后内存只有5MB，把OpenClaw那394MB的占用按在地上摩擦。"
+
+
+def make_rows(n: int) -> tuple[list, list]:
+    headers = ["对比项", "OpenClaw", "ZeroClaw", "OpenFang"]
+    cells   = ["394 MB", "5 MB", "~30 MB", "✓", "✗", "16 层", "—"]
+    rows = [[f"指标{i+1}"] + [cells[(i + j) % len(cells)] for j in range(3)] for i in range(n)]
+    return headers, rows
+
+
+def make_steps(n: int) -> list:
+    return [("⚙️", f"步骤{i+1}", "自动拆解\n执行步骤") for i in range(n)]
+
+
+def make_body(chars: int) -> str:
+    """按固定模式拼出约 chars 字的 markdown 正文（小标题 / 列表 / 段落交替）"""
+    lines, size, i = [], 0, 0
+    while size < chars:
+        if i % 8 == 0:
+            line = f"## 第{i//8+1}部分"
+        elif i % 8 == 5:
+            line = f"- 要点{i}：{PARAGRAPH[:20]}"
+        else:
+            line = PARAGRAPH
+        lines.append(line)
+        size += len(line)
+        i += 1
+    return "\n\n".join(lines)
+
+
+def build_cases() -> dict:
+    """用例名 → 无参可调用对象（渲染结果留在内存里，和流水线一致）"""
+    out = None
+    tpl = str(ROOT / "scripts" / "post_image_templates.pen")
+
+    draw   = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    f_wrap = ImageFont.truetype(main.FONT_BOLD, 52)
+
+    cases = {
+        "cover/short_title": lambda: main.render_cover(SHORT_TITLE, SUBTITLE, out, tpl),
+        "cover/long_title":  lambda: main.render_cover(LONG_TITLE, SUBTITLE, out, tpl),
+        "wrap/short_title":  lambda: main._wrap(draw, SHORT_TITLE, f_wrap, 1080),
+        "wrap/long_title":   lambda: main._wrap(draw, LONG_TITLE * 2, f_wrap, 1080),
+    }
+    for n in (5, 20, 50):
+        headers, rows = make_rows(n)
+        cases[f"comparison/{n}_rows"] = (
+            lambda h=headers, r=rows: main.render_comparison(h, r, "三大 Agent 框架对比", out))
+    for n in (2, 4, 8):
+        steps = make_steps(n)
+        cases[f"workflow/{n}_steps"] = (
+            lambda s=steps: main.render_workflow(s, "工作流程", "全程自动运行，无需人工介入", out))
+    for n in (1_000, 10_000, 50_000):
+        body = make_body(n)
+        cases[f"html/{n//1000}k_chars"] = lambda b=body: main.markdown_to_wechat_html(b)
+    return cases
+
+
+# ── 计时 ──────────────────────────────────────────────
+
+def percentile(sorted_vals: list, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = (len(sorted_vals) - 1) * p
+    lo, hi = int(k), min(int(k) + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+def bench_case(fn, iterations: int, warmup: int) -> dict:
+    """
+    先预热，再计时；峰值内存单独跑一遍 tracemalloc，避免拖慢计时。
+    peak_mem_kb 只统计 Python 堆（PIL 像素缓冲在 C 层），max_rss_kb 是进程 RSS 高水位。
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(warmup):
+            fn()
+
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "iterations":     iterations,
+        "ops_per_sec":    round(iterations / elapsed, 2) if elapsed else 0.0,
+        "mean_ms":        ms(statistics.fmean(latencies)),
+        "p50_ms":         ms(percentile(latencies, 0.50)),
+        "p95_ms":         ms(percentile(latencies, 0.95)),
+        "p99_ms":         ms(percentile(latencies, 0.99)),
+        "peak_mem_kb":    round(peak / 1024, 1),
+        "max_rss_kb":     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """返回退化用例说明列表（按 p50 比较）"""
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base or not base.get("p50_ms"):
+            continue
+        ratio = cur["p50_ms"] / base["p50_ms"] - 1
+        cur["vs_baseline"] = round(ratio, 3)
+        if ratio > threshold:
+            regressions.append(f"{name}: p50 {base['p50_ms']}ms → {cur['p50_ms']}ms（+{ratio:.0%}）")
+    return regressions
+
+
+# ── 主函数 ─────────────────────────────────────────────
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="渲染 / HTML 热路径基准测试")
+    parser.add_argument("--case",          help="只跑名字包含该子串的用例")
+    parser.add_argument("--iterations",    type=int, default=20, help="每个用例计时次数")
+    parser.add_argument("--warmup",        type=int, default=3,  help="每个用例预热次数")
+    parser.add_argument("--output",        default=str(RESULTS_JSON), help="结果 JSON 路径")
+    parser.add_argument("--baseline",      default=str(BASELINE_JSON), help="基线 JSON 路径")
+    parser.add_argument("--threshold",     type=float, default=0.15, help="p50 退化阈值（比例）")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果存为基线")
+    args = parser.parse_args()
+
+    for font in (main.FONT_BOLD, main.FONT_REG):
+        if not os.path.exists(font):
+            print(f"❌ 找不到字体：{font}（apt install fonts-noto-cjk）")
+            sys.exit(1)
+
+    cases = build_cases()
+    if args.case:
+        cases = {k: v for k, v in cases.items() if args.case in k}
+    print(f"🚀 开始基准测试：{len(cases)} 个用例，每个 {args.iterations} 次")
+
+    results = {}
+    for name, fn in cases.items():
+        r = bench_case(fn, args.iterations, args.warmup)
+        results[name] = r
+        print(f"  {name:24} {r['ops_per_sec']:>9.1f} ops/s  "
+              f"p50 {r['p50_ms']:>8.2f}ms  p95 {r['p95_ms']:>8.2f}ms  "
+              f"p99 {r['p99_ms']:>8.2f}ms  峰值 {r['peak_mem_kb']:>9.1f} KB")
+
+    regressions = []
+    baseline_path = Path(args.baseline)
+    if baseline_path.exists() and not args.save_baseline:
+        with open(baseline_path, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        if regressions:
+            print(f"\n⚠️  {len(regressions)} 个用例相对基线退化：")
+            for r in regressions:
+                print(f"   - {r}")
+        else:
+            print("\n✅ 没有超过阈值的退化")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python":    sys.version.split()[0],
+        "results":   results,
+    }
+    out_path = baseline_path if args.save_baseline else Path(args.output)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n📄 结果已保存：{out_path}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+run_pipeline_bench.py — 端到端流水线压测（本地 mock 微信 + LLM）
+
+在进程内启动 bench/mock_server.py，把 WECHAT_API_BASE 和模型 base_url 指过去，
+然后用批量路径（run_batch）或定时任务路径（scheduled_job）跑 N 篇文章，
+报告每分钟文章数、单篇延迟分位数和失败数。
+
+用法：
+    python bench/run_pipeline_bench.py --articles 50 --workers 8
+    python bench/run_pipeline_bench.py --mode scheduler --articles 10
+    python bench/run_pipeline_bench.py --llm-latency-ms 1500 --error-rate 0.05
+    python bench/run_pipeline_bench.py --throughput          # 去掉模拟延迟，测纯开销
+    python bench/run_pipeline_bench.py --error-rate 0.15 --errors=-1,40001,timeout   # 只测重试和 token 刷新
+    python bench/run_pipeline_bench.py --url http://127.0.0.1:8900   # 使用已启动的 mock
+
+注入的 45009 和真实的一样：该接口当天被标记为不可用，之后的文章全部进延后队列（报告里的 deferred），
+成功数会掉到很低，这是预期行为。只想看重试开销时用 --errors 去掉 45009。
+
+需要 Noto CJK 字体（会真实渲染封面）。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT         = Path(__file__).parent.parent
+RESULTS_JSON = ROOT / "bench" / "pipeline_results.json"
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+from mock_server import server_url, start_mock_server  # noqa: E402
+
+
+def point_env_to(url: str, state_db: str):
+    """main.py 在导入时读取配置，必须在 import main 之前调用"""
+    os.environ["WECHAT_API_BASE"]   = url
+    os.environ["WECHAT_APP_ID"]     = "mock_app_id"
+    os.environ["WECHAT_APP_SECRET"] = "mock_secret"
+    os.environ["ACTIVE_MODEL"]      = "deepseek"
+    os.environ["DEEPSEEK_API_KEY"]  = "mock"
+    os.environ["DEEPSEEK_BASE_URL"] = f"{url}/v1"
+    # 压测产生的 LLM 用量不要记进正式的状态库
+    os.environ["STATE_DB"]          = state_db
+
+
+def bench_batch(main, topics: list, workers: int) -> list:
+    return main.run_batch(topics, workers=workers)
+
+
+def bench_scheduler(main, n: int) -> list:
+    """scheduled_job 是串行路径：一次一篇，按 TOPIC_LIST 轮转"""
+    results = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        try:
+            main.scheduled_job()
+            error = None
+        except Exception as e:
+            error = str(e)
+        results.append({"error": error, "seconds": round(time.perf_counter() - t0, 3)})
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="端到端流水线压测（mock 微信 + LLM）")
+    parser.add_argument("--mode",              choices=["batch", "scheduler"], default="batch")
+    parser.add_argument("--articles",          type=int, default=20)
+    parser.add_argument("--workers",           type=int, default=4)
+    parser.add_argument("--url",               help="使用已启动的 mock 服务，不在进程内启动")
+    parser.add_argument("--wechat-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-latency-ms",    type=float, default=800.0)
+    parser.add_argument("--error-rate",        type=float, default=0.0)
+    parser.add_argument("--errors",            default="40001,45009,timeout",
+                        help="可注入的错误类型；45009 会把接口当天封掉，之后的文章都进延后队列")
+    parser.add_argument("--throughput",        action="store_true")
+    parser.add_argument("--output",            default=str(RESULTS_JSON))
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        server = start_mock_server(
+            wechat_latency_ms=args.wechat_latency_ms,
+            llm_latency_ms=args.llm_latency_ms,
+            error_rate=args.error_rate,
+            errors=[e.strip() for e in args.errors.split(",") if e.strip()],
+            # 挂起时长略大于客户端超时，保证触发超时
+            timeout_seconds=float(os.getenv("WECHAT_TIMEOUT", "30")) + 5,
+            throughput=args.throughput,
+            quiet=True,
+        )
+        url = server_url(server)
+    tmp = tempfile.TemporaryDirectory(prefix="pipeline_bench_")
+    point_env_to(url, os.path.join(tmp.name, "state.db"))
+
+    # run_bench 也会 import main，同样要放在 point_env_to 之后
+    import main
+    from run_bench import percentile
+
+    print(f"🚀 压测开始：{args.mode} 模式，{args.articles} 篇，mock={url}")
+    topics = [f"压测主题{i}" for i in range(args.articles)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.mode == "batch":
+            results = bench_batch(main, topics, args.workers)
+        else:
+            results = bench_scheduler(main, args.articles)
+    elapsed = time.perf_counter() - start
+
+    ok        = [r for r in results if not r["error"]]
+    latencies = sorted(r["seconds"] for r in ok)
+    summary = {
+        "mode":                args.mode,
+        "articles":            args.articles,
+        "workers":             args.workers if args.mode == "batch" else 1,
+        "succeeded":           len(ok),
+        "failed":              len(results) - len(ok),
+        "wall_seconds":        round(elapsed, 3),
+        "articles_per_minute": round(len(ok) / elapsed * 60, 2) if elapsed else 0.0,
+        "p50_s":               round(percentile(latencies, 0.50), 3),
+        "p95_s":               round(percentile(latencies, 0.95), 3),
+        "p99_s":               round(percentile(latencies, 0.99), 3),
+        "deferred":            main._db().execute("SELECT COUNT(*) FROM deferred_topics").fetchone()[0],
+        "errors":              sorted({r["error"] for r in results if r["error"]}),
+    }
+    if server:
+        summary["mock_stats"] = dict(server.stats)
+        server.shutdown()
+    tmp.cleanup()
+
+    print(f"✅ 成功 {summary['succeeded']} / 失败 {summary['failed']}（其中进延后队列 {summary['deferred']}），"
+          f"耗时 {summary['wall_seconds']}s")
+    print(f"📈 {summary['articles_per_minute']} 篇/分钟  "
+          f"p50 {summary['p50_s']}s  p95 {summary['p95_s']}s  p99 {summary['p99_s']}s")
+    for e in summary["errors"]:
+        print(f"   ⚠ {e[:100]}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"\n📄 结果已保存：{args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
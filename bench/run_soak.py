@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+run_soak.py — 长时间运行的内存浸泡测试（本地 mock 微信 + LLM）
+
+mock 服务单独开一个进程（它自己记录的草稿不算进被测进程的内存），
+被测进程用 run_batch 连续跑上千篇文章（主题各不相同，mock 开 vary，正文和图表内容每篇都随机），
+每隔一段做一次 gc 后采样 RSS、打开的文件数、线程数和临时目录数。
+预热之后 RSS 涨幅超过 --max-growth-mb 视为没有收敛，退出码 1。
+
+用法：
+    python bench/run_soak.py                       # 默认 2000 篇
+    python bench/run_soak.py --runs 5000 --workers 8
+    python bench/run_soak.py --runs 300 --warmup 100 --sample-every 50   # 快速检查
+
+需要 Noto CJK 字体（会真实渲染封面和配图）。
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT         = Path(__file__).parent.parent
+RESULTS_JSON = ROOT / "bench" / "soak_results.json"
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+from run_pipeline_bench import point_env_to  # noqa: E402
+
+
+def _serve_mock(queue):
+    from mock_server import server_url, start_mock_server
+    # 每篇的文章长度、图表行数 / 步数都随机，封面、正文图片和底图缓存面对的是不断变化的内容
+    server = start_mock_server(throughput=True, quiet=True, vary=True)
+    queue.put(server_url(server))
+    while True:
+        time.sleep(3600)
+
+
+def start_mock_process() -> tuple:
+    """在子进程里启动吞吐模式的 mock，返回 (进程, url)"""
+    ctx   = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc  = ctx.Process(target=_serve_mock, args=(queue,), daemon=True)
+    proc.start()
+    return proc, queue.get(timeout=30)
+
+
+def sample(main, runs: int) -> dict:
+    gc.collect()
+    try:
+        fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        fds = -1
+    return {
+        "runs":     runs,
+        "rss_mb":   round(main.rss_bytes() / 1024 / 1024, 1),
+        "fds":      fds,
+        "threads":  threading.active_count(),
+        "tmp_dirs": len(os.listdir(tempfile.gettempdir())),
+    }
+
+
+def slope_per_1000(points: list) -> float:
+    """最小二乘斜率：每 1000 篇 RSS 增长多少 MB"""
+    if len(points) < 2:
+        return 0.0
+    xs, ys = [p["runs"] for p in points], [p["rss_mb"] for p in points]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mx) ** 2 for x in xs)
+    return round(sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var * 1000, 2) if var else 0.0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="内存浸泡测试（mock 微信 + LLM）")
+    parser.add_argument("--runs",          type=int, default=2000)
+    parser.add_argument("--workers",       type=int, default=4)
+    parser.add_argument("--warmup",        type=int, default=200, help="前 N 篇不计入涨幅（缓存、连接池预热）")
+    parser.add_argument("--sample-every",  type=int, default=100)
+    parser.add_argument("--max-growth-mb", type=float, default=20.0, help="预热后 RSS 允许的最大涨幅")
+    parser.add_argument("--output",        default=str(RESULTS_JSON))
+    args = parser.parse_args()
+
+    mock, url = start_mock_process()
+    with tempfile.TemporaryDirectory(prefix="soak_") as tmp:
+        point_env_to(url, os.path.join(tmp, "state.db"))
+        import main
+
+        print(f"🚀 浸泡测试开始：{args.runs} 篇，{args.workers} 并发，mock={url}")
+        samples, failed, done = [sample(main, 0)], 0, 0
+        start = time.perf_counter()
+        while done < args.runs:
+            n = min(args.sample_every, args.runs - done)
+            topics = [f"浸泡主题{done + i}" for i in range(n)]
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = main.run_batch(topics, workers=args.workers)
+            failed += sum(1 for r in results if r["error"])
+            done   += n
+            samples.append(sample(main, done))
+            s = samples[-1]
+            print(f"  {done:>6} 篇  RSS {s['rss_mb']:>7.1f} MB  fd {s['fds']:>4}  线程 {s['threads']:>3}  "
+                  f"临时目录 {s['tmp_dirs']}", flush=True)
+        elapsed = time.perf_counter() - start
+    mock.terminate()
+
+    steady = [s for s in samples if s["runs"] >= args.warmup] or samples[-1:]
+    growth = round(steady[-1]["rss_mb"] - steady[0]["rss_mb"], 1)
+    summary = {
+        "runs":              args.runs,
+        "workers":           args.workers,
+        "failed":            failed,
+        "wall_seconds":      round(elapsed, 1),
+        "rss_start_mb":      steady[0]["rss_mb"],
+        "rss_end_mb":        steady[-1]["rss_mb"],
+        "rss_growth_mb":     growth,
+        "mb_per_1000_runs":  slope_per_1000(steady),
+        "fd_growth":         steady[-1]["fds"] - steady[0]["fds"],
+        "thread_growth":     steady[-1]["threads"] - steady[0]["threads"],
+        "tmp_dir_growth":    samples[-1]["tmp_dirs"] - samples[0]["tmp_dirs"],
+        "flat":              growth <= args.max_growth_mb,
+        "samples":           samples,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    mark = "✅" if summary["flat"] else "❌"
+    print(f"\n{mark} 预热后 RSS {summary['rss_start_mb']} → {summary['rss_end_mb']} MB"
+          f"（{growth:+} MB，{summary['mb_per_1000_runs']} MB/千篇），失败 {failed} 篇，耗时 {summary['wall_seconds']}s")
+    print(f"   fd {summary['fd_growth']:+d}  线程 {summary['thread_growth']:+d}  临时目录 {summary['tmp_dir_growth']:+d}")
+    print(f"📄 结果已保存：{args.output}")
+    sys.exit(0 if summary["flat"] else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
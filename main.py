@@ -5,12 +5,32 @@
 
 import os
 import re
+import sys
 import json
+import io
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+import functools
+import hashlib
+import tracemalloc
+import unicodedata
+import contextvars
+import signal
+import sqlite3
 import requests
 import schedule
 import time
-import tempfile
-from datetime import datetime
+import threading
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, redirect_stdout
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 from openai import OpenAI
 from PIL import Image, ImageDraw, ImageFont
@@ -23,32 +43,52 @@ load_dotenv()
 # 创建 .env 文件配置：
 #   WECHAT_APP_ID=your_app_id
 #   WECHAT_APP_SECRET=your_secret
+# 多个公众号用 ACCOUNTS_FILE 配置（见下方“公众号账号”），这里的环境变量作为默认账号
 WECHAT_APP_ID     = os.getenv("WECHAT_APP_ID")
 WECHAT_APP_SECRET = os.getenv("WECHAT_APP_SECRET")
-if not WECHAT_APP_ID or not WECHAT_APP_SECRET:
-    raise ValueError("请设置环境变量 WECHAT_APP_ID 和 WECHAT_APP_SECRET")
 
-# 支持的模型配置
+# 微信接口地址（压测时可指向本地 mock：bench/mock_server.py）
+WECHAT_API_BASE = os.getenv("WECHAT_API_BASE", "https://api.weixin.qq.com").rstrip("/")
+# 接口超时（秒）
+WECHAT_TIMEOUT  = float(os.getenv("WECHAT_TIMEOUT", "30"))
+LLM_TIMEOUT     = float(os.getenv("LLM_TIMEOUT", "300"))
+
+# 支持的模型配置（base_url 可用 <模型名>_BASE_URL 环境变量覆盖）
+# json_mode：该服务商支持的结构化输出方式，json_schema > json_object > None（只能走文本解析）
+# price：每百万 token 的美元价格（输入, 输出），只用于估算成本，以服务商账单为准
+# prompt_cache：auto 由服务商自动做前缀缓存；explicit 需要在 system 内容块上标 cache_control
 MODELS = {
     "openai": {
         "api_key": os.getenv("OPENAI_API_KEY", ""),
-        "base_url": "https://api.openai.com/v1",
+        "base_url": os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
         "model": "gpt-4o",
+        "prompt_cache": "auto",
+        "price": (2.5, 10.0),
+        "json_mode": "json_schema",
     },
     "deepseek": {
         "api_key": os.getenv("DEEPSEEK_API_KEY"),
-        "base_url": "https://api.deepseek.com/v1",
+        "base_url": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1"),
         "model": "deepseek-chat",
+        "prompt_cache": "auto",
+        "price": (0.27, 1.1),
+        "json_mode": "json_object",
     },
     "anthropic": {
         "api_key": os.getenv("ANTHROPIC_API_KEY", ""),
-        "base_url": "https://api.anthropic.com",
+        "base_url": os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com"),
         "model": "claude-sonnet-4-20250514",
+        "prompt_cache": "explicit",
+        "price": (3.0, 15.0),
+        "json_mode": None,
     },
     "gemini": {
         "api_key": os.getenv("GEMINI_API_KEY"),
-        "base_url": "https://generativelanguage.googleapis.com/v1beta/openai/",
+        "base_url": os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/openai/"),
         "model": "gemini-3-flash-preview",
+        "prompt_cache": "auto",
+        "price": (0.5, 3.0),
+        "json_mode": "json_schema",
     },
 }
 
@@ -82,25 +122,50 @@ else:
     FONT_BOLD = "/usr/share/fonts/opentype/noto/NotoSansCJK-Black.ttc"
     FONT_REG  = "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc"
 
-# 写作风格 skill 路径（优先读文件，没有则用内置默认）
+# 质量门槛：综合得分低于该值的文章不推草稿箱（0 表示不拦截）
+QUALITY_MIN_SCORE = int(os.getenv("QUALITY_MIN_SCORE", "0"))
+
+# 自动配图：调用方没传图表数据时，从文章的【配图需求】里提取对比表 / 流程图数据
+# CHART_MODEL 可以指定同一服务商下更便宜的模型，默认沿用当前模型
+AUTO_CHARTS = os.getenv("AUTO_CHARTS", "1") == "1"
+CHART_MODEL = os.getenv("CHART_MODEL", "")
+
+# 结构化输出：STRUCTURED_OUTPUT=1 时生成 / 评估要求模型直接输出 JSON（服务商不支持则仍走文本解析）。
+# 两种模式下解析失败都先用一次小调用把原始输出修成 JSON，不重新生成整篇；REPAIR_MODEL 默认沿用当前模型
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "0") == "1"
+REPAIR_MODEL      = os.getenv("REPAIR_MODEL", "")
+
+# 文章模式：two-call（默认，先生成再独立评估）/ single（一次调用生成 + 自评，延迟和输入 token 约减半）
+ARTICLE_MODE = os.getenv("ARTICLE_MODE", "two-call")
+
+# 写作风格 / 评估 skill 路径（写作 skill 找不到时用内置默认，评估 skill 找不到时跳过评估）
 SKILL_WRITE_PATH = os.getenv("SKILL_WRITE_PATH", "./SKILL_write.md")
+SKILL_EVAL_PATH  = os.getenv("SKILL_EVAL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "SKILL_eval.md"))
+
 
+# 客户端按 (服务商, key, base_url) 复用，连接池跨调用保留；热加载换了 key 会自动建新的
+_AI_CLIENTS = {}
 
-def get_ai_client():
-    """获取当前启用的 AI 客户端"""
-    config = MODELS.get(ACTIVE_MODEL)
+
+def get_ai_client(provider: str = None):
+    """获取 AI 客户端，默认当前启用的服务商"""
+    provider = provider or ACTIVE_MODEL
+    config = MODELS.get(provider)
     if not config or not config.get("api_key"):
-        raise ValueError(f"模型 {ACTIVE_MODEL} 未配置 API Key，请设置环境变量")
-    
-    client = OpenAI(api_key=config["api_key"], base_url=config["base_url"])
+        raise ValueError(f"模型 {provider} 未配置 API Key，请设置环境变量")
+
+    key = (provider, config["api_key"], config["base_url"])
+    client = _AI_CLIENTS.get(key)
+    if client is None:
+        client = _AI_CLIENTS.setdefault(
+            key, OpenAI(api_key=config["api_key"], base_url=config["base_url"], timeout=LLM_TIMEOUT))
+        # 同一服务商换了 key / base_url：旧客户端不再缓存，正在用它的调用结束后随引用释放（连同连接池）
+        for old in [k for k in _AI_CLIENTS if k[0] == provider and k != key]:
+            _AI_CLIENTS.pop(old, None)
     return client, config["model"]
 
 
-def _load_system_prompt():
-    if os.path.exists(SKILL_WRITE_PATH):
-        with open(SKILL_WRITE_PATH) as f:
-            return f.read()
-    return """
+DEFAULT_SYSTEM_PROMPT = """
 你是一个专注于轻创业、程序员、独立开发和AI领域的公众号作者。
 写作风格：大白话，真实感，适度制造焦虑但给出路，口语化，段落简短。
 严格按以下格式输出：
@@ -118,12 +183,520 @@ def _load_system_prompt():
 
 【结尾问句互动钩子】
 内容（18-22字）
+
+【配图需求】
+- 封面图（16:9）：画面描述
+- 正文配图：对比表 / 流程图的内容描述（可选）
 """
 
-SYSTEM_PROMPT = _load_system_prompt()
+# skill 文件只在修改时间变化时重新读取，平时直接用内存里的内容。
+# 每次请求发出去的 system 前缀因此逐字节不变，服务商的前缀缓存才能命中。
+_SKILL_CACHE = {}   # path → (mtime, 内容)
+_SKILL_LOCK  = threading.Lock()
+
+
+def load_skill(path: str, default: str = None) -> str:
+    """读取 skill 文件（按 mtime 缓存），文件不存在时返回 default"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return default
+    with _SKILL_LOCK:
+        cached = _SKILL_CACHE.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    with _SKILL_LOCK:
+        if cached:
+            print(f"🔄 skill 已更新，重新加载：{path}")
+        _SKILL_CACHE[path] = (mtime, text)
+    return text
+
+
+def system_prompt() -> str:
+    return load_skill(SKILL_WRITE_PATH, DEFAULT_SYSTEM_PROMPT)
 # ================================================
 
 
+# ────────────────────────────────────────────────
+# 耗时与指标
+# ────────────────────────────────────────────────
+
+# 结构化日志：每个阶段一行 JSON。"-" 输出到 stderr，填路径则追加写文件，不设不输出
+METRICS_LOG  = os.getenv("METRICS_LOG", "")
+# Prometheus 文本格式的指标文件，每次 run() 结束后覆盖写入；不设则只保存在内存
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+# 微信接口遇到系统繁忙（errcode -1）或网络超时时的重试次数
+WECHAT_MAX_RETRIES = int(os.getenv("WECHAT_MAX_RETRIES", "2"))
+
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_metrics_logger = logging.getLogger("wechat_pipeline.metrics")
+_metrics_logger.propagate = False
+if METRICS_LOG:
+    _handler = logging.StreamHandler() if METRICS_LOG == "-" else logging.FileHandler(METRICS_LOG, encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _metrics_logger.addHandler(_handler)
+    _metrics_logger.setLevel(logging.INFO)
+
+_run_id = contextvars.ContextVar("run_id", default="")
+_METRICS_LOCK = threading.Lock()
+_COUNTERS     = defaultdict(float)   # (name, labels) → 累计值
+_GAUGES       = defaultdict(float)   # (name, labels) → 当前值
+_HISTOGRAMS   = {}                   # (name, labels) → [各桶计数..., +Inf 计数, sum]
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """计数器累加"""
+    with _METRICS_LOCK:
+        _COUNTERS[(name, _labels(labels))] += value
+
+
+def add_gauge(name: str, delta: float, **labels):
+    """仪表值加减（在跑的文章数这类会回落的量）"""
+    with _METRICS_LOCK:
+        _GAUGES[(name, _labels(labels))] += delta
+
+
+def gauge_value(name: str, **labels) -> float:
+    with _METRICS_LOCK:
+        return _GAUGES.get((name, _labels(labels)), 0.0)
+
+
+def observe(name: str, value: float, **labels):
+    """直方图记录一个观测值"""
+    key = (name, _labels(labels))
+    with _METRICS_LOCK:
+        h = _HISTOGRAMS.setdefault(key, [0] * (len(HISTOGRAM_BUCKETS) + 2))
+        for i, b in enumerate(HISTOGRAM_BUCKETS):
+            if value <= b:
+                h[i] += 1
+        h[-2] += 1
+        h[-1] += value
+
+
+def log_event(event: str, **fields):
+    """输出一行结构化 JSON 日志，自动带上当前 run_id"""
+    if _metrics_logger.handlers:
+        record = {"ts": round(time.time(), 3), "event": event, "run_id": _run_id.get(), **fields}
+        _metrics_logger.info(json.dumps(record, ensure_ascii=False))
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """阶段计时：记入 pipeline_stage_seconds 直方图并输出一行 JSON 日志"""
+    t0, ok = time.perf_counter(), True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        observe("pipeline_stage_seconds", seconds, stage=stage)
+        if not ok:
+            inc("pipeline_stage_failures_total", stage=stage)
+        log_event("span", stage=stage, seconds=round(seconds, 4), ok=ok, **fields)
+
+
+def metrics_text() -> str:
+    """以 Prometheus 文本格式导出全部指标"""
+    def fmt(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        # 标签值按文本格式转义反斜杠、双引号和换行（账号名、错误信息里都可能出现）
+        esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    lines, seen = [], set()
+    with _METRICS_LOCK:
+        for (name, labels), value in sorted(_COUNTERS.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), value in sorted(_GAUGES.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} gauge")
+                seen.add(name)
+            lines.append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), h in sorted(_HISTOGRAMS.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            for b, count in zip(HISTOGRAM_BUCKETS, h):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', f'{b:g}')])} {count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h[-2]}")
+            lines.append(f"{name}_sum{fmt(labels)} {h[-1]:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {h[-2]}")
+    return "\n".join(lines) + "\n"
+
+
+def rss_bytes() -> int:
+    """当前进程的常驻内存（Linux 读 /proc；其它平台退回 ru_maxrss 峰值，取不到返回 0）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def write_metrics(path: str = None):
+    """把指标写到文件（先写临时文件再替换，避免读到半截内容）"""
+    path = path or METRICS_PATH
+    if not path:
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(metrics_text())
+    os.replace(tmp, path)
+
+
+# ────────────────────────────────────────────────
+# 本地状态库（SQLite）
+# ────────────────────────────────────────────────
+
+# 需要跨进程、跨重启保留的状态（LLM 用量等）都放在这个库里。
+# 每个线程一个连接，WAL 模式下多进程同时读写也不会互相卡住。
+STATE_DB = os.getenv("STATE_DB", "./state.db")
+
+_DB_LOCAL  = threading.local()
+_DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS llm_usage (
+        ts REAL, day TEXT, run_id TEXT, topic TEXT, provider TEXT, model TEXT, call TEXT,
+        prompt_tokens INTEGER, completion_tokens INTEGER, seconds REAL, cost_usd REAL,
+        cached_tokens INTEGER DEFAULT 0)""",
+    "CREATE INDEX IF NOT EXISTS idx_llm_usage_day ON llm_usage (day, provider)",
+    "CREATE INDEX IF NOT EXISTS idx_llm_usage_run ON llm_usage (run_id)",
+    # 微信接口令牌桶（跨进程共享）
+    """CREATE TABLE IF NOT EXISTS rate_buckets (
+        account TEXT, endpoint TEXT, tokens REAL, updated REAL, PRIMARY KEY (account, endpoint))""",
+    # 每日计数：接口调用数、drafts 草稿预占数、blocked:<接口> 超限标记
+    """CREATE TABLE IF NOT EXISTS daily_counters (
+        day TEXT, account TEXT, name TEXT, count INTEGER DEFAULT 0, PRIMARY KEY (day, account, name))""",
+    """CREATE TABLE IF NOT EXISTS deferred_topics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, account TEXT, topic TEXT, reason TEXT,
+        UNIQUE (account, topic))""",
+    # 正文图片 URL 缓存（media/uploadimg 的结果，按图片内容哈希）
+    """CREATE TABLE IF NOT EXISTS image_urls (
+        account TEXT, sha256 TEXT, url TEXT, ts REAL, PRIMARY KEY (account, sha256))""",
+    # 主题去重索引：每条是一篇文章的主题 / 标题 / 摘要之一，topic_lsh 是它的 LSH 分桶
+    """CREATE TABLE IF NOT EXISTS topic_index (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, account TEXT, topic TEXT, title TEXT,
+        kind TEXT, text TEXT, sig BLOB)""",
+    "CREATE TABLE IF NOT EXISTS topic_lsh (band INTEGER, bucket INTEGER, entry_id INTEGER)",
+    "CREATE INDEX IF NOT EXISTS idx_topic_lsh ON topic_lsh (band, bucket, entry_id)",
+    # 文章归档（全文索引见 _DB_FTS）
+    """CREATE TABLE IF NOT EXISTS articles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, day TEXT, run_id TEXT, account TEXT, topic TEXT,
+        title TEXT, digest TEXT, body TEXT, article_json TEXT, eval_json TEXT, total_score REAL,
+        status TEXT, draft_id TEXT, images_json TEXT, error TEXT)""",
+    "CREATE INDEX IF NOT EXISTS idx_articles_ts ON articles (ts)",
+    # 选题库：pending 待用 / used 已取用
+    """CREATE TABLE IF NOT EXISTS topic_backlog (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, pillar TEXT, topic TEXT UNIQUE, angle TEXT, reason TEXT,
+        score REAL, priority REAL, status TEXT, used_ts REAL, account TEXT)""",
+    "CREATE INDEX IF NOT EXISTS idx_topic_backlog ON topic_backlog (status, priority)",
+    # 已推草稿：同一账号同一个 key（主题）只保留一份草稿，改了就 draft/update；
+    # 记下封面素材和图片哈希，重跑时封面没变就复用，不再上传
+    """CREATE TABLE IF NOT EXISTS drafts (
+        account TEXT, key TEXT, media_id TEXT, content_hash TEXT, ts REAL,
+        thumb_media_id TEXT, cover_sha TEXT, PRIMARY KEY (account, key))""",
+]
+# 标题 / 正文全文索引（外部内容表，触发器同步）。trigram 分词要 SQLite 3.34+，
+# 建不出来就整组跳过（不能只建触发器，否则写 articles 会报错），检索退回 LIKE 扫描。
+_DB_FTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(
+        title, body, content='articles', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS articles_ai AFTER INSERT ON articles BEGIN
+        INSERT INTO articles_fts (rowid, title, body) VALUES (new.id, new.title, new.body); END""",
+    """CREATE TRIGGER IF NOT EXISTS articles_ad AFTER DELETE ON articles BEGIN
+        INSERT INTO articles_fts (articles_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); END""",
+]
+# 旧库补列：(表, 列, 类型)
+_DB_COLUMNS = [
+    ("llm_usage", "cached_tokens", "INTEGER DEFAULT 0"),
+    ("drafts", "thumb_media_id", "TEXT"),
+    ("drafts", "cover_sha", "TEXT"),
+]
+
+
+def _db() -> sqlite3.Connection:
+    """当前线程的状态库连接（自动提交；STATE_DB 变了会重新连接）"""
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None or _DB_LOCAL.path != STATE_DB:
+        conn = sqlite3.connect(STATE_DB, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for stmt in _DB_SCHEMA:
+            conn.execute(stmt)
+        for table, column, decl in _DB_COLUMNS:
+            if column not in {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        try:
+            conn.execute("BEGIN")
+            for stmt in _DB_FTS:
+                conn.execute(stmt)
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError as e:
+            conn.execute("ROLLBACK")
+            print(f"⚠️  SQLite 不支持 FTS5 trigram 全文索引（{e}），文章检索改用 LIKE 扫描")
+        _DB_LOCAL.fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'articles_fts'").fetchone() is not None
+        _DB_LOCAL.conn, _DB_LOCAL.path = conn, STATE_DB
+    return conn
+
+
+# ────────────────────────────────────────────────
+# LLM 用量、成本与预算
+# ────────────────────────────────────────────────
+
+# 每个服务商每天的 token 预算，格式 "deepseek=2000000,openai=500000"，不设则不限。
+# 超出预算时改用 LLM_FALLBACK_MODEL（它自己也没超预算的话），否则拒绝调用（BudgetExceeded），
+# 批量任务记为失败，定时任务当天跳过。
+LLM_DAILY_TOKEN_BUDGET = {
+    k.strip(): int(v) for k, v in
+    (item.split("=", 1) for item in os.getenv("LLM_DAILY_TOKEN_BUDGET", "").split(",") if "=" in item)
+}
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")
+
+_run_topic = contextvars.ContextVar("run_topic", default="")
+
+
+class BudgetExceeded(Exception):
+    """所有可用服务商当天的 token 预算都已用完"""
+
+
+def tokens_used_today(provider: str) -> int:
+    row = _db().execute(
+        "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM llm_usage WHERE day = ? AND provider = ?",
+        (datetime.now().strftime("%Y-%m-%d"), provider)).fetchone()
+    return row[0]
+
+
+def _pick_provider() -> str:
+    """按预算选服务商：ACTIVE_MODEL 优先，超预算时换 LLM_FALLBACK_MODEL"""
+    for provider in dict.fromkeys(p for p in (ACTIVE_MODEL, LLM_FALLBACK_MODEL) if p):
+        budget = LLM_DAILY_TOKEN_BUDGET.get(provider)
+        if budget and tokens_used_today(provider) >= budget:
+            continue
+        if provider != ACTIVE_MODEL:
+            inc("llm_budget_reroutes_total", provider=ACTIVE_MODEL, to=provider)
+            print(f"💸 {ACTIVE_MODEL} 今日 token 预算已用完，改用 {provider}")
+        return provider
+    inc("llm_budget_exceeded_total", provider=ACTIVE_MODEL)
+    raise BudgetExceeded(f"今日 token 预算已用完：{ACTIVE_MODEL}"
+                         + (f" / {LLM_FALLBACK_MODEL}" if LLM_FALLBACK_MODEL else ""))
+
+
+def _cached_tokens(usage) -> int:
+    """命中前缀缓存的输入 token：OpenAI / Gemini、DeepSeek、Anthropic 字段各不相同"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        details = SimpleNamespace(**details)
+    return int(getattr(details, "cached_tokens", 0)
+               or getattr(usage, "prompt_cache_hit_tokens", 0)
+               or getattr(usage, "cache_read_input_tokens", 0)
+               or 0)
+
+
+def _record_llm_usage(resp, call: str, provider: str = None, model: str = "", seconds: float = 0.0):
+    """记录一次 LLM 调用的 token 用量、耗时和估算成本（指标 + 状态库）"""
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return
+    provider   = provider or ACTIVE_MODEL
+    prompt     = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    cached     = _cached_tokens(usage)
+    price_in, price_out = MODELS.get(provider, {}).get("price", (0, 0))
+    cost = (prompt * price_in + completion * price_out) / 1_000_000
+
+    labels = {"provider": provider, "call": call}
+    inc("llm_tokens_total", prompt, kind="prompt", **labels)
+    inc("llm_tokens_total", completion, kind="completion", **labels)
+    inc("llm_tokens_total", cached, kind="cached", **labels)
+    inc("llm_cost_usd_total", cost, provider=provider)
+    if seconds:
+        observe("llm_call_seconds", seconds, **labels)
+    log_event("llm_usage", call=call, provider=provider, model=model, prompt_tokens=prompt,
+              completion_tokens=completion, cached_tokens=cached, seconds=round(seconds, 3), cost_usd=round(cost, 6))
+    now = time.time()
+    _db().execute(
+        """INSERT INTO llm_usage (ts, day, run_id, topic, provider, model, call, prompt_tokens,
+                                  completion_tokens, seconds, cost_usd, cached_tokens)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (now, datetime.fromtimestamp(now).strftime("%Y-%m-%d"), _run_id.get(), _run_topic.get(),
+         provider, model, call, prompt, completion, seconds, cost, cached))
+
+
+def _mark_cacheable(messages: list) -> list:
+    """把 system 内容整块标记为可缓存前缀（cache_control），skill 文件不变时每次都相同"""
+    return [dict(m, content=[{"type": "text", "text": m["content"], "cache_control": {"type": "ephemeral"}}])
+            if m["role"] == "system" and isinstance(m["content"], str) else m
+            for m in messages]
+
+
+def _chat(call: str, messages: list, temperature: float, model: str = None, schema: tuple = None):
+    """
+    所有 LLM 调用的统一入口：按预算选服务商、计时、记账。
+    model 只对 ACTIVE_MODEL 生效（改道到备用服务商时用它的默认模型）；
+    schema = (名称, JSON Schema) 时按服务商能力加 response_format。
+    """
+    provider = _pick_provider()
+    client, default_model = get_ai_client(provider)
+    model = (model if provider == ACTIVE_MODEL else None) or default_model
+    if MODELS[provider].get("prompt_cache") == "explicit":
+        messages = _mark_cacheable(messages)
+    extra = _response_format(*schema, provider=provider) if schema else {}
+    t0 = time.perf_counter()
+    resp = client.chat.completions.create(model=model, messages=messages, temperature=temperature, **extra)
+    _record_llm_usage(resp, call, provider, model, time.perf_counter() - t0)
+    return resp
+
+
+USAGE_GROUPS = ("provider", "topic", "run_id", "call", "day", "model")
+
+
+def usage_report(days: int = 1, by: str = "provider") -> list:
+    """
+    最近 days 天（含今天）的用量汇总，按 by 分组。
+    tokens_per_sec 是输出 token / 调用耗时，反映服务商的生成速度；
+    cache_hit_rate 是命中前缀缓存的输入 token 占比。
+    """
+    if by not in USAGE_GROUPS:
+        raise ValueError(f"by 只能是 {', '.join(USAGE_GROUPS)}")
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    rows = _db().execute(
+        f"""SELECT {by} AS key, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(completion_tokens) AS completion_tokens, SUM(cached_tokens) AS cached_tokens,
+                   SUM(seconds) AS seconds, SUM(cost_usd) AS cost_usd
+            FROM llm_usage WHERE day >= ? GROUP BY {by} ORDER BY cost_usd DESC""", (since,)).fetchall()
+    return [dict(r, tokens_per_sec=round(r["completion_tokens"] / r["seconds"], 1) if r["seconds"] else 0.0,
+                 cache_hit_rate=round(r["cached_tokens"] / r["prompt_tokens"], 3) if r["prompt_tokens"] else 0.0,
+                 cost_usd=round(r["cost_usd"], 4), seconds=round(r["seconds"], 2))
+            for r in rows]
+
+
+def run_usage(run_id: str) -> dict:
+    """单次运行的用量合计"""
+    row = _db().execute(
+        """SELECT COUNT(*) AS calls, COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+                  COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+                  COALESCE(SUM(cached_tokens), 0) AS cached_tokens, COALESCE(SUM(cost_usd), 0) AS cost_usd
+           FROM llm_usage WHERE run_id = ?""", (run_id,)).fetchone()
+    return dict(row)
+
+
+def print_usage_report(days: int = 1, by: str = "provider"):
+    rows = usage_report(days, by)
+    print(f"\n💰 最近 {days} 天 LLM 用量（按 {by}）")
+    print("-" * 98)
+    print(f"{by:<28} {'调用':>6} {'输入 tokens':>12} {'缓存命中':>8} {'输出 tokens':>12} {'tok/s':>8} {'成本 $':>10}")
+    for r in rows:
+        print(f"{str(r['key'])[:28]:<28} {r['calls']:>6} {r['prompt_tokens']:>12} {r['cache_hit_rate']:>8.0%} "
+              f"{r['completion_tokens']:>12} {r['tokens_per_sec']:>8} {r['cost_usd']:>10.4f}")
+    for provider, budget in LLM_DAILY_TOKEN_BUDGET.items():
+        print(f"   {provider} 今日预算：{tokens_used_today(provider)} / {budget}")
+    print("-" * 98)
+
+
+# ────────────────────────────────────────────────
+# 性能剖析（可选）
+# ────────────────────────────────────────────────
+
+# PROFILE=run 剖析整次 run()；PROFILE=render 剖析 run() 里每次渲染调用；不设则关闭
+# 也可以用命令行 python main.py --profile
+PROFILE       = os.getenv("PROFILE", "")
+PROFILE_DIR   = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))
+
+# 多个剖析可能并发（PROFILE=render 时投机线程里也在渲染）：按引用计数开关 tracemalloc。
+# 只关自己开的——PYTHONTRACEMALLOC 或外层工具已经在追踪的话不去动它
+_TRACEMALLOC_LOCK    = threading.Lock()
+_TRACEMALLOC_USERS   = 0
+_TRACEMALLOC_STARTED = False
+
+
+def _tracemalloc_acquire():
+    global _TRACEMALLOC_USERS, _TRACEMALLOC_STARTED
+    with _TRACEMALLOC_LOCK:
+        if _TRACEMALLOC_USERS == 0:
+            _TRACEMALLOC_STARTED = not tracemalloc.is_tracing()
+            if _TRACEMALLOC_STARTED:
+                tracemalloc.start(25)
+        _TRACEMALLOC_USERS += 1
+
+
+def _tracemalloc_release():
+    global _TRACEMALLOC_USERS, _TRACEMALLOC_STARTED
+    with _TRACEMALLOC_LOCK:
+        _TRACEMALLOC_USERS -= 1
+        if _TRACEMALLOC_USERS == 0 and _TRACEMALLOC_STARTED:
+            tracemalloc.stop()
+            _TRACEMALLOC_STARTED = False
+
+
+def profile_call(fn, *args, profile_dir: str = None, **kwargs):
+    """
+    在 cProfile + tracemalloc 下执行 fn(*args, **kwargs)，返回 fn 的返回值。
+    输出目录下写 <函数名>_<时间>.prof（可用 snakeviz / pstats 打开）、
+    <函数名>_<时间>.snapshot（tracemalloc 快照）和 .txt 摘要，并在终端打印 Top N。
+    profile_dir 不传时：参数里有输出图片路径就写在图片旁边，否则写到 PROFILE_DIR。
+    """
+    if profile_dir is None:
+        out = kwargs.get("output_path") or next(
+            (a for a in args if isinstance(a, str) and a.lower().endswith((".png", ".jpg", ".jpeg"))), None)
+        profile_dir = os.path.dirname(os.path.abspath(out)) if out else PROFILE_DIR
+    os.makedirs(profile_dir, exist_ok=True)
+    stem = os.path.join(profile_dir, f"{fn.__name__}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}")
+
+    profiler = cProfile.Profile()
+    _tracemalloc_acquire()
+    try:
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+    finally:
+        _tracemalloc_release()
+        profiler.dump_stats(f"{stem}.prof")
+        snapshot.dump(f"{stem}.snapshot")
+
+        buf = io.StringIO()
+        pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        buf.write(f"\n内存分配 Top {PROFILE_TOP_N}（峰值 {peak/1024/1024:.1f} MB）：\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+            buf.write(f"  {stat}\n")
+        summary = buf.getvalue()
+        with open(f"{stem}.txt", "w", encoding="utf-8") as f:
+            f.write(summary)
+        print(f"\n🔬 性能剖析：{fn.__name__}\n{summary}")
+        print(f"📄 剖析结果已保存：{stem}.prof / .snapshot / .txt")
+
+
+def _profiled(fn, *args, **kwargs):
+    """PROFILE=render 时剖析渲染调用（结果按 run_id 归到 PROFILE_DIR 下），否则直接执行"""
+    if PROFILE == "render":
+        return profile_call(fn, *args, profile_dir=os.path.join(PROFILE_DIR, _run_id.get() or "adhoc"), **kwargs)
+    return fn(*args, **kwargs)
+
+
 # ────────────────────────────────────────────────
 # 图片渲染工具函数
 # ────────────────────────────────────────────────
@@ -131,6 +704,20 @@ SYSTEM_PROMPT = _load_system_prompt()
 BG, DARK2, ACCENT = "#0f172a", "#1e293b", "#6366f1"
 WHITE, GRAY, GREEN, RED = "#ffffff", "#94a3b8", "#22c55e", "#ef4444"
 
+_FONT_CACHE = threading.local()
+
+
+def _font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """按 (路径, 字号) 缓存字体；FreeType 句柄不保证线程安全，所以每个线程各有一份"""
+    cache = getattr(_FONT_CACHE, "fonts", None)
+    if cache is None:
+        cache = _FONT_CACHE.fonts = {}
+    key = (path, size)
+    if key not in cache:
+        cache[key] = ImageFont.truetype(path, size)
+    return cache[key]
+
+
 def _hex2rgb(h):
     h = h.lstrip("#")
     return tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
@@ -158,26 +745,353 @@ def _wrap(draw, text, font, max_w):
     return lines
 
 
-def render_cover(title: str, subtitle: str, output_path: str, template_path: str = None):
-    """基于 .pen 模板渲染封面图（1200x675）"""
-    W, H, PAD = 1200, 675, 60
-    tpl_nodes = {}
-    if template_path and os.path.exists(template_path):
-        with open(template_path) as f:
-            tpl = json.load(f)
-        tpl_nodes = {n["id"]: n for n in tpl.get("nodes", [])}
+# 图片编码：渲染出来的都是大色块图表，调色板 PNG 通常比默认 PNG 小很多。
+# auto 在调色板 PNG / 普通 PNG 里取最小的，超出字节预算再降级为 JPEG。
+# 微信素材接口不收 WebP，所以不在候选里。
+IMAGE_FORMAT       = os.getenv("IMAGE_FORMAT", "auto")   # auto / png / png-palette / jpeg
+IMAGE_MAX_BYTES    = int(os.getenv("IMAGE_MAX_BYTES", str(2 * 1024 * 1024)))
+IMAGE_JPEG_QUALITY = min(max(int(os.getenv("IMAGE_JPEG_QUALITY", "85")), 1), 95)   # Pillow 建议不超过 95
 
-    img  = Image.new("RGB", (W, H), _hex2rgb(BG))
-    draw = ImageDraw.Draw(img)
 
+def _encode(img, fmt: str, **params) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+
+def encode_image(img, max_bytes: int = None, fmt: str = None) -> tuple:
+    """
+    按格式策略编码图片，返回 (字节, 扩展名)。
+    fmt: auto / png / png-palette / jpeg，默认 IMAGE_FORMAT；max_bytes 默认 IMAGE_MAX_BYTES。
+    JPEG 从 IMAGE_JPEG_QUALITY 起逐档降质量直到满足预算，仍超出则报错。
+    默认 PNG 只在 auto / png 时编码（它本身是候选），顺带算出省了多少；其它格式不为了统计多编一遍。
+    """
+    fmt       = fmt or IMAGE_FORMAT
+    max_bytes = max_bytes or IMAGE_MAX_BYTES
+
+    baseline   = None
+    candidates = []
+    if fmt in ("auto", "png"):
+        baseline = _encode(img, "PNG")   # 默认 PNG，同时作为对比基准
+        candidates.append(("png", baseline))
+    if fmt in ("auto", "png-palette"):
+        palette = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        candidates.append(("png-palette", _encode(palette, "PNG", optimize=True)))
+        palette.close()
+
+    chosen = min(candidates, key=lambda c: len(c[1])) if candidates else None
+    if chosen is None or len(chosen[1]) > max_bytes:
+        rgb = img.convert("RGB")
+        # 逐档降到 30 为止；起始质量本来就低于 30 时只按它编一次
+        for quality in range(IMAGE_JPEG_QUALITY, min(IMAGE_JPEG_QUALITY, 30) - 1, -10):
+            chosen = (f"jpeg-q{quality}", _encode(rgb, "JPEG", quality=quality, optimize=True))
+            if len(chosen[1]) <= max_bytes:
+                break
+        rgb.close()
+    name, data = chosen
+    if len(data) > max_bytes:
+        raise Exception(f"图片编码后 {len(data)//1024} KB，超过预算 {max_bytes//1024} KB")
+
+    inc("image_encoded_bytes_total", len(data), format=name.split("-q")[0])
+    if baseline is None:
+        log_event("image_encoded", format=name, bytes=len(data))
+        print(f"🗜️  图片编码：{name} {len(data)//1024} KB")
+    else:
+        saved = len(baseline) - len(data)
+        inc("image_bytes_saved_total", max(saved, 0))
+        log_event("image_encoded", format=name, bytes=len(data), baseline_bytes=len(baseline), saved_bytes=saved)
+        print(f"🗜️  图片编码：{name} {len(data)//1024} KB（默认 PNG {len(baseline)//1024} KB，"
+              f"省 {saved*100//max(len(baseline), 1)}%）")
+    return data, ("jpg" if name.startswith("jpeg") else "png")
+
+
+def _save_image(img, output_path=None):
+    """
+    渲染结果输出，统一走 encode_image：output_path 为空时直接返回编码后的字节（不落盘）；
+    传文件对象则写进去并返回该对象；传路径则按扩展名选 PNG / JPEG 编码后保存并返回路径。
+    编码完就关闭 img，像素缓冲立刻释放，不等垃圾回收。
+    """
+    try:
+        if output_path is None:
+            return encode_image(img)[0]
+        if hasattr(output_path, "write"):
+            output_path.write(encode_image(img)[0])
+            return output_path
+        fmt = "jpeg" if output_path.lower().endswith((".jpg", ".jpeg")) else None
+        if fmt is None and IMAGE_FORMAT == "jpeg":
+            fmt = "png"   # 文件名是 .png 就不写 JPEG 内容
+        with open(output_path, "wb") as f:
+            f.write(encode_image(img, fmt=fmt)[0])
+        return output_path
+    finally:
+        img.close()
+
+
+# ── 静态底图缓存 ──
+# 文字以外的图形只画一次，之后每次渲染从底图 copy() 开始，只画文字：
+# 封面的条纹、同心圆和底部色条按 (宽, 高, 底色) 缓存；
+# 对比表的表头色块、斑马纹和底部色条按版式几何（表头高、各行行高）缓存，
+# 流程图的卡片、高亮框、序号圆、箭头和底部色条按卡片尺寸和位置缓存。
+# 行数 / 步数相同、没有折行的图表几何完全一样，内容不同也能命中；折行改变了行高才会另画一张。
+
+@functools.lru_cache(maxsize=8)
+def _cover_base(W: int, H: int, bg: str) -> Image.Image:
+    img  = Image.new("RGB", (W, H), _hex2rgb(bg))
+    draw = ImageDraw.Draw(img)
     for i in range(8):
         draw.rectangle([0, i*2, W//3, i*2+2], fill=(99,102,241))
     for i in range(3):
         r = 60+i*40
         draw.ellipse([W-r*2+20, H-r*2+20, W+20, H+20], outline=(99,102,241), width=2)
+    draw.rectangle([60, H-8, W-60, H-4], fill=_hex2rgb(ACCENT))
+    return img
+
+
+@functools.lru_cache(maxsize=8)
+def _comparison_base(W: int, H: int, bg: str, ty: int, header_h: int, row_hs: tuple) -> Image.Image:
+    """背景 + 底部色条 + 表头色块和斑马纹"""
+    img  = Image.new("RGB", (W, H), _hex2rgb(bg))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([60, H-10, W-60, H-4], fill=_hex2rgb(ACCENT))
+    _draw_comparison_rows(draw, W, ty, header_h, row_hs)
+    return img
+
+
+@functools.lru_cache(maxsize=8)
+def _workflow_base(W: int, H: int, bg: str, card_w: int, card_h: int, cards: tuple, arrows: tuple) -> Image.Image:
+    """背景 + 底部色条 + 卡片、高亮框、序号圆和箭头"""
+    img  = Image.new("RGB", (W, H), _hex2rgb(bg))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([60, H-10, W-60, H-4], fill=_hex2rgb(ACCENT))
+    _draw_workflow_cards(draw, card_w, card_h, cards, arrows)
+    return img
+
+
+def _draw_comparison_rows(draw, W: int, ty: int, header_h: int, row_hs: tuple):
+    """表头色块 + 斑马纹，行高各不相同（长单元格折行）"""
+    _draw_rounded_rect(draw, [60, ty, W-60, ty+header_h], 10, ACCENT)
+    y = ty + header_h
+    for ri, rh in enumerate(row_hs):
+        draw.rectangle([60, y, W-60, y+rh], fill=_hex2rgb(DARK2 if ri%2==0 else BG))
+        y += rh
+
+
+def _draw_workflow_cards(draw, card_w: int, card_h: int, cards: tuple, arrows: tuple):
+    """卡片、高亮框、序号圆和箭头"""
+    f_num = _font(FONT_BOLD, 30)
+    n = len(cards)
+    for i, (x, y) in enumerate(cards):
+        _draw_rounded_rect(draw, [x, y, x+card_w, y+card_h], 14, DARK2)
+        if i == n//2:
+            draw.rounded_rectangle([x-2, y-2, x+card_w+2, y+card_h+2],
+                                    radius=14, outline=_hex2rgb(ACCENT), width=3)
+        ccx, ccy = x+card_w//2, y+36
+        draw.ellipse([ccx-24, ccy-24, ccx+24, ccy+24], fill=_hex2rgb(ACCENT))
+        nw = draw.textlength(str(i+1), font=f_num)
+        draw.text((ccx-nw//2, ccy-16), str(i+1), font=f_num, fill=_hex2rgb(WHITE))
+    for ax, ay, bx in arrows:
+        draw.line([ax, ay, bx-14, ay], fill=_hex2rgb(ACCENT), width=3)
+        draw.polygon([(bx-14,ay-8),(bx,ay),(bx-14,ay+8)], fill=_hex2rgb(ACCENT))
+
+
+# ── 自适应版式 ──
+# 先量一遍内容（每个字符的宽度只量一次），算出字号、列宽 / 卡片尺寸和折行，
+# 绘制阶段直接用量好的行宽居中，不再反复调用 textlength。
+# 字号按候选从大到小试，放得下就用；最小字号仍放不下时折行。
+
+COMPARISON_FONT_SIZES = ((26, 24), (24, 22), (22, 20), (20, 18))   # (表头, 单元格)
+WORKFLOW_FONT_SIZES   = ((26, 22), (24, 20), (22, 18))             # (卡片标题, 描述)
+CELL_PAD    = 16    # 单元格左右内边距
+CARD_PAD    = 16    # 卡片左右内边距
+CARD_MIN_W  = 160
+CARD_MAX_W  = 260
+CARD_GAP    = 48    # 卡片最小间距（要放得下箭头）
+CARD_ROW_GAP = 40
+
+
+def _char_width(font, ch: str, memo: dict) -> float:
+    key = (id(font), ch)
+    w = memo.get(key)
+    if w is None:
+        w = memo[key] = font.getlength(ch)
+    return w
+
+
+def _text_width(font, text: str, memo: dict) -> float:
+    return sum(_char_width(font, ch, memo) for ch in text)
+
+
+def _wrap_measured(text: str, font, max_w: float, memo: dict) -> list:
+    """按字符宽度累加折行，返回 [(行, 行宽)]，空串也返回一行"""
+    lines, cur, cur_w = [], "", 0.0
+    for ch in text:
+        cw = _char_width(font, ch, memo)
+        if cur and cur_w + cw > max_w:
+            # 英文单词不从中间断开：退回到最后一个空格处换行
+            cut = cur.rfind(" ") + 1 if ch != " " else 0
+            head, tail = (cur[:cut].rstrip(), cur[cut:]) if cut > 0 else (cur, "")
+            lines.append((head, _text_width(font, head, memo)))
+            cur = (tail + ch).lstrip(" ")
+            cur_w = _text_width(font, cur, memo)
+        else:
+            cur += ch; cur_w += cw
+    lines.append((cur, cur_w))
+    return lines
+
+
+def _fit_title(text: str, W: int, sizes=(40, 36, 32, 28)):
+    """图表标题单行显示，放不下就逐档缩小字号，最小字号仍放不下则截断加省略号。返回 (字体, 文本, 宽度)"""
+    memo = {}
+    for size in sizes:
+        f = _font(FONT_BOLD, size)
+        w = _text_width(f, text, memo)
+        if w <= W - 120:
+            return f, text, w
+    text, w = _wrap_measured(text, f, W - 120 - _text_width(f, "…", memo), memo)[0]
+    return f, text + "…", w + _text_width(f, "…", memo)
+
+
+def _fit_columns(natural: list, total: int) -> list:
+    """
+    列宽分配：自然宽度放得下时按比例分掉余量；放不下时窄列保持自然宽度，
+    剩下的宽度按自然宽度比例分给宽列（宽列里的内容折行）。
+    """
+    if sum(natural) <= total:
+        slack = total - sum(natural)
+        widths = [w + slack // len(natural) for w in natural]
+    else:
+        widths, rest, wide = list(natural), total, list(range(len(natural)))
+        while True:
+            fair   = rest / len(wide)
+            narrow = [i for i in wide if natural[i] <= fair]
+            if not narrow:
+                break
+            rest -= sum(natural[i] for i in narrow)
+            wide  = [i for i in wide if i not in narrow]
+        wide_sum = sum(natural[i] for i in wide)
+        for i in wide:
+            widths[i] = int(rest * natural[i] / wide_sum)
+    widths[-1] += total - sum(widths)   # 取整误差补到最后一列
+    return widths
+
+
+def _layout_comparison(headers: list, rows: list, W: int) -> dict:
+    total = W - 120
+    n     = len(headers)
+    memo  = {}
+    for size_h, size_c in COMPARISON_FONT_SIZES:
+        f_h, f_cell = _font(FONT_BOLD, size_h), _font(FONT_REG, size_c)
+        natural = [
+            int(max([_text_width(f_h, str(headers[ci]), memo)] +
+                    [_text_width(f_cell, str(r[ci]), memo) for r in rows if ci < len(r)])) + CELL_PAD*2
+            for ci in range(n)
+        ]
+        if sum(natural) <= total:
+            break
+    col_w = _fit_columns(natural, total)
+
+    def wrap_row(cells, font):
+        return [_wrap_measured(str(c), font, w - CELL_PAD*2, memo) for c, w in zip(cells, col_w)]
+
+    header_cells = wrap_row(headers, f_h)
+    body_cells   = [wrap_row(r, f_cell) for r in rows]
+    # 单行时行高 72，与原先一致；每多一行加一个行距
+    header_h = 72 + (max(len(c) for c in header_cells) - 1) * (size_h + 12)
+    row_hs   = tuple(72 + (max((len(c) for c in cells), default=1) - 1) * (size_c + 12)
+                     for cells in body_cells)
+    return {
+        "f_h": f_h, "f_cell": f_cell, "line_h": (size_h + 12, size_c + 12),
+        "col_w": col_w, "header_cells": header_cells, "body_cells": body_cells,
+        "header_h": header_h, "row_hs": row_hs,
+    }
+
+
+def _layout_workflow(steps: list, W: int, H: int) -> dict:
+    avail = W - 120
+    n     = len(steps)
+    memo  = {}
+    for size_t, size_d in WORKFLOW_FONT_SIZES:
+        f_ct, f_desc = _font(FONT_BOLD, size_t), _font(FONT_REG, size_d)
+        need = max(max([_text_width(f_ct, title, memo)] +
+                       [_text_width(f_desc, line, memo) for line in desc.split("\n")])
+                   for _, title, desc in steps)
+        card_w = int(min(CARD_MAX_W, max(CARD_MIN_W, need + CARD_PAD*2)))
+        cols   = max(1, min(n, (avail + CARD_GAP) // (card_w + CARD_GAP)))
+        if cols >= n:
+            break
+    else:
+        # 最小字号也放不下：卡片还能压窄就一行排开、文字折行，否则分多行
+        one_row_w = (avail - (n-1)*CARD_GAP) // n
+        if one_row_w >= CARD_MIN_W:
+            card_w, cols = one_row_w, n
+    # 每行卡片数尽量平均
+    n_rows = -(-n // cols)
+    cols   = -(-n // n_rows)
+
+    inner = card_w - CARD_PAD*2
+    t_lh, d_lh = size_t + 18, size_d + 10
+    cards_text = []
+    for _, title, desc in steps:
+        t_lines = _wrap_measured(title, f_ct, inner, memo)
+        d_lines = [seg for line in desc.split("\n") for seg in _wrap_measured(line, f_desc, inner, memo)]
+        cards_text.append((t_lines, d_lines))
+    # 单行标题 + 两行描述时卡片高 220，与原先一致
+    body_h = max(len(t) * t_lh + len(d) * d_lh for t, d in cards_text)
+    card_h = max(220, 76 + body_h + 24)
+
+    grid_h = n_rows * card_h + (n_rows - 1) * CARD_ROW_GAP
+    H      = max(H, 140 + grid_h + 90)
+    top    = (H - grid_h) // 2 + 20
+
+    cards, arrows = [], []
+    for r in range(n_rows):
+        k   = min(cols, n - r*cols)
+        gap = max(CARD_GAP, (avail - k*card_w) // (k-1)) if k > 1 else 0
+        sx  = (W - (k*card_w + (k-1)*gap)) // 2
+        y   = top + r*(card_h + CARD_ROW_GAP)
+        for c in range(k):
+            x = sx + c*(card_w + gap)
+            cards.append((x, y))
+            if c < k-1:
+                arrows.append((x + card_w + 12, y + card_h//2, x + card_w + gap - 10))
+    return {
+        "H": H, "f_ct": f_ct, "f_desc": f_desc, "t_lh": t_lh, "d_lh": d_lh,
+        "card_w": card_w, "card_h": card_h, "cards": tuple(cards), "arrows": tuple(arrows),
+        "cards_text": cards_text,
+    }
+
+
+# .pen 模板和 skill 一样按 mtime 缓存：不用每张封面都读一遍 JSON，改了模板下一张就生效
+_TEMPLATE_CACHE = {}   # path → (mtime, {节点 id: 节点})
+
+
+def load_template(path: str) -> dict:
+    """读取 .pen 模板的节点表（按 mtime 缓存），文件不存在时返回空表"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return {}
+    cached = _TEMPLATE_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, encoding="utf-8") as f:
+        nodes = {n["id"]: n for n in json.load(f).get("nodes", [])}
+    if cached:
+        print(f"🔄 模板已更新，重新加载：{path}")
+    _TEMPLATE_CACHE[path] = (mtime, nodes)
+    return nodes
+
+
+def render_cover(title: str, subtitle: str, output_path: str = None, template_path: str = None):
+    """基于 .pen 模板渲染封面图（1200x675），output_path 为空时返回 PNG 字节"""
+    W, H, PAD = 1200, 675, 60
+    tpl_nodes = load_template(template_path) if template_path else {}
+
+    img  = _cover_base(W, H, tpl_nodes.get("cover", {}).get("fill", BG)).copy()
+    draw = ImageDraw.Draw(img)
 
-    f_t = ImageFont.truetype(FONT_BOLD, tpl_nodes.get("title",{}).get("fontSize", 52))
-    f_s = ImageFont.truetype(FONT_REG,  tpl_nodes.get("subtitle",{}).get("fontSize", 28))
+    f_t = _font(FONT_BOLD, tpl_nodes.get("title",{}).get("fontSize", 52))
+    f_s = _font(FONT_REG,  tpl_nodes.get("subtitle",{}).get("fontSize", 28))
 
     tl = _wrap(draw, title,    f_t, W-PAD*2)
     sl = _wrap(draw, subtitle, f_s, W-PAD*2)
@@ -192,125 +1106,554 @@ def render_cover(title: str, subtitle: str, output_path: str, template_path: str
         lw = draw.textlength(line, font=f_s)
         draw.text(((W-lw)//2, y), line, font=f_s, fill=_hex2rgb(GRAY)); y += 36
 
-    draw.rectangle([60, H-8, W-60, H-4], fill=_hex2rgb(ACCENT))
-    img.save(output_path)
+    result = _save_image(img, output_path)
     print(f"✅ 封面图渲染完成")
+    return result
 
 
-def render_comparison(headers, rows, chart_title: str, output_path: str):
-    """渲染框架对比表"""
-    W  = 1200
-    H  = 110 + 72*(len(rows)+1) + 80
-    img  = Image.new("RGB", (W, H), _hex2rgb(BG))
+def render_comparison(headers, rows, chart_title: str, output_path: str = None, note: str = None):
+    """
+    渲染对比表，output_path 为空时返回 PNG 字节。
+    列宽、字号按内容自适应，长单元格自动折行；note 为底部注释，默认“* 最后一列 综合表现最优”，传空串不显示。
+    """
+    W, ty = 1200, 100
+    lay = _layout_comparison(headers, rows, W)
+    H   = ty + lay["header_h"] + sum(lay["row_hs"]) + 90
+    img  = _comparison_base(W, H, BG, ty, lay["header_h"], lay["row_hs"]).copy()
     draw = ImageDraw.Draw(img)
 
-    f_t    = ImageFont.truetype(FONT_BOLD, 40)
-    f_h    = ImageFont.truetype(FONT_BOLD, 26)
-    f_cell = ImageFont.truetype(FONT_REG,  24)
-    f_note = ImageFont.truetype(FONT_REG,  20)
-
-    _centered(draw, chart_title, f_t, 0, 30, W, WHITE)
+    f_note = _font(FONT_REG, 20)
+    f_t, title, tw = _fit_title(chart_title, W)
+    draw.text(((W-tw)//2, 30), title, font=f_t, fill=_hex2rgb(WHITE))
 
     n = len(headers)
-    col_w = [280] + [(W-340)//(n-1)]*(n-1)
     col_x = [60]
-    for w in col_w[:-1]: col_x.append(col_x[-1]+w)
-
-    row_h, ty = 72, 100
-    _draw_rounded_rect(draw, [col_x[0], ty, W-60, ty+row_h], 10, ACCENT)
-    for h, x, w in zip(headers, col_x, col_w):
-        _centered(draw, h, f_h, x, ty+20, w, WHITE)
-
-    for ri, row in enumerate(rows):
-        y = ty+row_h*(ri+1)
-        draw.rectangle([col_x[0], y, W-60, y+row_h], fill=_hex2rgb(DARK2 if ri%2==0 else BG))
-        for ci, (cell, x, w) in enumerate(zip(row, col_x, col_w)):
-            color = GREEN if cell=="✓" else RED if cell=="✗" else ACCENT if ci==n-1 else GRAY if ci==0 else WHITE
-            _centered(draw, cell, f_cell, x, y+22, w, color)
-
-    note = f"* {headers[-1]} 综合表现最优"
-    nw = draw.textlength(note, font=f_note)
-    draw.text(((W-nw)//2, H-44), note, font=f_note, fill=_hex2rgb(GRAY))
-    draw.rectangle([60, H-10, W-60, H-4], fill=_hex2rgb(ACCENT))
-    img.save(output_path)
+    for w in lay["col_w"][:-1]: col_x.append(col_x[-1]+w)
+
+    def draw_cells(cells, y, row_h, font, line_h, color_of):
+        for ci, (lines, x, w) in enumerate(zip(cells, col_x, lay["col_w"])):
+            ly = y + (row_h - (len(lines)-1)*line_h - font.size)//2 - 2
+            for text, lw in lines:
+                draw.text((x+(w-lw)//2, ly), text, font=font, fill=_hex2rgb(color_of(ci, text)))
+                ly += line_h
+
+    h_lh, c_lh = lay["line_h"]
+    draw_cells(lay["header_cells"], ty, lay["header_h"], lay["f_h"], h_lh, lambda ci, t: WHITE)
+    y = ty + lay["header_h"]
+    for cells, rh in zip(lay["body_cells"], lay["row_hs"]):
+        draw_cells(cells, y, rh, lay["f_cell"], c_lh,
+                   lambda ci, t: GREEN if t=="✓" else RED if t=="✗" else ACCENT if ci==n-1 else GRAY if ci==0 else WHITE)
+        y += rh
+
+    if note is None:
+        note = f"* {headers[-1]} 综合表现最优"
+    if note:
+        nw = draw.textlength(note, font=f_note)
+        draw.text(((W-nw)//2, H-44), note, font=f_note, fill=_hex2rgb(GRAY))
+    result = _save_image(img, output_path)
     print(f"✅ 对比表渲染完成")
+    return result
 
 
-def render_workflow(steps: list, chart_title: str, subtitle: str, output_path: str):
-    """渲染流程图，steps = [("emoji", "标题", "描述\n第二行"), ...]"""
-    W, H = 1200, 675
-    img  = Image.new("RGB", (W, H), _hex2rgb(BG))
+def render_workflow(steps: list, chart_title: str, subtitle: str, output_path: str = None, note: str = ""):
+    """
+    渲染流程图，steps = [("emoji", "标题", "描述\\n第二行"), ...]，output_path 为空时返回 PNG 字节。
+    卡片宽度、字号按内容和步数自适应，一行放不下自动分多行（画布随之加高），描述自动折行；
+    note 为底部注释，默认不显示。
+    """
+    W   = 1200
+    lay = _layout_workflow(steps, W, 675)
+    H   = lay["H"]
+    card_w = lay["card_w"]
+    img  = _workflow_base(W, H, BG, card_w, lay["card_h"], lay["cards"], lay["arrows"]).copy()
     draw = ImageDraw.Draw(img)
 
-    f_t    = ImageFont.truetype(FONT_BOLD, 40)
-    f_sub  = ImageFont.truetype(FONT_REG,  22)
-    f_num  = ImageFont.truetype(FONT_BOLD, 30)
-    f_ct   = ImageFont.truetype(FONT_BOLD, 26)
-    f_desc = ImageFont.truetype(FONT_REG,  22)
-    f_note = ImageFont.truetype(FONT_REG,  20)
-
-    _centered(draw, chart_title, f_t,   0, 36, W, WHITE)
-    _centered(draw, subtitle,    f_sub, 0, 88, W, GRAY)
-
-    n = len(steps)
-    card_w, card_h = 200, 220
-    gap = max(20, (W-120-n*card_w)//(n-1)) if n > 1 else 0
-    sx  = (W - (n*card_w + (n-1)*gap)) // 2
-    cy  = (H-card_h)//2 + 20
-
-    for i, (_, title, desc) in enumerate(steps):
-        x = sx + i*(card_w+gap)
-        _draw_rounded_rect(draw, [x, cy, x+card_w, cy+card_h], 14, DARK2)
-        if i == n//2:
-            draw.rounded_rectangle([x-2, cy-2, x+card_w+2, cy+card_h+2],
-                                    radius=14, outline=_hex2rgb(ACCENT), width=3)
-        ccx, ccy = x+card_w//2, cy+36
-        draw.ellipse([ccx-24, ccy-24, ccx+24, ccy+24], fill=_hex2rgb(ACCENT))
-        nw = draw.textlength(str(i+1), font=f_num)
-        draw.text((ccx-nw//2, ccy-16), str(i+1), font=f_num, fill=_hex2rgb(WHITE))
-        tw = draw.textlength(title, font=f_ct)
-        draw.text((x+(card_w-tw)//2, cy+76), title, font=f_ct, fill=_hex2rgb(WHITE))
-        for li, line in enumerate(desc.split("\n")):
-            lw = draw.textlength(line, font=f_desc)
-            draw.text((x+(card_w-lw)//2, cy+120+li*32), line, font=f_desc, fill=_hex2rgb(GRAY))
-        if i < n-1:
-            ax = x+card_w+12; ay = cy+card_h//2
-            draw.line([ax, ay, ax+gap-24, ay], fill=_hex2rgb(ACCENT), width=3)
-            draw.polygon([(ax+gap-24,ay-8),(ax+gap-10,ay),(ax+gap-24,ay+8)], fill=_hex2rgb(ACCENT))
-
-    note = "安全保障：16 层独立安全机制 · WASM 沙箱隔离 · 消费步骤强制人工确认"
-    nw = draw.textlength(note, font=f_note)
-    draw.text(((W-nw)//2, H-48), note, font=f_note, fill=_hex2rgb(GRAY))
-    draw.rectangle([60, H-10, W-60, H-4], fill=_hex2rgb(ACCENT))
-    img.save(output_path)
+    f_sub  = _font(FONT_REG,  22)
+    f_note = _font(FONT_REG,  20)
+    f_t, title, tw = _fit_title(chart_title, W)
+    draw.text(((W-tw)//2, 36), title, font=f_t, fill=_hex2rgb(WHITE))
+    _centered(draw, subtitle, f_sub, 0, 88, W, GRAY)
+
+    for (x, cy), (t_lines, d_lines) in zip(lay["cards"], lay["cards_text"]):
+        y = cy + 76
+        for text, lw in t_lines:
+            draw.text((x+(card_w-lw)//2, y), text, font=lay["f_ct"], fill=_hex2rgb(WHITE))
+            y += lay["t_lh"]
+        for text, lw in d_lines:
+            draw.text((x+(card_w-lw)//2, y), text, font=lay["f_desc"], fill=_hex2rgb(GRAY))
+            y += lay["d_lh"]
+
+    if note:
+        nw = draw.textlength(note, font=f_note)
+        draw.text(((W-nw)//2, H-48), note, font=f_note, fill=_hex2rgb(GRAY))
+    result = _save_image(img, output_path)
     print(f"✅ 流程图渲染完成")
+    return result
+
+
+# ────────────────────────────────────────────────
+# 批量渲染（多进程）
+# ────────────────────────────────────────────────
+
+# spec 的 kind → 渲染函数。cover / comparison / workflow 取自本文件，
+# hands_cards 等固定配图取自 scripts/render_images.py（只接受 output_path）
+RENDERERS = {
+    "cover":      render_cover,
+    "comparison": render_comparison,
+    "workflow":   render_workflow,
+}
+SCRIPT_RENDERERS = ("comparison", "workflow", "hands_cards")
+
+# 预热的常用字号（与各渲染函数保持一致）
+_WARM_FONT_SIZES = {FONT_BOLD: (26, 30, 40, 52), FONT_REG: (20, 22, 24, 28)}
+
+
+def _render_worker_init(quiet: bool):
+    """进程池 initializer：每个 worker 只加载一次字体，并可关掉渲染日志"""
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    for path, sizes in _WARM_FONT_SIZES.items():
+        for size in sizes:
+            _font(path, size)
+
+
+def _render_spec(spec: dict):
+    """worker 里执行单个 spec，返回渲染结果（字节或输出路径）"""
+    kind = spec["kind"]
+    if kind.startswith("script:"):
+        from scripts import render_images
+        name = kind.split(":", 1)[1]
+        if name not in SCRIPT_RENDERERS:
+            raise ValueError(f"未知的 scripts 渲染器：{name}")
+        getattr(render_images, f"render_{name}")(spec["output_path"])
+        return spec["output_path"]
+    if kind not in RENDERERS:
+        raise ValueError(f"未知的渲染类型：{kind}")
+    return RENDERERS[kind](**spec.get("args", {}), output_path=spec.get("output_path"))
+
+
+def _timed_render_spec(spec: dict) -> tuple:
+    t0 = time.perf_counter()
+    result = _render_spec(spec)
+    return result, round(time.perf_counter() - t0, 4)
+
+
+def render_many(specs, workers: int = None, quiet: bool = True, max_pending: int = None):
+    """
+    用进程池批量渲染，适合品牌色调整后整批重刷封面 / 配图。
+
+    specs: 可迭代对象（可以是生成器，边读边提交），每项形如
+        {"kind": "cover", "args": {"title": ..., "subtitle": ..., "template_path": ...},
+         "output_path": "out/1.png"}          # output_path 省略时结果为编码后的字节
+        {"kind": "script:hands_cards", "output_path": "out/hands.png"}
+    按完成顺序逐个产出：
+        {"index": 在 specs 中的序号, "spec": spec, "result": 字节/路径, "error": None 或错误信息, "seconds": 耗时}
+    单个 spec 失败不会中断整批。同时在途的任务数不超过 max_pending（默认 workers*4）。
+    """
+    workers     = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+    it = iter(enumerate(specs))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_render_worker_init, initargs=(quiet,)) as pool:
+        pending = {}
+
+        def _fill():
+            while len(pending) < max_pending:
+                try:
+                    index, spec = next(it)
+                except StopIteration:
+                    return
+                pending[pool.submit(_timed_render_spec, spec)] = (index, spec)
+
+        _fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                index, spec = pending.pop(fut)
+                try:
+                    result, seconds = fut.result()
+                    error = None
+                except Exception as e:
+                    result, seconds, error = None, None, f"{type(e).__name__}: {e}"
+                    inc("render_many_failures_total", kind=spec.get("kind", "?"))
+                yield {"index": index, "spec": spec, "result": result, "error": error, "seconds": seconds}
+            _fill()
+
+
+# ────────────────────────────────────────────────
+# 公众号账号
+# ────────────────────────────────────────────────
+
+# 账号清单从 ACCOUNTS_FILE（JSON）读取，格式见 accounts.example.json；
+# 文件不存在时用 WECHAT_APP_ID / WECHAT_APP_SECRET 组成一个 default 账号（兼容单账号用法）。
+# 每个账号独立的 access_token 缓存、接口限速、每日草稿配额和并发上限，互不影响。
+# 限速和每日计数存在 STATE_DB 里，同一台机器上的多个 worker 进程共用一份额度。
+ACCOUNTS_FILE           = os.getenv("ACCOUNTS_FILE", "./accounts.json")
+ACCOUNT_MAX_CONCURRENCY = int(os.getenv("ACCOUNT_MAX_CONCURRENCY", "2"))
+TOKEN_REFRESH_MARGIN    = 300   # access_token 提前 5 分钟刷新
+
+
+def _parse_limits(text: str) -> dict:
+    """"draft/add=20,*=120" → {"draft/add": 20.0, "*": 120.0}"""
+    return {k.strip(): float(v) for k, v in (item.split("=", 1) for item in text.split(",") if "=" in item)}
+
+
+# 微信接口限速（每分钟调用数），按接口配置，"*" 是其它接口的默认值，如 "material/add_material=30,*=120"
+WECHAT_RATE_LIMITS  = _parse_limits(os.getenv("WECHAT_RATE_LIMITS", ""))
+# 每日调用上限，格式同上；剩余不够跑一篇时，新文章进延后队列，不会跑到一半才撞上 45009
+WECHAT_DAILY_LIMITS = _parse_limits(os.getenv("WECHAT_DAILY_LIMITS", ""))
+# 一篇文章大约要用的接口调用数（封面素材 + 两张正文图 + 草稿），开跑前按它检查余量
+RUN_API_CALLS = {"material/add_material": 1, "media/uploadimg": 2, "draft/add": 1}
+# 当天接口调用超限
+DAILY_LIMIT_ERRCODE = 45009
+
+ACCOUNTS       = {}   # 账号名 → 配置
+_ACCOUNT_STATE = {}   # 账号名 → 进程内状态（token 缓存、并发信号量）；限速桶和每日计数在 STATE_DB 里
+_ACCOUNTS_LOCK = threading.Lock()
+_account = contextvars.ContextVar("account", default="")
+
+# errcode 表示 access_token 失效，丢掉缓存下次重新获取
+TOKEN_INVALID_ERRCODES = (40001, 40014, 42001)
+
+
+class QuotaExceeded(Exception):
+    """账号当天的草稿配额或某个微信接口的调用上限已用完"""
+
+
+def load_accounts(path: str = None) -> dict:
+    """
+    读取账号清单并替换 ACCOUNTS（可重复调用，已有账号的运行时状态保留）。
+    字段：name、app_id、app_secret（或 app_secret_env 指定环境变量名）、
+    daily_quota（每日草稿数，0 不限）、max_concurrency、rate_per_minute（每个接口每分钟调用数，0 不限）、
+    rate_limits / daily_limits（按接口覆盖全局限额，格式同 WECHAT_RATE_LIMITS 的字典形式）、topics。
+    """
+    path = path or ACCOUNTS_FILE
+    accounts = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            items = json.load(f).get("accounts", [])
+        for item in items:
+            secret = item.get("app_secret") or os.getenv(item.get("app_secret_env", ""), "")
+            if not item.get("name") or not item.get("app_id") or not secret:
+                raise ValueError(f"账号配置不完整（需要 name / app_id / app_secret）：{item.get('name')}")
+            accounts[item["name"]] = dict(item, app_secret=secret)
+    elif WECHAT_APP_ID and WECHAT_APP_SECRET:
+        accounts["default"] = {"name": "default", "app_id": WECHAT_APP_ID, "app_secret": WECHAT_APP_SECRET}
+
+    with _ACCOUNTS_LOCK:
+        ACCOUNTS.clear()
+        ACCOUNTS.update(accounts)
+        for name, acc in accounts.items():
+            state = _ACCOUNT_STATE.setdefault(name, {"token": None, "expires_at": 0.0, "token_lock": threading.Lock()})
+            limit = int(acc.get("max_concurrency") or ACCOUNT_MAX_CONCURRENCY)
+            if state.get("limit") != limit:
+                state["limit"], state["semaphore"] = limit, threading.BoundedSemaphore(limit)
+    return ACCOUNTS
+
+
+def get_account(name: str = None) -> dict:
+    """按名字取账号，不传则用当前上下文的账号（run() 里设置），再不行取第一个"""
+    if not ACCOUNTS:
+        load_accounts()
+    if not ACCOUNTS:
+        raise ValueError(f"没有可用的公众号账号：请配置 {ACCOUNTS_FILE} 或环境变量 WECHAT_APP_ID / WECHAT_APP_SECRET")
+    name = name or _account.get() or next(iter(ACCOUNTS))
+    if name not in ACCOUNTS:
+        raise ValueError(f"未知账号：{name}（已配置：{', '.join(ACCOUNTS)}）")
+    return ACCOUNTS[name]
+
+
+def _limit(account: str, endpoint: str, kind: str) -> float:
+    """
+    查限额（0 不限）：账号配置里的 rate_limits / daily_limits 优先，其次全局 WECHAT_RATE_LIMITS / WECHAT_DAILY_LIMITS；
+    先找具体接口，再找 "*"。账号的 rate_per_minute 相当于它的 rate_limits["*"]。
+    """
+    acc    = ACCOUNTS.get(account, {})
+    own    = dict(acc.get(kind) or {})
+    if kind == "rate_limits" and acc.get("rate_per_minute"):
+        own.setdefault("*", acc["rate_per_minute"])
+    shared = WECHAT_RATE_LIMITS if kind == "rate_limits" else WECHAT_DAILY_LIMITS
+    for table in (own, shared):
+        if endpoint in table:
+            return float(table[endpoint] or 0)
+    for table in (own, shared):
+        if "*" in table:
+            return float(table["*"] or 0)
+    return 0.0
+
+
+@contextmanager
+def _db_tx():
+    """写事务（BEGIN IMMEDIATE）：多个进程共用状态库时，读-改-写不会互相覆盖"""
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def _rate_acquire(account: str, endpoint: str):
+    """
+    接口级令牌桶（状态存在 STATE_DB，多个 worker 进程共享）：限额为 0 时不限速，
+    令牌不足就睡到下一个令牌产生再试——排队等，而不是让请求失败。
+    """
+    rate = _limit(account, endpoint, "rate_limits")
+    if not rate:
+        return
+    while True:
+        with _db_tx() as conn:
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE account = ? AND endpoint = ?",
+                               (account, endpoint)).fetchone()
+            now = time.time()
+            tokens = rate if row is None else min(rate, row["tokens"] + (now - row["updated"]) * rate / 60)
+            granted = tokens >= 1
+            conn.execute("INSERT OR REPLACE INTO rate_buckets (account, endpoint, tokens, updated) VALUES (?, ?, ?, ?)",
+                         (account, endpoint, tokens - 1 if granted else tokens, now))
+        if granted:
+            return
+        inc("wechat_rate_waits_total", account=account, endpoint=endpoint)
+        time.sleep((1 - tokens) * 60 / rate)
+
+
+def _bump_counter(conn, account: str, name: str, delta: int = 1):
+    conn.execute("""INSERT INTO daily_counters (day, account, name, count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (day, account, name) DO UPDATE SET count = MAX(0, count + excluded.count)""",
+                 (_today(), account, name, delta))
+
+
+def _counter(conn, account: str, name: str) -> int:
+    row = conn.execute("SELECT count FROM daily_counters WHERE day = ? AND account = ? AND name = ?",
+                       (_today(), account, name)).fetchone()
+    return row["count"] if row else 0
+
+
+def _count_call(account: str, endpoint: str):
+    """记一次接口调用；每日上限已用完时抛 QuotaExceeded（run() 会把文章放进延后队列）"""
+    limit = _limit(account, endpoint, "daily_limits")
+    with _db_tx() as conn:
+        if _counter(conn, account, f"blocked:{endpoint}") or (limit and _counter(conn, account, endpoint) >= limit):
+            inc("wechat_daily_limit_total", account=account, endpoint=endpoint)
+            raise QuotaExceeded(f"账号 {account} 今日 {endpoint} 调用已达上限")
+        _bump_counter(conn, account, endpoint)
+
+
+def api_calls_today(account: str = None) -> dict:
+    """当天各接口的调用数 {接口: 次数}（含 drafts 预占数和 blocked:* 标记）"""
+    account = account or get_account()["name"]
+    rows = _db().execute("SELECT name, count FROM daily_counters WHERE day = ? AND account = ?",
+                         (_today(), account)).fetchall()
+    return {r["name"]: r["count"] for r in rows}
+
+
+def _take_draft_quota(account: str):
+    """
+    开跑前预占一篇草稿配额，同时确认各接口当天还剩够一次运行的调用数（RUN_API_CALLS）；
+    不够就抛 QuotaExceeded，这时还没调 LLM，文章进延后队列，不会跑到一半才失败。
+    """
+    quota = int(ACCOUNTS[account].get("daily_quota") or 0)
+    with _db_tx() as conn:
+        if quota and _counter(conn, account, "drafts") >= quota:
+            inc("account_quota_exceeded_total", account=account)
+            raise QuotaExceeded(f"账号 {account} 今日草稿配额 {quota} 已用完")
+        for endpoint, need in RUN_API_CALLS.items():
+            limit = _limit(account, endpoint, "daily_limits")
+            if _counter(conn, account, f"blocked:{endpoint}") or (
+                    limit and _counter(conn, account, endpoint) + need > limit):
+                inc("wechat_daily_limit_total", account=account, endpoint=endpoint)
+                raise QuotaExceeded(f"账号 {account} 今日 {endpoint} 剩余调用不够跑一篇")
+        _bump_counter(conn, account, "drafts")
+
+
+def _release_draft_quota(account: str):
+    """没推成草稿（出错或被质量门槛拦下）时把预占的配额还回去"""
+    with _db_tx() as conn:
+        _bump_counter(conn, account, "drafts", -1)
+
+
+def defer_topic(topic: str, account: str, reason: str = ""):
+    """把因为配额 / 接口上限跑不了的主题放进延后队列（同账号同主题只排一次）"""
+    _db().execute("INSERT OR IGNORE INTO deferred_topics (ts, account, topic, reason) VALUES (?, ?, ?, ?)",
+                  (time.time(), account, topic, reason))
+    inc("pipeline_deferred_total", account=account)
+    print(f"⏳ 「{topic}」已放进 {account} 的延后队列：{reason}")
+
+
+def pop_deferred(account: str, limit: int = 1) -> list:
+    """按入队顺序取出账号最早延后的主题（取出即出队，再失败会重新入队）"""
+    with _db_tx() as conn:
+        rows = conn.execute("SELECT id, topic FROM deferred_topics WHERE account = ? ORDER BY id LIMIT ?",
+                            (account, limit)).fetchall()
+        conn.executemany("DELETE FROM deferred_topics WHERE id = ?", [(r["id"],) for r in rows])
+    return [r["topic"] for r in rows]
+
+
+def _invalidate_token(account: str):
+    state = _ACCOUNT_STATE.get(account)
+    if state:
+        with state["token_lock"]:
+            state["token"], state["expires_at"] = None, 0.0
 
 
 # ────────────────────────────────────────────────
 # 微信 API
 # ────────────────────────────────────────────────
 
-def get_access_token() -> str:
-    url    = "https://api.weixin.qq.com/cgi-bin/token"
-    params = {"grant_type": "client_credential", "appid": WECHAT_APP_ID, "secret": WECHAT_APP_SECRET}
-    data   = requests.get(url, params=params).json()
-    if "access_token" in data:
-        print("✅ access_token 获取成功")
-        return data["access_token"]
+def _wechat_call(endpoint: str, method: str = "POST", **kwargs) -> dict:
+    """
+    调用微信接口并记录指标：请求字节数、errcode、重试次数。
+    系统繁忙（errcode -1）和网络超时会按 WECHAT_MAX_RETRIES 退避重试，其余错误原样返回给调用方判断；
+    45009（当天超限）例外，直接抛 QuotaExceeded，让 run() 把文章放进延后队列。
+    """
+    url = f"{WECHAT_API_BASE}/cgi-bin/{endpoint}"
+    sent = len(kwargs.get("data") or b"") + sum(len(v[1]) for v in (kwargs.get("files") or {}).values())
+    account = _account.get() or get_account()["name"]
+    for attempt in range(WECHAT_MAX_RETRIES + 1):
+        if attempt:
+            inc("wechat_retries_total", endpoint=endpoint)
+            time.sleep(min(2 ** attempt * 0.5, 8))
+        _rate_acquire(account, endpoint)
+        _count_call(account, endpoint)
+        try:
+            data = requests.request(method, url, timeout=WECHAT_TIMEOUT, **kwargs).json()
+        except (requests.Timeout, requests.ConnectionError) as e:
+            inc("wechat_errcode_total", endpoint=endpoint, errcode="network")
+            log_event("wechat_error", endpoint=endpoint, attempt=attempt, error=str(e))
+            if attempt == WECHAT_MAX_RETRIES:
+                raise
+            continue
+        inc("wechat_requests_total", endpoint=endpoint, account=account)
+        if sent:
+            inc("wechat_upload_bytes_total", sent, endpoint=endpoint)
+        errcode = data.get("errcode", 0)
+        if errcode:
+            inc("wechat_errcode_total", endpoint=endpoint, errcode=errcode, account=account)
+            log_event("wechat_error", endpoint=endpoint, attempt=attempt, errcode=errcode, errmsg=data.get("errmsg"),
+                      account=account)
+            if errcode in TOKEN_INVALID_ERRCODES:
+                _invalidate_token(account)
+            elif errcode == DAILY_LIMIT_ERRCODE:
+                # 微信说今天超了：标记这个接口当天不可用，后面的文章直接进延后队列
+                with _db_tx() as conn:
+                    _bump_counter(conn, account, f"blocked:{endpoint}")
+                raise QuotaExceeded(f"账号 {account} 今日 {endpoint} 调用已达上限（微信返回 {errcode}）")
+        if errcode != -1 or attempt == WECHAT_MAX_RETRIES:
+            return data
+
+
+def get_access_token(account: str = None) -> str:
+    """
+    获取账号的 access_token（不传则用当前账号）。
+    按 expires_in（通常 7200 秒）缓存，提前 TOKEN_REFRESH_MARGIN 秒刷新；同一账号并发调用只请求一次。
+    """
+    acc   = get_account(account)
+    state = _ACCOUNT_STATE[acc["name"]]
+    with state["token_lock"]:
+        if state["token"] and time.time() < state["expires_at"]:
+            return state["token"]
+        params = {"grant_type": "client_credential", "appid": acc["app_id"], "secret": acc["app_secret"]}
+        token_ctx = contextvars.copy_context()
+        token_ctx.run(_account.set, acc["name"])
+        data = token_ctx.run(_wechat_call, "token", "GET", params=params)
+        if "access_token" in data:
+            state["token"]      = data["access_token"]
+            state["expires_at"] = time.time() + int(data.get("expires_in", 7200)) - TOKEN_REFRESH_MARGIN
+            print(f"✅ access_token 获取成功（{acc['name']}）")
+            return state["token"]
     raise Exception(f"获取 access_token 失败: {data}")
 
 
-def upload_image(access_token: str, image_path: str) -> str:
-    url  = f"https://api.weixin.qq.com/cgi-bin/material/add_material?access_token={access_token}&type=image"
-    with open(image_path, "rb") as f:
-        data = requests.post(url, files={"media": f}).json()
+def _read_image_source(image, filename: str = None) -> tuple:
+    """
+    图片来源统一成 (文件名, 字节)：支持文件路径、bytes 和可读的文件对象。
+    文件名扩展名按实际内容修正（encode_image 可能把 PNG 降级成 JPEG）。
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        name, data = filename or "image.png", bytes(image)
+    elif hasattr(image, "read"):
+        if hasattr(image, "seek"):
+            image.seek(0)
+        name = filename or os.path.basename(getattr(image, "name", "") or "") or "image.png"
+        data = image.read()
+    else:
+        with open(image, "rb") as f:
+            name, data = filename or os.path.basename(image), f.read()
+
+    stem, ext = os.path.splitext(name)
+    if data[:3] == b"\xff\xd8\xff" and ext.lower() not in (".jpg", ".jpeg"):
+        name = f"{stem}.jpg"
+    elif data[:8] == b"\x89PNG\r\n\x1a\n" and ext.lower() != ".png":
+        name = f"{stem}.png"
+    return name, data
+
+
+def upload_image(access_token: str, image, filename: str = None) -> str:
+    """上传永久图片素材；image 可以是文件路径、PNG/JPEG 字节或文件对象"""
+    name, payload = _read_image_source(image, filename)
+    data = _wechat_call("material/add_material", params={"access_token": access_token, "type": "image"},
+                        files={"media": (name, payload)})
     print(f"📤 上传图片返回: {data}")
     if "media_id" in data:
-        print(f"✅ 图片上传成功：{os.path.basename(image_path)}")
+        print(f"✅ 图片上传成功：{name}")
         return data["media_id"]
     raise Exception(f"上传图片失败: {data}")
 
 
+def delete_material(access_token: str, media_id: str) -> bool:
+    """删除永久素材，返回是否删掉；失败只告警（素材库多一张图不影响发文）"""
+    try:
+        data = _wechat_draft_call("material/del_material", access_token, {"media_id": media_id})
+    except Exception as e:
+        data = {"errmsg": str(e)}
+    if data.get("errcode", 0) == 0:
+        inc("material_deleted_total")
+        return True
+    print(f"⚠️  删除素材 {media_id} 失败：{data}")
+    return False
+
+
+# 正文图片走 media/uploadimg：返回可直接放进 <img src> 的 URL，不占永久素材库（订阅号上限 1000 个）。
+# 接口只收 1MB 以内的 JPG / PNG，超了先按这个预算重新编码。
+BODY_IMAGE_MAX_BYTES = 1024 * 1024
+
+
+def upload_body_image(access_token: str, image, filename: str = None) -> str:
+    """
+    上传正文图片，返回图片 URL；image 可以是文件路径、PNG/JPEG 字节或文件对象。
+    URL 按 (账号, 图片内容 sha256) 缓存在 STATE_DB 里，同一张图（比如数据没变的对比表）不重复上传。
+    """
+    name, payload = _read_image_source(image, filename)
+    if len(payload) > BODY_IMAGE_MAX_BYTES:
+        src = Image.open(io.BytesIO(payload))
+        try:
+            payload, ext = encode_image(src, max_bytes=BODY_IMAGE_MAX_BYTES)
+        finally:
+            src.close()
+        name = f"{os.path.splitext(name)[0]}.{ext}"
+
+    account = _account.get() or get_account()["name"]
+    digest  = hashlib.sha256(payload).hexdigest()
+    row = _db().execute("SELECT url FROM image_urls WHERE account = ? AND sha256 = ?", (account, digest)).fetchone()
+    if row:
+        inc("image_url_cache_hits_total")
+        print(f"♻️  复用已上传的正文图片：{name}")
+        return row["url"]
+
+    data = _wechat_call("media/uploadimg", params={"access_token": access_token}, files={"media": (name, payload)})
+    if "url" not in data:
+        raise Exception(f"上传正文图片失败: {data}")
+    _db().execute("INSERT OR REPLACE INTO image_urls (account, sha256, url, ts) VALUES (?, ?, ?, ?)",
+                  (account, digest, data["url"], time.time()))
+    print(f"✅ 正文图片上传成功：{name}")
+    return data["url"]
+
+
 def markdown_to_wechat_html(text: str) -> str:
     html = []
     for line in text.split("\n"):
@@ -335,96 +1678,430 @@ def clean_title(title):
         title = title.replace(char, '')
     return title.strip()
 
+# ── 草稿预检 ──
+# 推送前一次扫描完标题、摘要、作者、正文长度 / 字节数、图片引用和禁用标签：
+# 能规整的（转义、隐藏字符、超长截断）直接规整，规整不了的在本地就拒绝（InvalidDraft），
+# 不浪费一次往返和当天的接口额度。
+DRAFT_TITLE_MAX    = 32
+DRAFT_DIGEST_MAX   = 64
+DRAFT_AUTHOR_MAX   = 16
+DRAFT_CONTENT_MAX  = 20000            # 正文字符数（微信：少于 2 万字符）
+DRAFT_CONTENT_BYTES = 1024 * 1024     # 正文字节数（微信：小于 1M）
+WECHAT_AUTHOR      = os.getenv("WECHAT_AUTHOR", "")
+WECHAT_IMAGE_HOSTS = ("mmbiz.qpic.cn", "mmbiz.qlogo.cn")   # 正文图片只能引用微信自己的图床
+FORBIDDEN_TAGS     = {"script", "iframe", "frame", "object", "embed", "form", "input", "button",
+                      "textarea", "select", "style", "link", "meta", "base"}
+
+_UNICODE_ESCAPE = re.compile(r"\\u(d[89ab][0-9a-f]{2})\\u(d[c-f][0-9a-f]{2})|\\u([0-9a-f]{4})", re.I)
+_HTML_TAG       = re.compile(r"<\s*(/?)\s*([a-zA-Z][\w-]*)([^>]*)>")
+_ON_HANDLER     = re.compile(r"\son[a-z]+\s*=", re.I)
+_IMG_SRC        = re.compile(r"""\ssrc\s*=\s*["']?([^"'\s>]*)""", re.I)
+
+
+class InvalidDraft(Exception):
+    """草稿不符合微信的限制，problems 是所有问题的列表"""
+    def __init__(self, problems: list):
+        super().__init__("草稿预检不通过：" + "；".join(problems))
+        self.problems = problems
+
+
+def decode_unicode_escapes(text: str) -> str:
+    """
+    只把字面的 \\uXXXX（含代理对）还原成字符，其余反斜杠和非 ASCII 字符原样保留。
+    以前用 encode().decode('unicode-escape')，会把中文按 Latin-1 解码成乱码，也会吃掉正常的反斜杠。
+    """
+    if not text or "\\u" not in text:
+        return text or ""
+
+    def _sub(m):
+        if m.group(3):
+            code = int(m.group(3), 16)
+            return m.group(0) if 0xD800 <= code <= 0xDFFF else chr(code)   # 落单的代理项不还原
+        hi, lo = int(m.group(1), 16), int(m.group(2), 16)
+        return chr(0x10000 + ((hi - 0xD800) << 10) + (lo - 0xDC00))
+    return _UNICODE_ESCAPE.sub(_sub, text)
+
+
+def _extends_grapheme(ch: str, prev: str) -> bool:
+    """ch 是否和前一个字符属于同一个字形（组合符、变体选择符、肤色、ZWJ 序列、标签序列）"""
+    cp = ord(ch)
+    return (prev == "\u200d" or cp == 0x200D
+            or unicodedata.category(ch) in ("Mn", "Me", "Mc")
+            or 0xFE00 <= cp <= 0xFE0F or 0xE0100 <= cp <= 0xE01EF
+            or 0x1F3FB <= cp <= 0x1F3FF or 0xE0020 <= cp <= 0xE007F)
+
+
+def truncate_graphemes(text: str, limit: int) -> str:
+    """
+    截到 limit 个字符以内，只在字形边界截断：不会把 emoji、国旗、带声调的字母拆成半个。
+    （按码位计数，保证截完的 len() 一定不超过 limit）
+    """
+    if len(text) <= limit:
+        return text
+    cut, prev, regional = 0, "", 0
+    for i, ch in enumerate(text[:limit + 1]):
+        is_regional = 0x1F1E6 <= ord(ch) <= 0x1F1FF
+        if i and not _extends_grapheme(ch, prev) and not (is_regional and regional % 2):
+            cut = i                                   # i 之前都是完整字形
+        regional = regional + 1 if is_regional else 0  # 国旗是两个区域指示符一组
+        prev = ch
+    return text[:cut].rstrip()
+
+
+def validate_draft(title: str, content: str, digest: str = "", author: str = "",
+                   thumb_media_id: str = "") -> dict:
+    """
+    规整并校验一篇草稿，返回可以直接放进 draft/add 的字段 {title, digest, author, content}。
+    标题 / 摘要 / 作者超长按字形截断；标题为空、缺封面 thumb_media_id、正文为空或超长、引用了外部或空地址的图片、
+    含有 script / iframe 等禁用标签或 on* 事件属性时抛 InvalidDraft（一次列出全部问题）。
+    """
+    problems = []
+    title   = check_wechat_title(title)
+    digest  = check_wechat_digest(digest)
+    author  = truncate_graphemes(clean_title(author or ""), DRAFT_AUTHOR_MAX)
+    content = decode_unicode_escapes(content or "")
+    if not title:
+        problems.append("标题为空")
+    if not thumb_media_id:
+        problems.append("缺少封面 thumb_media_id")
+    if not content.strip():
+        problems.append("正文为空")
+    if len(content) > DRAFT_CONTENT_MAX:
+        problems.append(f"正文 {len(content)} 字符，超过 {DRAFT_CONTENT_MAX}")
+    size = len(content.encode("utf-8"))
+    if size > DRAFT_CONTENT_BYTES:
+        problems.append(f"正文 {size // 1024} KB，超过 {DRAFT_CONTENT_BYTES // 1024} KB")
+
+    for m in _HTML_TAG.finditer(content):
+        closing, tag, attrs = m.group(1), m.group(2).lower(), m.group(3)
+        if closing:
+            continue
+        if tag in FORBIDDEN_TAGS:
+            problems.append(f"正文含禁用标签 <{tag}>")
+        if _ON_HANDLER.search(attrs) or "javascript:" in attrs.lower():
+            problems.append(f"<{tag}> 含脚本属性")
+        if tag == "img":
+            src = _IMG_SRC.search(attrs)
+            host = re.sub(r"^(https?:)?//", "", src.group(1)).split("/")[0] if src else ""
+            if not host.endswith(WECHAT_IMAGE_HOSTS):
+                problems.append(f"图片地址不是微信图床：{src.group(1) if src and src.group(1) else '(空)'}")
+
+    if problems:
+        inc("draft_invalid_total")
+        raise InvalidDraft(list(dict.fromkeys(problems)))
+    return {"title": title, "digest": digest, "author": author, "content": content}
+
+
 def check_wechat_title(title):
     """限制标题在32字以内"""
-    if title is None:
-        return ""
-    if '\\u' in title:
-        title = title.encode('utf-8').decode('unicode-escape')
-    title = clean_title(title)
-    while len(title) > 32:
-        title = title[:-1]
-    return title
+    return truncate_graphemes(clean_title(decode_unicode_escapes(title or "")), DRAFT_TITLE_MAX)
+
 
 def check_wechat_digest(digest):
     """限制摘要在64字以内"""
-    if digest is None:
-        return ""
-    if '\\u' in digest:
-        digest = digest.encode('utf-8').decode('unicode-escape')
-    while len(digest) > 64:
-        digest = digest[:-1]
-    return digest
-
-def push_to_draft(access_token: str, title: str, content: str, thumb_media_id: str, digest: str = ""):
-    url = f"https://api.weixin.qq.com/cgi-bin/draft/add?access_token={access_token}"
-    title = check_wechat_title(title)
-    digest = check_wechat_digest(digest)
-    
-    # 检查并处理 Unicode 转义
-    if content and '\\u' in content:
-        print("⚠️ 检测到content中有Unicode转义！正在解码...")
-        content = content.encode('utf-8').decode('unicode-escape')
-    
-    # 检查并处理 Unicode 转义
-    if content and '\\u' in content:
-        content = content.encode('utf-8').decode('unicode-escape')
-    if digest and '\\u' in digest:
-        digest = digest.encode('utf-8').decode('unicode-escape')
-    if title and '\\u' in title:
-        title = title.encode('utf-8').decode('unicode-escape')
-    
-    # 发送 payload
-    payload = {"articles": [{"title": title, "digest": digest, "content": content,
-                              "thumb_media_id": thumb_media_id, "need_open_comment": 1}]}
-    # 使用 data 参数发送 UTF-8 编码的 JSON，避免乱码
-    json_str = json.dumps(payload, ensure_ascii=False)
-    data = requests.post(url, data=json_str.encode('utf-8'), headers={'Content-Type': 'application/json; charset=utf-8'}).json()
-    if "media_id" in data:
-        print("✅ 已推送草稿箱，请登录后台手动发布")
-        return data["media_id"]
-    raise Exception(f"推送草稿失败: {data}")
+    return truncate_graphemes(decode_unicode_escapes(digest or "").strip(), DRAFT_DIGEST_MAX)
 
 
-# ────────────────────────────────────────────────
-# AI 生成文章
-# ────────────────────────────────────────────────
+def draft_record(key: str, account: str = None):
+    """当前账号用 key 推过的草稿（media_id / content_hash / thumb_media_id / cover_sha），没有返回 None"""
+    if not key:
+        return None
+    return _db().execute(
+        "SELECT media_id, content_hash, thumb_media_id, cover_sha FROM drafts WHERE account = ? AND key = ?",
+        (account or _account.get() or get_account()["name"], key)).fetchone()
 
-def generate_article(topic: str) -> dict:
-    client, model = get_ai_client()
-    print(f"🤖 正在生成文章（{ACTIVE_MODEL}/{model}）：{topic}")
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user",   "content": f"请写一篇关于「{topic}」的公众号文章，严格按照输出格式"},
-        ],
-        temperature=0.8,
-    )
-    raw = resp.choices[0].message.content.strip()
-    
+
+def _drop_replaced_cover(access_token: str, account: str, media_id: str):
+    """草稿换了封面：旧封面素材没有别的草稿在用就删掉，同时从封面缓存里拿掉"""
+    if _db().execute("SELECT 1 FROM drafts WHERE account = ? AND thumb_media_id = ?",
+                     (account, media_id)).fetchone():
+        return
+    with _COVER_LOCK:
+        for k in [k for k, v in _COVER_CACHE.items() if v[0] == media_id]:
+            del _COVER_CACHE[k]
+    delete_material(access_token, media_id)
+
+
+def push_to_draft(access_token: str, title: str, content: str, thumb_media_id: str, digest: str = "",
+                  key: str = None, author: str = None, cover_sha: str = None):
+    """
+    推草稿箱，返回草稿 media_id。推送前先过 validate_draft，不合格直接抛 InvalidDraft，不调接口。
+    传 key（run() 里用主题）时是幂等的：同一账号同一个 key 推过就改用 draft/update 更新原草稿，
+    内容哈希没变则直接跳过；原草稿在后台被删了（更新失败）再新建。不传 key 每次都新建。
+    内容哈希按封面图片哈希 cover_sha 算（不传时用 thumb_media_id），重新上传同一张封面不算内容变化；
+    换了封面后，被替换的旧封面素材会删掉。
+    """
+    fields = validate_draft(title, content, digest, WECHAT_AUTHOR if author is None else author, thumb_media_id)
+    news = {"title": fields["title"], "digest": fields["digest"], "content": fields["content"],
+            "thumb_media_id": thumb_media_id, "need_open_comment": 1}
+    if fields["author"]:
+        news["author"] = fields["author"]
+    hashed = dict(news, thumb_media_id=cover_sha or thumb_media_id)
+    content_hash = hashlib.sha256(json.dumps(hashed, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+    account = _account.get() or get_account()["name"]
+    prev = draft_record(key, account)
+
+    if prev and prev["content_hash"] == content_hash:
+        inc("draft_pushes_total", action="skipped")
+        print("♻️  草稿内容没有变化，跳过推送")
+        return prev["media_id"]
+
+    media_id = None
+    if prev:
+        data = _wechat_draft_call("draft/update", access_token,
+                                  {"media_id": prev["media_id"], "index": 0, "articles": news})
+        if data.get("errcode", 0) == 0:
+            media_id = prev["media_id"]
+            inc("draft_pushes_total", action="updated")
+            print("✅ 已更新草稿箱里的原草稿，请登录后台手动发布")
+        else:
+            print(f"⚠️  更新原草稿失败（{data.get('errcode')}），改为新建")
+
+    if media_id is None:
+        data = _wechat_draft_call("draft/add", access_token, {"articles": [news]})
+        if "media_id" not in data:
+            raise Exception(f"推送草稿失败: {data}")
+        media_id = data["media_id"]
+        inc("draft_pushes_total", action="added")
+        print("✅ 已推送草稿箱，请登录后台手动发布")
+
+    if key:
+        _db().execute("""INSERT INTO drafts (account, key, media_id, content_hash, ts, thumb_media_id, cover_sha)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (account, key) DO UPDATE SET
+                             media_id = excluded.media_id, content_hash = excluded.content_hash, ts = excluded.ts,
+                             thumb_media_id = excluded.thumb_media_id, cover_sha = excluded.cover_sha""",
+                      (account, key, media_id, content_hash, time.time(), thumb_media_id, cover_sha))
+        if prev and prev["thumb_media_id"] and prev["thumb_media_id"] != thumb_media_id:
+            _drop_replaced_cover(access_token, account, prev["thumb_media_id"])
+    return media_id
+
+
+def _wechat_draft_call(endpoint: str, access_token: str, payload: dict) -> dict:
+    # 使用 data 参数发送 UTF-8 编码的 JSON，避免乱码
+    json_str = json.dumps(payload, ensure_ascii=False)
+    return _wechat_call(endpoint, params={"access_token": access_token}, data=json_str.encode('utf-8'),
+                        headers={'Content-Type': 'application/json; charset=utf-8'})
+
+
+# ────────────────────────────────────────────────
+# AI 生成文章
+# ────────────────────────────────────────────────
+
+# 结构化输出的 JSON Schema（json_schema 模式下按 strict 要求写全 required / additionalProperties）
+ARTICLE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title":              {"type": "string"},
+        "hook":               {"type": "string"},
+        "digest":             {"type": "string"},
+        "body":               {"type": "string", "description": "markdown 正文"},
+        "cta":                {"type": "string"},
+        "image_requirements": {"type": "string", "description": "配图需求，每行一条"},
+    },
+    "required": ["title", "hook", "digest", "body", "cta", "image_requirements"],
+    "additionalProperties": False,
+}
+
+EVAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title_score":   {"type": "integer"},
+        "hook_score":    {"type": "integer"},
+        "body_score":    {"type": "integer"},
+        "lang_score":    {"type": "integer"},
+        "closing_score": {"type": "integer"},
+        "total_score":   {"type": "integer"},
+        "conclusion":    {"type": "string"},
+        "issues":        {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["title_score", "hook_score", "body_score", "lang_score",
+                 "closing_score", "total_score", "conclusion", "issues"],
+    "additionalProperties": False,
+}
+
+ARTICLE_JSON_HINT = """
+只输出一个 JSON 对象，字段：title（标题）、hook（开头引言钩子）、digest（摘要）、body（markdown 正文）、
+cta（结尾问句互动钩子）、image_requirements（配图需求，每行一条）。"""
+
+EVAL_JSON_HINT = """只输出一个 JSON 对象，字段：title_score、hook_score、body_score、lang_score、closing_score、
+total_score（整数），conclusion（可以直接发/小改再发/需要大改/建议重写），issues（主要问题列表）。"""
+
+
+def _parse_json_object(raw: str) -> dict:
+    """从模型输出里取出第一个 JSON 对象（兼容 ```json 代码块和前后多余文字）"""
+    raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw.strip())
+    start, end = raw.find("{"), raw.rfind("}")
+    if start < 0 or end <= start:
+        raise ValueError("输出里没有 JSON 对象")
+    return json.loads(raw[start:end+1])
+
+
+def _json_mode(provider: str = None) -> str:
+    return MODELS.get(provider or ACTIVE_MODEL, {}).get("json_mode")
+
+
+def _response_format(name: str, schema: dict, provider: str = None) -> dict:
+    """按服务商能力返回 response_format 参数，不支持时返回 {}"""
+    mode = _json_mode(provider)
+    if mode == "json_schema":
+        return {"response_format": {"type": "json_schema",
+                                    "json_schema": {"name": name, "schema": schema, "strict": True}}}
+    if mode == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+
+def _check_json(data: dict, schema: dict) -> dict:
+    missing = [k for k in schema["required"] if k not in data]
+    if missing:
+        raise ValueError(f"缺少字段：{', '.join(missing)}")
+    return data
+
+
+def _repair_json(raw: str, schema: dict, call: str) -> dict:
+    """
+    解析失败时的补救：把原始输出交给模型整理成符合 schema 的 JSON（温度 0 的小调用），
+    比重新生成整篇便宜得多。仍不合格则抛 ValueError。
+    """
+    inc("llm_repairs_total", call=call)
+    print(f"🔧 {call} 输出格式不对，正在修复（{ACTIVE_MODEL}/{REPAIR_MODEL or MODELS[ACTIVE_MODEL]['model']}）")
+    resp = _chat(
+        f"{call}_repair",
+        [{"role": "user", "content":
+          "把下面的模型输出整理成 JSON，内容保持原样，不要改写。字段和类型严格按这个 JSON Schema：\n"
+          f"{json.dumps(schema, ensure_ascii=False)}\n只输出 JSON 对象。\n\n--- 原始输出 ---\n{raw}"}],
+        temperature=0, model=REPAIR_MODEL or None, schema=(f"{call}_repair", schema),
+    )
+    return _check_json(_parse_json_object(resp.choices[0].message.content), schema)
+
+
+def _parse_article_text(raw: str) -> dict:
     def extract(tag, text):
         m = re.search(rf"【{tag}】\s*\n(.*?)(?=\n【|\Z)", text, re.DOTALL)
         return m.group(1).strip() if m else ""
 
-    title  = extract("标题", raw)
-    hook   = extract("开头引言钩子", raw)
-    digest = extract("摘要", raw)
-    body   = extract("正文", raw)
-    cta    = extract("结尾问句互动钩子", raw)
-    
-    # 检查并解码 Unicode 转义
-    if title and '\\u' in title:
-        title = title.encode('utf-8').decode('unicode-escape')
-    if digest and '\\u' in digest:
-        digest = digest.encode('utf-8').decode('unicode-escape')
-    if body and '\\u' in body:
-        body = body.encode('utf-8').decode('unicode-escape')
-    
+    article = dict(title=extract("标题", raw), hook=extract("开头引言钩子", raw), digest=extract("摘要", raw),
+                   body=extract("正文", raw), cta=extract("结尾问句互动钩子", raw),
+                   image_requirements=extract("配图需求", raw))
+    if not article["title"] or not article["body"]:
+        raise ValueError("缺少【标题】或【正文】")
+    return article
+
+
+def _parse_article(raw: str, structured: bool) -> dict:
+    """结构化模式解析 JSON，否则解析【】分段文本；失败时走 _repair_json"""
+    try:
+        if structured:
+            data = _check_json(_parse_json_object(raw), ARTICLE_SCHEMA)
+        else:
+            return _parse_article_text(raw)
+    except ValueError as e:
+        print(f"⚠️  文章解析失败：{e}")
+        data = _repair_json(raw, ARTICLE_SCHEMA, "generate")
+    return {k: str(data.get(k) or "").strip() for k in ARTICLE_SCHEMA["required"]}
+
+
+def generate_article(topic: str) -> dict:
+    structured = STRUCTURED_OUTPUT and _json_mode() is not None
+    print(f"🤖 正在生成文章（{ACTIVE_MODEL}/{MODELS[ACTIVE_MODEL]['model']}{'，JSON 输出' if structured else ''}）：{topic}")
+    # 固定内容（skill + 输出格式）全放在 system 里做前缀，user 里只有主题
+    system = system_prompt() + (ARTICLE_JSON_HINT if structured else "")
+    resp = _chat(
+        "generate",
+        [
+            {"role": "system", "content": system},
+            {"role": "user",   "content": f"请写一篇关于「{topic}」的公众号文章，严格按照输出格式"},
+        ],
+        temperature=0.8,
+        schema=("article", ARTICLE_SCHEMA) if structured else None,
+    )
+    raw = resp.choices[0].message.content.strip()
+
+    try:
+        article = _parse_article(raw, structured)
+    except ValueError as e:
+        raise Exception(f"文章解析失败（修复后仍不合格）：{e}")
+    return _finish_article(article)
+
+
+def _finish_article(article: dict) -> dict:
+    """解析后的统一收尾：解码残留的 Unicode 转义、生成封面副标题"""
+    title, digest, body = (decode_unicode_escapes(article[k]) for k in ("title", "digest", "body"))
+
     cover_sub = digest[:20]+"..." if len(digest) > 20 else digest
 
     print(f"✅ 文章生成完成：{title}")
-    return dict(title=title, hook=hook, digest=digest, body=body, cta=cta, cover_subtitle=cover_sub)
+    return dict(article, title=title, digest=digest, body=body, cover_subtitle=cover_sub)
+
+
+def _parse_eval_text(raw: str) -> dict:
+    def parse_score(label, text):
+        m = re.search(rf"{label}得分[：:]\s*(\d+)", text)
+        return int(m.group(1)) if m else None
+
+    def parse_field(label, text):
+        m = re.search(rf"{label}[：:]\s*(.+)", text)
+        return m.group(1).strip() if m else ""
+
+    result = {
+        "title_score":    parse_score("标题", raw),
+        "hook_score":     parse_score("开头", raw),
+        "body_score":     parse_score("正文", raw),
+        "lang_score":     parse_score("语言", raw),
+        "closing_score":  parse_score("结尾", raw),
+        "total_score":    parse_score("综合", raw),
+        "conclusion":     parse_field("结论", raw),
+        "issues":         re.findall(r"^-\s+(.+)$", raw, re.MULTILINE),
+    }
+    missing = [k for k, v in result.items() if v is None]
+    if missing:
+        # 以前缺失的分数会静默变成 0，这里交给上层修复
+        raise ValueError(f"缺少分数：{', '.join(missing)}", result)
+    return result
+
+
+def _score(value) -> int:
+    """分数字段取开头的数字：模型常给 18.5、"18/20"、"18分" 这类写法，小数截掉；取不出数字按 0 计"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    m = re.match(r"\s*(\d+(?:\.\d+)?)", str(value or ""))
+    return int(float(m.group(1))) if m else 0
+
+
+def _parse_eval(raw: str, structured: bool) -> dict:
+    try:
+        if structured:
+            data = _check_json(_parse_json_object(raw), EVAL_SCHEMA)
+        else:
+            return _parse_eval_text(raw)
+    except ValueError as e:
+        print(f"⚠️  评分解析失败：{e.args[0]}")
+        try:
+            data = _repair_json(raw, EVAL_SCHEMA, "evaluate")
+        except ValueError as e2:
+            # 修复也失败：保留能解析出来的部分，缺失的分数按 0 计（等同旧行为）
+            inc("llm_repair_failures_total", call="evaluate")
+            print(f"⚠️  评分修复失败：{e2}")
+            data = e.args[1] if len(e.args) > 1 and isinstance(e.args[1], dict) else {}
+    result = {k: _score(data.get(k)) for k in EVAL_SCHEMA["required"] if k.endswith("_score")}
+    result["conclusion"] = str(data.get("conclusion") or "")
+    result["issues"]     = [str(i) for i in data.get("issues") or []]
+    return result
+
+
+EVAL_TEXT_FORMAT = """标题得分: XX/20
+开头得分: XX/20
+正文得分: XX/30
+语言得分: XX/20
+结尾得分: XX/10
+综合得分: XX/100
+结论: [可以直接发/小改再发/需要大改/建议重写]
+主要问题:
+- 问题1
+- 问题2
+- 问题3
+"""
 
 
 def evaluate_article(article: dict) -> dict:
@@ -432,15 +2109,15 @@ def evaluate_article(article: dict) -> dict:
     使用 SKILL_eval.md 规则对文章打分。
     调用 AI 模型进行评估，返回结构化评分数据。
     """
-    eval_skill_path = os.path.join(os.path.dirname(__file__), "SKILL_eval.md")
-    if not os.path.exists(eval_skill_path):
+    eval_skill = load_skill(SKILL_EVAL_PATH)
+    if eval_skill is None:
         print("⚠️  找不到 SKILL_eval.md，跳过评估")
         return {}
 
-    with open(eval_skill_path, encoding="utf-8") as f:
-        eval_skill = f.read()
-
-    content = f"""请评估以下公众号文章，严格按照评分框架输出结构化结果。
+    structured = STRUCTURED_OUTPUT and _json_mode() is not None
+    output_format = EVAL_JSON_HINT if structured else "请按以下格式输出（只输出这个格式，不要多余说明）：\n" + EVAL_TEXT_FORMAT
+    # 评分框架 + 输出格式固定不变，放在 system 前缀里；user 里只有这篇文章
+    content = f"""请评估以下公众号文章，严格按照评分框架和输出格式输出结构化结果。
 
 标题：{article['title']}
 
@@ -452,54 +2129,26 @@ def evaluate_article(article: dict) -> dict:
 {article['body']}
 
 结尾互动钩子：{article['cta']}
-
-请按以下格式输出（只输出这个格式，不要多余说明）：
-标题得分: XX/20
-开头得分: XX/20
-正文得分: XX/30
-语言得分: XX/20
-结尾得分: XX/10
-综合得分: XX/100
-结论: [可以直接发/小改再发/需要大改/建议重写]
-主要问题:
-- 问题1
-- 问题2
-- 问题3
 """
 
-    client, model = get_ai_client()
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": eval_skill},
+    resp = _chat(
+        "evaluate",
+        [
+            {"role": "system", "content": f"{eval_skill}\n\n{output_format}"},
             {"role": "user",   "content": content},
         ],
         temperature=0.3,
+        schema=("evaluation", EVAL_SCHEMA) if structured else None,
     )
     raw = resp.choices[0].message.content.strip()
 
-    def parse_score(label, text):
-        m = re.search(rf"{label}得分[：:]\s*(\d+)", text)
-        return int(m.group(1)) if m else 0
-
-    def parse_field(label, text):
-        m = re.search(rf"{label}[：:]\s*(.+)", text)
-        return m.group(1).strip() if m else ""
+    result = _parse_eval(raw, structured)
+    result["raw"] = raw
+    _print_eval_report(result)
+    return result
 
-    issues = re.findall(r"^-\s+(.+)$", raw, re.MULTILINE)
-
-    result = {
-        "title_score":    parse_score("标题", raw),
-        "hook_score":     parse_score("开头", raw),
-        "body_score":     parse_score("正文", raw),
-        "lang_score":     parse_score("语言", raw),
-        "closing_score":  parse_score("结尾", raw),
-        "total_score":    parse_score("综合", raw),
-        "conclusion":     parse_field("结论", raw),
-        "issues":         issues,
-        "raw":            raw,
-    }
 
+def _print_eval_report(result: dict):
     bar = "█" * (result["total_score"] // 5) + "░" * (20 - result["total_score"] // 5)
     print(f"""
 ╔══════════════════════════════════════╗
@@ -516,64 +2165,907 @@ def evaluate_article(article: dict) -> dict:
         print(f"║  ⚠ {issue:<35}║")
     print("╚══════════════════════════════════════╝")
 
-    return result
+
+# ── 单次调用模式：生成 + 自评 ──
+# ARTICLE_MODE=single 时一次调用同时产出文章和按 SKILL_eval.md 的自评，省掉评估那一轮往返
+# 和重复发送整篇文章的输入 token；自评没有独立评审严格，质量要求高的场景保留默认的 two-call。
+
+SELF_EVAL_HINT = f"""
+
+写完文章后，按上面的评分框架给这篇文章自评，追加在最后（评分要严格，不要手下留情）：
+【自评】
+{EVAL_TEXT_FORMAT}"""
+
+COMBINED_SCHEMA = {
+    "type": "object",
+    "properties": {**ARTICLE_SCHEMA["properties"], "evaluation": EVAL_SCHEMA},
+    "required": ARTICLE_SCHEMA["required"] + ["evaluation"],
+    "additionalProperties": False,
+}
+
+COMBINED_JSON_HINT = ARTICLE_JSON_HINT + """
+另加 evaluation 字段：按上面的评分框架给这篇文章严格自评，字段同评估输出（各项得分、conclusion、issues）。"""
+
+
+def generate_and_evaluate(topic: str) -> tuple:
+    """
+    一次调用生成文章并自评，返回 (article, eval_result)，结构与 generate_article / evaluate_article 相同。
+    找不到 SKILL_eval.md 时退回只生成文章，eval_result 为 {}。
+    """
+    eval_skill = load_skill(SKILL_EVAL_PATH)
+    if eval_skill is None:
+        print("⚠️  找不到 SKILL_eval.md，单次调用模式退回只生成文章")
+        return generate_article(topic), {}
+
+    structured = STRUCTURED_OUTPUT and _json_mode() is not None
+    print(f"🤖 正在生成文章并自评（{ACTIVE_MODEL}/{MODELS[ACTIVE_MODEL]['model']}"
+          f"{'，JSON 输出' if structured else ''}）：{topic}")
+    system = (f"{system_prompt()}\n\n# 自评用的评分框架\n{eval_skill}"
+              + (COMBINED_JSON_HINT if structured else SELF_EVAL_HINT))
+    resp = _chat(
+        "generate_eval",
+        [
+            {"role": "system", "content": system},
+            {"role": "user",   "content": f"请写一篇关于「{topic}」的公众号文章，严格按照输出格式，最后附上自评"},
+        ],
+        temperature=0.8,
+        schema=("article_with_eval", COMBINED_SCHEMA) if structured else None,
+    )
+    raw = resp.choices[0].message.content.strip()
+
+    try:
+        if structured:
+            try:
+                data = _check_json(_parse_json_object(raw), COMBINED_SCHEMA)
+            except ValueError as e:
+                print(f"⚠️  文章解析失败：{e}")
+                data = _repair_json(raw, COMBINED_SCHEMA, "generate_eval")
+            eval_raw = json.dumps(data["evaluation"], ensure_ascii=False) if data.get("evaluation") else ""
+            article  = _parse_article(json.dumps(data, ensure_ascii=False), structured=True)
+        else:
+            m = re.search(r"【自评】\s*\n(.*)", raw, re.DOTALL)
+            eval_raw = m.group(1).strip() if m else ""
+            article  = _parse_article(raw, structured=False)
+    except ValueError as e:
+        raise Exception(f"文章解析失败（修复后仍不合格）：{e}")
+
+    article = _finish_article(article)
+    if not eval_raw:
+        # 模型漏了自评（没有【自评】段 / evaluation 字段）：不拿空文本去解析，单独评估一次
+        inc("self_eval_missing_total")
+        print("⚠️  输出里没有自评，改为单独调用评估")
+        return article, evaluate_article(article)
+
+    evaluation = _parse_eval(eval_raw, structured)
+    evaluation["raw"]  = eval_raw
+    evaluation["mode"] = "self"
+    _print_eval_report(evaluation)
+    return article, evaluation
+
+
+# ────────────────────────────────────────────────
+# 自动配图：【配图需求】→ 图表数据
+# ────────────────────────────────────────────────
+
+CHART_PROMPT = """下面是一篇公众号文章的配图需求和正文。请根据配图需求，从正文里整理出可以直接画图的图表数据。
+只输出一个 JSON 对象，不要任何解释，不要 markdown 代码块。格式：
+{{
+  "comparison": {{"title": "对比表标题", "headers": ["对比项", "方案A", "方案B"], "rows": [["维度1", "值", "值"]], "note": "一句话结论"}},
+  "workflow": {{"title": "流程图标题", "subtitle": "一句话副标题", "steps": [{{"title": "步骤名（6字内）", "desc": "说明（12字内）"}}]}}
+}}
+要求：
+- 配图需求里没有对比表就把 comparison 设为 null，没有流程图就把 workflow 设为 null
+- 表格 3~8 行、2~5 列，每行的单元格数和 headers 一致；流程 2~8 步
+- 数据必须来自正文，不要编造
+
+【配图需求】
+{images}
+
+【正文】
+{body}
+"""
+
+CHART_KEYWORDS = ("对比", "表", "流程", "步骤", "工作流")
+
+
+def parse_chart_specs(raw: str) -> dict:
+    """
+    校验并整理图表 JSON，返回 {"comparison": {...}, "workflow": {...}}，不合格的图表直接丢弃。
+    comparison 可直接作为 run() 的 comparison_data；workflow["steps"] 已转成 render_workflow 的三元组。
+    """
+    data  = _parse_json_object(raw)
+    specs = {}
+
+    comp = data.get("comparison")
+    if isinstance(comp, dict):
+        headers = [str(h) for h in comp.get("headers") or []]
+        rows    = [[str(c) for c in r] for r in comp.get("rows") or [] if isinstance(r, list)]
+        rows    = [r for r in rows if len(r) == len(headers)]
+        if len(headers) >= 2 and rows:
+            specs["comparison"] = {"title": str(comp.get("title") or "对比"), "headers": headers,
+                                   "rows": rows[:12], "note": str(comp.get("note") or "")}
+
+    flow = data.get("workflow")
+    if isinstance(flow, dict):
+        steps = [("", str(st.get("title", "")), str(st.get("desc", "")))
+                 for st in flow.get("steps") or [] if isinstance(st, dict) and st.get("title")]
+        if len(steps) >= 2:
+            specs["workflow"] = {"title": str(flow.get("title") or "工作流程"),
+                                 "subtitle": str(flow.get("subtitle") or ""), "steps": steps[:12]}
+    return specs
+
+
+def extract_chart_specs(article: dict) -> dict:
+    """
+    把文章的【配图需求】转成图表数据（一次低温度的小调用，可用 CHART_MODEL 换便宜模型）。
+    没有配图需求、需求里不涉及图表、或模型输出不合格时返回 {}，不影响主流程。
+    """
+    images = article.get("image_requirements", "")
+    if not images or not any(k in images for k in CHART_KEYWORDS):
+        return {}
+
+    print(f"📐 正在提取配图数据（{ACTIVE_MODEL}/{CHART_MODEL or MODELS[ACTIVE_MODEL]['model']}）")
+    resp = _chat(
+        "charts",
+        [{"role": "user", "content": CHART_PROMPT.format(images=images, body=article["body"][:6000])}],
+        temperature=0.2, model=CHART_MODEL or None,
+    )
+    try:
+        specs = parse_chart_specs(resp.choices[0].message.content)
+    except ValueError as e:   # json.JSONDecodeError 也是 ValueError
+        inc("chart_extract_failures_total")
+        print(f"⚠️  配图数据解析失败，跳过自动配图：{e}")
+        return {}
+    print(f"✅ 配图数据：{'、'.join(specs) or '无'}")
+    return specs
+
+
+# ────────────────────────────────────────────────
+# 主题去重（MinHash + LSH）
+# ────────────────────────────────────────────────
+
+# 每篇推进草稿箱的文章，把主题、标题、摘要各算一个 MinHash 签名（字符 2-gram），按 LSH 分桶存进 STATE_DB。
+# 新主题开跑前先查：只比对同桶候选（按撞桶次数取前 LSH_MAX_CANDIDATES 个），几万篇历史也是亚毫秒级，不用逐篇比较。
+# TOPIC_DEDUP：warn 只提示（默认），reject 直接拒绝（DuplicateTopic），off 不检查。
+TOPIC_DEDUP           = os.getenv("TOPIC_DEDUP", "warn")
+TOPIC_DEDUP_THRESHOLD = float(os.getenv("TOPIC_DEDUP_THRESHOLD", "0.7"))   # 估算的 Jaccard 相似度
+
+MINHASH_PERM  = 64
+LSH_BANDS     = 16                        # 16 段 × 4 行：相似度约 0.5 以上基本都能进同一个桶
+LSH_ROWS      = MINHASH_PERM // LSH_BANDS
+LSH_MAX_CANDIDATES = 16                   # 撞桶越多越像，只精算前几个
+_MINHASH_P    = (1 << 31) - 1
+_MINHASH_SEED = random.Random(20240601)
+_MINHASH_AB   = [(_MINHASH_SEED.randrange(1, _MINHASH_P), _MINHASH_SEED.randrange(0, _MINHASH_P))
+                 for _ in range(MINHASH_PERM)]
+
+
+class DuplicateTopic(Exception):
+    """主题和已发文章太像（TOPIC_DEDUP=reject 时抛出）"""
+
+
+def _shingles(text: str) -> set:
+    """只保留中文、字母、数字并转小写，切成字符 2-gram（太短就整体当一个）"""
+    text = re.sub(r"[^\w]|_", "", text or "").lower()
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i+2] for i in range(len(text) - 1)}
+
+
+def topic_signature(text: str) -> list:
+    """文本的 MinHash 签名（MINHASH_PERM 个 31 位整数）；空文本返回空列表"""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "little")
+              for s in _shingles(text)]
+    if not hashes:
+        return []
+    return [min([(a * h + b) % _MINHASH_P for h in hashes]) for a, b in _MINHASH_AB]
+
+
+def _lsh_buckets(sig: list) -> list:
+    """每段签名压成一个 64 位桶号，返回 [(段号, 桶号), ...]"""
+    out = []
+    for band in range(LSH_BANDS):
+        chunk = ",".join(map(str, sig[band*LSH_ROWS:(band+1)*LSH_ROWS])).encode()
+        out.append((band, int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "little", signed=True)))
+    return out
+
+
+def _sig_similarity(a: list, b) -> float:
+    return sum(x == y for x, y in zip(a, b)) / MINHASH_PERM
+
+
+def _pack_sig(sig: list) -> bytes:
+    return array("I", sig).tobytes()
+
+
+def _unpack_sig(blob: bytes) -> array:
+    sig = array("I")
+    sig.frombytes(blob)
+    return sig
+
+
+def index_article(topic: str, article: dict, account: str = ""):
+    """把已推草稿的文章（主题 / 标题 / 摘要）加入去重索引"""
+    rows = [("topic", topic), ("title", article.get("title", "")), ("digest", article.get("digest", ""))]
+    with _db_tx() as conn:
+        for kind, text in rows:
+            sig = topic_signature(text)
+            if not sig:
+                continue
+            cur = conn.execute(
+                "INSERT INTO topic_index (ts, account, topic, title, kind, text, sig) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), account, topic, article.get("title", ""), kind, text, _pack_sig(sig)))
+            conn.executemany("INSERT INTO topic_lsh (band, bucket, entry_id) VALUES (?, ?, ?)",
+                             [(band, bucket, cur.lastrowid) for band, bucket in _lsh_buckets(sig)])
+
+
+def find_similar_topic(topic: str, threshold: float = None) -> dict:
+    """
+    在去重索引里找和 topic 最像的历史条目：相似度 ≥ threshold（默认 TOPIC_DEDUP_THRESHOLD）时
+    返回 {"similarity", "kind", "text", "topic", "title", "ts"}，否则返回 None。
+    """
+    threshold = TOPIC_DEDUP_THRESHOLD if threshold is None else threshold
+    sig = topic_signature(topic)
+    if not sig:
+        return None
+    buckets = _lsh_buckets(sig)
+    where   = " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets))
+    rows = _db().execute(
+        f"""SELECT t.* FROM (SELECT entry_id, COUNT(*) AS hits FROM topic_lsh WHERE {where}
+                             GROUP BY entry_id ORDER BY hits DESC LIMIT ?) AS c
+            JOIN topic_index t ON t.id = c.entry_id""",
+        [v for pair in buckets for v in pair] + [LSH_MAX_CANDIDATES]).fetchall()
+    best = None
+    for row in rows:
+        sim = _sig_similarity(sig, _unpack_sig(row["sig"]))
+        if sim >= threshold and (best is None or sim > best["similarity"]):
+            best = {"similarity": round(sim, 3), "kind": row["kind"], "text": row["text"],
+                    "topic": row["topic"], "title": row["title"], "ts": row["ts"]}
+    return best
+
+
+def check_topic(topic: str):
+    """
+    开跑前的去重检查：按 TOPIC_DEDUP 提示或拒绝（抛 DuplicateTopic）。
+    当前账号用同一个主题推过草稿的不算重复——这是重跑，push_to_draft 会更新原草稿。
+    """
+    if TOPIC_DEDUP == "off":
+        return
+    match = find_similar_topic(topic)
+    if not match:
+        return
+    if match["topic"] == topic and draft_record(topic):
+        print("🔁 同一主题重跑，将更新原草稿")
+        return
+    inc("topic_duplicates_total", action=TOPIC_DEDUP)
+    log_event("topic_duplicate", topic=topic, similar_to=match["topic"], kind=match["kind"],
+              similarity=match["similarity"])
+    msg = f"主题「{topic}」和已发文章「{match['title']}」相似（{match['kind']} 相似度 {match['similarity']:.0%}）"
+    if TOPIC_DEDUP == "reject":
+        raise DuplicateTopic(msg)
+    print(f"⚠️  {msg}")
+
+
+# ────────────────────────────────────────────────
+# 文章归档与全文检索
+# ────────────────────────────────────────────────
+
+# 每次运行生成的文章、评估结果、图片哈希和 media_id / URL 都存进 STATE_DB 的 articles 表，
+# 标题和正文建 FTS5 全文索引（trigram 分词，中文不用额外分词器）。
+# 状态：drafted 已推草稿箱 / rejected 被质量门槛拦下 / failed 中途出错。
+ARCHIVE_FIELDS = ("id", "ts", "run_id", "account", "topic", "title", "digest", "total_score", "status", "draft_id")
+
+
+def archive_article(topic: str, article: dict, eval_result: dict, status: str,
+                    draft_id: str = None, images: list = None, error: str = None) -> int:
+    """归档一篇文章，返回归档 ID；归档失败只告警，不影响主流程"""
+    # 评估的 LLM 原文（raw）只在这次运行里用，解析出的分数和问题已经够查，不进归档
+    if eval_result:
+        eval_result = {k: v for k, v in eval_result.items() if k != "raw"}
+    try:
+        cur = _db().execute(
+            """INSERT INTO articles (ts, day, run_id, account, topic, title, digest, body, article_json, eval_json,
+                                     total_score, status, draft_id, images_json, error)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (time.time(), _today(), _run_id.get(), _account.get(), topic, article.get("title", ""),
+             article.get("digest", ""), article.get("body", ""), json.dumps(article, ensure_ascii=False),
+             json.dumps(eval_result, ensure_ascii=False) if eval_result else None,
+             eval_result.get("total_score") if eval_result else None,
+             status, draft_id, json.dumps(images or [], ensure_ascii=False), error))
+        inc("articles_archived_total", status=status)
+        return cur.lastrowid
+    except sqlite3.Error as e:
+        print(f"⚠️  文章归档失败：{e}")
+        return None
+
+
+def search_articles(query: str = "", account: str = None, status: str = None, days: int = None,
+                    min_score: float = None, limit: int = 20) -> list:
+    """
+    检索归档文章，按相关度（有关键词时）或时间倒序返回 [{id, ts, ..., snippet}]，不含正文。
+    关键词按空格切分、全部命中才算；3 个字及以上走全文索引，更短的（如“代码”）退回 LIKE 扫描。
+    SQLite 没建出全文索引时全部走 LIKE。
+    """
+    conn   = _db()
+    terms  = query.split()
+    fts    = [t for t in terms if len(t) >= 3] if _DB_LOCAL.fts else []
+    where, params = [], []
+    if fts:
+        where.append("articles_fts MATCH ?")
+        params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in fts))
+    for t in terms:
+        if t not in fts:
+            where.append("(a.title LIKE ? OR a.body LIKE ?)")
+            params += [f"%{t}%", f"%{t}%"]
+    for column, value in (("a.account", account), ("a.status", status)):
+        if value:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if days:
+        where.append("a.ts >= ?")
+        params.append(time.time() - days * 86400)
+    if min_score is not None:
+        where.append("a.total_score >= ?")
+        params.append(min_score)
+
+    columns = ", ".join(f"a.{c}" for c in ARCHIVE_FIELDS)
+    if fts:
+        sql = (f"SELECT {columns}, snippet(articles_fts, 1, '【', '】', '…', 16) AS snippet "
+               f"FROM articles_fts JOIN articles a ON a.id = articles_fts.rowid")
+        order = "bm25(articles_fts)"
+    else:
+        sql   = f"SELECT {columns}, substr(a.body, 1, 60) AS snippet FROM articles a"
+        order = "a.ts DESC"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT ?"
+    return [dict(r) for r in conn.execute(sql, params + [limit]).fetchall()]
+
+
+def get_article(archive_id: int) -> dict:
+    """按归档 ID 取完整记录：文章 dict、评估结果、图片列表都解析好"""
+    row = _db().execute("SELECT * FROM articles WHERE id = ?", (archive_id,)).fetchone()
+    if row is None:
+        return None
+    out = dict(row)
+    out["article"]    = json.loads(out.pop("article_json"))
+    out["evaluation"] = json.loads(out["eval_json"]) if out["eval_json"] else None
+    out["images"]     = json.loads(out.pop("images_json") or "[]")
+    del out["eval_json"]
+    return out
+
+
+def score_trend(days: int = 30, account: str = None) -> list:
+    """按天汇总质量趋势：[{day, articles, drafted, rejected, avg_score}]"""
+    sql = """SELECT day, COUNT(*) AS articles,
+                    SUM(status = 'drafted') AS drafted, SUM(status = 'rejected') AS rejected,
+                    ROUND(AVG(total_score), 1) AS avg_score
+             FROM articles WHERE ts >= ?"""
+    params = [time.time() - days * 86400]
+    if account:
+        sql += " AND account = ?"
+        params.append(account)
+    sql += " GROUP BY day ORDER BY day"
+    return [dict(r) for r in _db().execute(sql, params).fetchall()]
+
+
+def print_archive(query: str = "", archive_id: int = None, trend: bool = False, days: int = None,
+                  limit: int = 20):
+    """python main.py archive 的输出"""
+    if archive_id:
+        rec = get_article(archive_id)
+        if rec is None:
+            print(f"❌ 没有归档 {archive_id}")
+            return
+        a = rec["article"]
+        print(f"📄 #{rec['id']} {a.get('title')}（{rec['status']}，{rec['total_score']} 分，账号 {rec['account']}）")
+        print(f"主题：{rec['topic']}\n摘要：{a.get('digest')}\n\n{a.get('hook')}\n\n{a.get('body')}\n\n{a.get('cta')}")
+        for img in rec["images"]:
+            print(f"🖼️  {img['kind']}: {img.get('media_id') or img.get('url')}  sha256={img['sha256'][:12]}")
+        return
+    if trend:
+        print(f"📈 最近 {days or 30} 天质量趋势")
+        print(f"{'日期':<12}{'篇数':>6}{'入草稿':>8}{'被拦截':>8}{'平均分':>8}")
+        for r in score_trend(days or 30):
+            print(f"{r['day']:<12}{r['articles']:>6}{r['drafted']:>8}{r['rejected']:>8}{r['avg_score'] or '-':>8}")
+        return
+    rows = search_articles(query, days=days, limit=limit)
+    print(f"🔎 {len(rows)} 篇" + (f"匹配「{query}」" if query else "（最近）"))
+    for r in rows:
+        when = datetime.fromtimestamp(r["ts"]).strftime("%Y-%m-%d %H:%M")
+        print(f"  #{r['id']:<5} {when}  {r['status']:<8} {r['total_score'] or '-':>5}  {r['title']}")
+        if query:
+            print(f"         {r['snippet']}")
+
+
+# ────────────────────────────────────────────────
+# 选题库
+# ────────────────────────────────────────────────
+
+# 按内容方向（SKILL.md 的 Content pillars）批量让模型出选题：几个方向合并成一次调用，
+# 同一次调用里顺便给每个选题打传播潜力分（1~10），不额外花调用。
+# 去重后按优先级存进 STATE_DB 的 topic_backlog 表，scheduled_job 从里面取；
+# 库存低于 TOPIC_BACKLOG_MIN 时在后台补货，取选题永远不等模型。
+TOPIC_PILLARS = [p.strip() for p in os.getenv(
+    "TOPIC_PILLARS", "AI工具测评与实测,独立开发的经验教训,副业收入拆解,程序员视角看钱、效率和做产品").split(",") if p.strip()]
+TOPIC_MODEL         = os.getenv("TOPIC_MODEL", "")
+TOPIC_BACKLOG_MIN   = int(os.getenv("TOPIC_BACKLOG_MIN", "10"))
+TOPICS_PER_PILLAR   = 5
+TOPIC_PILLARS_PER_CALL = 4
+
+TOPIC_PROMPT = """请为下面每个内容方向各提 {n} 个公众号选题。
+只输出一个 JSON 对象，不要任何解释，不要 markdown 代码块。格式：
+{{"topics": [{{"pillar": "所属方向（原样照抄）", "title": "选题标题（32 字以内）", "angle": "核心角度", "reason": "为什么适合这批读者", "score": 传播潜力 1~10}}]}}
+要求：
+- 每个方向恰好 {n} 个，同一方向内角度不要重复
+- 标题按写作规则里的标题公式，具体、有数字或冲突感
+- 不要和下面这些已有的选题重复：
+{recent}
+
+【内容方向】
+{pillars}
+"""
+
+TOPIC_SCHEMA = ("topic_backlog", {
+    "type": "object",
+    "properties": {"topics": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"pillar": {"type": "string"}, "title": {"type": "string"}, "angle": {"type": "string"},
+                       "reason": {"type": "string"}, "score": {"type": "number"}},
+        "required": ["pillar", "title", "angle", "reason", "score"], "additionalProperties": False}}},
+    "required": ["topics"], "additionalProperties": False,
+})
+
+_BACKLOG_REFILL = threading.Lock()
+
+
+def _propose_topics(pillars: list, per_pillar: int, recent: list) -> list:
+    """一次调用为多个方向出选题，返回模型给的原始条目（格式不对的丢弃）"""
+    prompt = TOPIC_PROMPT.format(n=per_pillar, pillars="\n".join(f"- {p}" for p in pillars),
+                                 recent="\n".join(f"- {t}" for t in recent) or "（无）")
+    resp = _chat("topics", [{"role": "system", "content": system_prompt()},
+                            {"role": "user", "content": prompt}],
+                 temperature=0.9, model=TOPIC_MODEL or None, schema=TOPIC_SCHEMA)
+    try:
+        items = _parse_json_object(resp.choices[0].message.content).get("topics", [])
+    except ValueError as e:
+        inc("topic_backlog_failures_total")
+        print(f"⚠️  选题解析失败：{e}")
+        return []
+    return [t for t in items if isinstance(t, dict) and str(t.get("title", "")).strip()]
+
+
+def build_topic_backlog(pillars: list = None, per_pillar: int = TOPICS_PER_PILLAR,
+                        pillars_per_call: int = TOPIC_PILLARS_PER_CALL) -> int:
+    """
+    生成一批选题入库，返回新增条数。
+    去重：和库里待用的选题、同批选题相似（≥ TOPIC_DEDUP_THRESHOLD）的丢掉，和已发文章重复的也丢掉；
+    优先级 = 模型打分 × (1 - 与已发文章最高相似度 / 2)，越新鲜越靠前。
+    """
+    pillars = pillars or TOPIC_PILLARS
+    recent  = [r["topic"] for r in _db().execute(
+        "SELECT topic FROM topic_backlog ORDER BY id DESC LIMIT 20").fetchall()]
+    recent += [r["title"] for r in _db().execute("SELECT title FROM articles ORDER BY id DESC LIMIT 20").fetchall()]
+
+    candidates = []
+    for i in range(0, len(pillars), pillars_per_call):
+        with span("topic_backlog"):
+            candidates += _propose_topics(pillars[i:i + pillars_per_call], per_pillar, recent)
+
+    kept = [topic_signature(r["topic"]) for r in _db().execute(
+        "SELECT topic FROM topic_backlog WHERE status = 'pending'").fetchall()]
+    added = 0
+    for item in candidates:
+        # 模型偶尔给出 "score": "高" 之类的条目：跳过这一条，不让整批补货失败
+        try:
+            title = clean_title(str(item["title"]))
+            score = min(max(float(item.get("score") or 5), 1), 10)
+        except (KeyError, TypeError, ValueError) as e:
+            inc("topic_backlog_failures_total")
+            print(f"⚠️  跳过格式不对的候选选题「{item.get('title')}」：{e}")
+            continue
+        sig   = topic_signature(title)
+        if not sig or any(_sig_similarity(sig, k) >= TOPIC_DEDUP_THRESHOLD for k in kept):
+            continue
+        seen = find_similar_topic(title, threshold=0.3)
+        if seen and seen["similarity"] >= TOPIC_DEDUP_THRESHOLD:
+            continue
+        priority = round(score * (1 - (seen["similarity"] if seen else 0) / 2), 2)
+        cur = _db().execute(
+            """INSERT OR IGNORE INTO topic_backlog (ts, pillar, topic, angle, reason, score, priority, status)
+               VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')""",
+            (time.time(), str(item.get("pillar", "")), title, str(item.get("angle", "")),
+             str(item.get("reason", "")), score, priority))
+        if cur.rowcount:
+            kept.append(sig)
+            added += 1
+    inc("topic_backlog_added_total", added)
+    print(f"💡 选题库新增 {added} 个（候选 {len(candidates)} 个，{len(pillars)} 个方向）")
+    return added
+
+
+def backlog_size() -> int:
+    return _db().execute("SELECT COUNT(*) FROM topic_backlog WHERE status = 'pending'").fetchone()[0]
+
+
+def list_backlog(limit: int = 20) -> list:
+    """待用选题，按优先级排序"""
+    return [dict(r) for r in _db().execute(
+        "SELECT * FROM topic_backlog WHERE status = 'pending' ORDER BY priority DESC, id LIMIT ?",
+        (limit,)).fetchall()]
+
+
+def _refill_backlog():
+    """后台补货：同一时间只补一次，失败只告警"""
+    if not _BACKLOG_REFILL.acquire(blocking=False):
+        return
+    try:
+        build_topic_backlog()
+    except Exception as e:
+        print(f"⚠️  选题库补货失败：{e}")
+    finally:
+        _BACKLOG_REFILL.release()
+
+
+BACKLOG_CLAIM_TTL = 86400   # 领走超过一天还没有结果（进程中途崩了）的选题放回库里
+
+
+def next_backlog_topic(account: str = "") -> str:
+    """
+    领一个待用选题（标记为 claimed，别的调用方不会再取到）；库空了返回 None。
+    run() 跑完才标记为已用（finish_backlog_topic），中途失败放回库里；进了延后队列的保持领走状态，补跑后再标记。
+    先选最近 7 天用得最少的内容方向（各方向轮着来），再在方向内取优先级最高的。
+    取完库存低于 TOPIC_BACKLOG_MIN 就在后台补货，调用方不用等。
+    """
+    now = time.time()
+    with _db_tx() as conn:
+        conn.execute("""UPDATE topic_backlog SET status = 'pending', used_ts = NULL, account = NULL
+                        WHERE status = 'claimed' AND used_ts < ?
+                          AND topic NOT IN (SELECT topic FROM deferred_topics)""", (now - BACKLOG_CLAIM_TTL,))
+        row = conn.execute(
+            """SELECT id, topic FROM topic_backlog b WHERE status = 'pending'
+               ORDER BY (SELECT COUNT(*) FROM topic_backlog u
+                         WHERE u.status IN ('used', 'claimed') AND u.pillar = b.pillar AND u.used_ts > ?),
+                        priority DESC, id LIMIT 1""", (now - 7 * 86400,)).fetchone()
+        if row:
+            conn.execute("UPDATE topic_backlog SET status = 'claimed', used_ts = ?, account = ? WHERE id = ?",
+                         (now, account, row["id"]))
+    if backlog_size() < TOPIC_BACKLOG_MIN:
+        _SPECULATIVE_POOL.submit(_refill_backlog)
+    return row["topic"] if row else None
+
+
+def finish_backlog_topic(topic: str, used: bool):
+    """领走的选题跑完了：used=True 标记为已用，False 放回库里等下次再取（不是从选题库取的主题不受影响）"""
+    if used:
+        _db().execute("UPDATE topic_backlog SET status = 'used', used_ts = ? WHERE topic = ? AND status = 'claimed'",
+                      (time.time(), topic))
+    else:
+        _db().execute("""UPDATE topic_backlog SET status = 'pending', used_ts = NULL, account = NULL
+                         WHERE topic = ? AND status = 'claimed'""", (topic,))
 
 
 # ────────────────────────────────────────────────
 # 主流程
 # ────────────────────────────────────────────────
 
-def run(topic: str, comparison_data: dict = None, workflow_steps: list = None):
+# 封面只依赖标题和副标题，可以和评估并行跑（投机执行）。
+# 上传结果按 (账号, 标题, 副标题) 缓存：被质量门槛拦下的文章重跑时直接复用 media_id（素材不跨账号共享）。
+# 常驻进程里每篇文章都会留一条，只保留最近 COVER_CACHE_MAX 条，最久没用的先丢。
+_SPECULATIVE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+COVER_CACHE_MAX = 256
+_COVER_CACHE = OrderedDict()
+_COVER_LOCK  = threading.Lock()
+
+
+def _render_and_upload_cover(token: str, title: str, subtitle: str, prev=None) -> tuple:
     """
-    主流程：生成文章 → 评估打分（本地） → 渲染配图 → 上传 → 推草稿箱
+    渲染并上传封面，返回 (media_id, 图片 sha256, 是否这次新上传)。
+    prev 是这个主题已推草稿的记录（draft_record）：渲染出的封面和它的一样就复用原素材，不再上传。
+    """
+    key = (_account.get(), title, subtitle)
+    with _COVER_LOCK:
+        if key in _COVER_CACHE:
+            print("♻️  复用已上传的封面图")
+            _COVER_CACHE.move_to_end(key)
+            return _COVER_CACHE[key] + (False,)
+    with span("render_cover"):
+        cover = _profiled(render_cover, title, subtitle, None, PEN_TEMPLATE_PATH)
+    sha = hashlib.sha256(cover).hexdigest()
+    if prev and prev["thumb_media_id"] and prev["cover_sha"] == sha:
+        print("♻️  封面与原草稿相同，复用原素材")
+        return prev["thumb_media_id"], sha, False
+    with span("upload_cover"):
+        media_id = upload_image(token, cover, "cover.png")
+    result = (media_id, sha)
+    with _COVER_LOCK:
+        _COVER_CACHE[key] = result
+        while len(_COVER_CACHE) > COVER_CACHE_MAX:
+            _COVER_CACHE.popitem(last=False)
+    return result + (True,)
+
+
+def _discard_cover(token: str, article: dict, future):
+    """
+    文章被质量门槛拦下，投机上传的封面用不上了：还没开始的直接取消；
+    已经在传的等它传完，从缓存里拿掉并删除素材，不在永久素材库里留孤儿图片。
+    复用缓存的封面属于已推草稿的文章，不动。
+    """
+    if future is None or future.cancel():
+        return
+    try:
+        media_id, _, uploaded = future.result()
+    except Exception:
+        return
+    if not uploaded:
+        return
+    with _COVER_LOCK:
+        _COVER_CACHE.pop((_account.get(), article["title"], article["cover_subtitle"]), None)
+    delete_material(token, media_id)
+
+
+def _start_speculative(token: str, article: dict, want_charts: bool, prev=None) -> tuple:
+    """在投机线程池里开始封面渲染上传和（可选的）配图数据提取，返回 (cover_future, charts_future)"""
+    cover_future = _SPECULATIVE_POOL.submit(
+        contextvars.copy_context().run,
+        _render_and_upload_cover, token, article["title"], article["cover_subtitle"], prev)
+    charts_future = None
+    if want_charts:
+        charts_future = _SPECULATIVE_POOL.submit(contextvars.copy_context().run, _extract_charts_timed, article)
+    return cover_future, charts_future
+
+
+def _extract_charts_timed(article: dict) -> dict:
+    """投机线程里跑的配图提取：失败只告警，不影响推草稿"""
+    try:
+        with span("extract_charts"):
+            return extract_chart_specs(article)
+    except Exception as e:
+        print(f"⚠️  配图数据提取失败，跳过自动配图：{e}")
+        return {}
 
+
+def run(topic: str, comparison_data: dict = None, workflow_steps: list = None, min_score: int = None,
+        account: str = None):
+    """
+    主流程：生成文章 → 评估打分（本地）‖ 渲染上传封面 → 渲染配图 → 上传 → 推草稿箱
+    ARTICLE_MODE=single 时生成和自评在同一次调用里完成，没有单独的评估阶段。
+
+    评估和封面渲染上传并行执行；min_score（默认 QUALITY_MIN_SCORE）大于 0 时，
+    综合得分不达标的文章不推草稿箱，已经投机上传的封面会删掉（material/del_material）。
     评分报告只在终端展示，不推入草稿箱。
     草稿箱只包含：封面图 + 引言钩子 + 正文 + 配图 + 结尾钩子。
+    comparison_data / workflow_steps 都没传且 AUTO_CHARTS 开启时，从文章的【配图需求】自动提取图表数据
+    （与评估并行），定时任务因此也能带图表。
+    返回草稿 media_id，被质量门槛拦下时返回 None。
+    account 指定推到哪个公众号（默认第一个账号）；同一账号同时在跑的文章数受 max_concurrency 限制，
+    当天草稿数达到 daily_quota、或微信接口剩余调用不够一篇时，在生成之前就抛 QuotaExceeded，不浪费 LLM 调用；
+    主题进延后队列（defer_topic），定时任务之后优先补跑。
+    开跑前先查主题去重索引（check_topic），和已发文章太像时按 TOPIC_DEDUP 提示或抛 DuplicateTopic。
+    草稿按主题幂等：同一账号同一主题重跑会用 draft/update 更新原草稿，内容没变则跳过推送。
+    每个阶段都有耗时统计（span），指标见 metrics_text() / METRICS_PATH。
+    PROFILE=run 时整次运行在 cProfile + tracemalloc 下执行，结果写到 PROFILE_DIR
+    （cProfile 只统计当前线程，投机线程里的封面渲染要用 PROFILE=render 单独看）。
     """
+    run_id = uuid.uuid4().hex[:12]
+    account = get_account(account)["name"]
+    _run_id.set(run_id)
+    _run_topic.set(topic)
+    _account.set(account)
+    try:
+        _take_draft_quota(account)
+    except QuotaExceeded as e:
+        defer_topic(topic, account, str(e))
+        raise
+    draft_id = None
+    add_gauge("pipeline_runs_in_flight", 1)
+    try:
+        with _ACCOUNT_STATE[account]["semaphore"]:
+            if PROFILE in ("1", "run"):
+                draft_id = profile_call(_run, topic, comparison_data, workflow_steps, min_score,
+                                        profile_dir=os.path.join(PROFILE_DIR, run_id))
+            else:
+                draft_id = _run(topic, comparison_data, workflow_steps, min_score)
+        finish_backlog_topic(topic, used=True)   # 推了草稿或被质量门槛拦下，选题都算用过了
+        return draft_id
+    except QuotaExceeded as e:
+        # 跑到一半撞上接口每日上限（别的进程用掉了余量）：这篇排到明天
+        defer_topic(topic, account, str(e))
+        raise
+    except DuplicateTopic:
+        finish_backlog_topic(topic, used=True)   # 和已发文章重复，放回去也还是重复
+        raise
+    except Exception:
+        finish_backlog_topic(topic, used=False)
+        raise
+    finally:
+        add_gauge("pipeline_runs_in_flight", -1)
+        if draft_id is None:
+            _release_draft_quota(account)
+
+
+def _run(topic: str, comparison_data: dict, workflow_steps: list, min_score: int):
     list_available_models()
-    print(f"\n{'='*50}\n🚀 开始处理：{topic}\n时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n{'='*50}")
+    print(f"\n{'='*50}\n🚀 开始处理：{topic}（账号 {_account.get()}）\n时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n{'='*50}")
+
+    if min_score is None:
+        min_score = QUALITY_MIN_SCORE
 
-    tmpdir = tempfile.mkdtemp()
+    article = eval_result = token = draft_id = None
+    cover_future = charts_future = None
+    images  = []
     try:
-        token   = get_access_token()
-        article = generate_article(topic)
-
-        # ── 评估打分（仅本地，不进草稿箱）──
-        # 评估由外层模型使用 SKILL_eval.md 规则进行
-        # 此处只返回待评估内容，不做自动分数检查
-        eval_result = evaluate_article(article)
-
-        # ── 渲染并上传封面（进草稿箱）──
-        cover_path = os.path.join(tmpdir, "cover.png")
-        render_cover(article["title"], article["cover_subtitle"], cover_path, PEN_TEMPLATE_PATH)
-        thumb_id = upload_image(token, cover_path)
-
-        # ── 组装草稿箱正文 HTML（不含评分）──
-        body_html  = f'<p style="color:#6366f1;font-weight:bold;font-size:15px;text-align:center;">{article["hook"]}</p>\n'
-        body_html += markdown_to_wechat_html(article["body"])
-
-        if comparison_data:
-            comp_path = os.path.join(tmpdir, "comparison.png")
-            render_comparison(comparison_data["headers"], comparison_data["rows"],
-                              comparison_data.get("title","框架对比"), comp_path)
-            comp_id    = upload_image(token, comp_path)
-            body_html += f'\n<img src="" data-mediaId="{comp_id}" style="width:100%;" />'
-
-        if workflow_steps:
-            flow_path = os.path.join(tmpdir, "workflow.png")
-            render_workflow(workflow_steps, "工作流程", "全程自动运行，无需人工介入", flow_path)
-            flow_id    = upload_image(token, flow_path)
-            body_html += f'\n<img src="" data-mediaId="{flow_id}" style="width:100%;" />'
-
-        body_html += f'\n<p style="color:#94a3b8;font-size:15px;margin-top:32px;">{article["cta"]}</p>'
-
-        # ── 推草稿箱 ──
-        push_to_draft(token, article["title"], body_html, thumb_id, digest=article["digest"])
-        print(f"\n🎉 完成！「{article['title']}」已进入草稿箱，等待手动发布。")
+        with span("run", topic=topic):
+            with span("dedupe"):
+                check_topic(topic)
+            with span("token"):
+                token = get_access_token()
+            # 这个主题推过草稿的话先拿到原记录，封面没变就复用原素材，不再上传
+            prev_draft = draft_record(topic)
+            with span("generate"):
+                if ARTICLE_MODE == "single":
+                    article, eval_result = generate_and_evaluate(topic)
+                else:
+                    article = generate_article(topic)
+
+            want_charts  = AUTO_CHARTS and not comparison_data and not workflow_steps
+
+            # ── 评估打分（仅本地，不进草稿箱）──
+            # 评估由外层模型使用 SKILL_eval.md 规则进行；单次调用模式下自评已经有了，跳过
+            if eval_result is None:
+                # 投机执行：封面渲染上传（以及配图数据提取）与评估并行
+                cover_future, charts_future = _start_speculative(token, article, want_charts, prev_draft)
+                with span("evaluate"):
+                    eval_result = evaluate_article(article)
+
+            if min_score and eval_result and eval_result["total_score"] < min_score:
+                # 还没开始的投机任务直接丢弃；已经上传的封面删掉
+                if charts_future:
+                    charts_future.cancel()
+                _discard_cover(token, article, cover_future)
+                inc("pipeline_rejected_total")
+                print(f"⛔ 综合得分 {eval_result['total_score']} 低于门槛 {min_score}，不推草稿箱")
+                archive_article(topic, article, eval_result, "rejected")
+                return None
+
+            if cover_future is None:
+                cover_future, charts_future = _start_speculative(token, article, want_charts, prev_draft)
+            with span("cover_wait"):
+                thumb_id, cover_sha, _ = cover_future.result()
+            images.append({"kind": "cover", "media_id": thumb_id, "sha256": cover_sha})
+
+            flow_title, flow_sub = "工作流程", "全程自动运行，无需人工介入"
+            if charts_future:
+                specs = charts_future.result()
+                comparison_data = specs.get("comparison")
+                if "workflow" in specs:
+                    workflow_steps = specs["workflow"]["steps"]
+                    flow_title     = specs["workflow"]["title"]
+                    flow_sub       = specs["workflow"]["subtitle"]
+
+            # ── 组装草稿箱正文 HTML（不含评分）──
+            body_html  = f'<p style="color:#6366f1;font-weight:bold;font-size:15px;text-align:center;">{article["hook"]}</p>\n'
+            body_html += markdown_to_wechat_html(article["body"])
+
+            if comparison_data:
+                with span("render_comparison"):
+                    comp_png = _profiled(render_comparison, comparison_data["headers"], comparison_data["rows"],
+                                         comparison_data.get("title","框架对比"), note=comparison_data.get("note"))
+                with span("upload_comparison"):
+                    comp_url = upload_body_image(token, comp_png, "comparison.png")
+                images.append({"kind": "comparison", "url": comp_url, "sha256": hashlib.sha256(comp_png).hexdigest()})
+                body_html += f'\n<img src="{comp_url}" style="width:100%;" />'
+
+            if workflow_steps:
+                with span("render_workflow"):
+                    flow_png = _profiled(render_workflow, workflow_steps, flow_title, flow_sub)
+                with span("upload_workflow"):
+                    flow_url = upload_body_image(token, flow_png, "workflow.png")
+                images.append({"kind": "workflow", "url": flow_url, "sha256": hashlib.sha256(flow_png).hexdigest()})
+                body_html += f'\n<img src="{flow_url}" style="width:100%;" />'
+
+            body_html += f'\n<p style="color:#94a3b8;font-size:15px;margin-top:32px;">{article["cta"]}</p>'
+
+            # ── 推草稿箱 ──
+            with span("draft"):
+                draft_id = push_to_draft(token, article["title"], body_html, thumb_id, digest=article["digest"],
+                                         key=topic, cover_sha=cover_sha)
+            inc("pipeline_drafts_total", account=_account.get())
+            index_article(topic, article, _account.get())
+            archive_article(topic, article, eval_result, "drafted", draft_id=draft_id, images=images)
+            print(f"\n🎉 完成！「{article['title']}」已进入草稿箱，等待手动发布。")
+            return draft_id
 
     except Exception as e:
         print(f"❌ 出错：{e}")
+        # 草稿没推成：投机任务不再需要，刚上传的封面也没有文章引用，删掉
+        if draft_id is None:
+            if charts_future:
+                charts_future.cancel()
+            _discard_cover(token, article, cover_future)
+        if article:
+            archive_article(topic, article, eval_result, "failed", images=images, error=str(e))
         raise
+    finally:
+        usage = run_usage(_run_id.get())
+        if usage["calls"]:
+            print(f"💰 本次 LLM 用量：{usage['calls']} 次调用，输入 {usage['prompt_tokens']}"
+                  f"（缓存命中 {usage['cached_tokens']}）/ 输出 {usage['completion_tokens']} tokens，"
+                  f"约 ${usage['cost_usd']:.4f}")
+        write_metrics()
+
+
+def run_batch(topics: list, workers: int = 4) -> list:
+    """
+    并发处理多个主题，单篇失败不影响其它。
+    topics 的元素可以是主题字符串（推到默认账号）、(主题, 账号) 或 {"topic", "account"}。
+    多账号时按账号轮转派发：每个账号同时在跑的不超过它的 max_concurrency，
+    一个账号排了很多主题也不会把其它账号的 worker 占满。
+    返回 [{"topic", "account", "draft_id", "error", "seconds"}, ...]，顺序与 topics 一致。
+    常驻进程收到退出信号后不再派新的，剩下的主题进延后队列。账号名写错的只记这一篇失败。
+    """
+    jobs, results = [], [None] * len(topics)
+    for i, item in enumerate(topics):
+        if isinstance(item, dict):
+            topic, account = item["topic"], item.get("account")
+        elif isinstance(item, (tuple, list)):
+            topic, account = item
+        else:
+            topic, account = item, None
+        try:
+            account = get_account(account)["name"]
+        except ValueError as e:
+            results[i] = {"topic": topic, "account": account, "draft_id": None, "error": str(e), "seconds": 0.0}
+        jobs.append((topic, account))
+
+    def _one(topic, account):
+        t0 = time.perf_counter()
+        try:
+            draft_id, error = run(topic, account=account), None
+        except Exception as e:
+            draft_id, error = None, str(e)
+        return {"topic": topic, "account": account, "draft_id": draft_id, "error": error,
+                "seconds": round(time.perf_counter() - t0, 3)}
+
+    queues = {}
+    for i, (_, account) in enumerate(jobs):
+        if results[i] is None:
+            queues.setdefault(account, deque()).append(i)
+    limits  = {a: _ACCOUNT_STATE[a]["limit"] for a in queues}
+    running = dict.fromkeys(queues, 0)
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+        while queues or pending:
+            # 常驻进程正在退出：还没开跑的进延后队列，下次启动优先补跑，只等在跑的写完
+            if _DRAINING.is_set() and queues:
+                for account, queue in queues.items():
+                    for i in queue:
+                        defer_topic(jobs[i][0], account, "进程退出")
+                        results[i] = {"topic": jobs[i][0], "account": account, "draft_id": None,
+                                      "error": "进程退出，已放进延后队列", "seconds": 0.0}
+                queues.clear()
+            # 轮转：每轮每个有空位的账号派一篇，直到 worker 满或没有可派的
+            dispatched = True
+            while dispatched and len(pending) < workers:
+                dispatched = False
+                for account in list(queues):
+                    if len(pending) >= workers:
+                        break
+                    if running[account] >= limits[account]:
+                        continue
+                    i = queues[account].popleft()
+                    if not queues[account]:
+                        del queues[account]
+                    running[account] += 1
+                    pending[pool.submit(_one, *jobs[i])] = i
+                    dispatched = True
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                running[jobs[i][1]] -= 1
+                results[i] = future.result()
+    return results
 
 
 # ────────────────────────────────────────────────
@@ -589,10 +3081,303 @@ TOPIC_LIST = [
 ]
 
 def scheduled_job():
-    idx = int(time.time()/86400) % len(TOPIC_LIST)
-    run(TOPIC_LIST[idx])
+    """
+    每个账号每天一篇：先补跑延后队列里最早的主题；账号配了自己的 topics 就按它轮转，
+    否则从选题库取优先级最高的，选题库空了再按 TOPIC_LIST 轮转（同时后台补货）。
+    轮转时跳过和已发文章重复的主题。
+    """
+    day = int(time.time()/86400)
+    if not ACCOUNTS:
+        load_accounts()
+    try:
+        _pick_provider()   # 预算已经用完就整批跳过，不必每个账号都失败一次
+    except BudgetExceeded as e:
+        print(f"⏸️  {e}，今天跳过")
+        return
+    jobs = []
+    for name, acc in ACCOUNTS.items():
+        topics = acc.get("topics") or TOPIC_LIST
+        deferred = pop_deferred(name)
+        if deferred:
+            jobs.append((deferred[0], name))
+            continue
+        if not acc.get("topics"):
+            backlog = next_backlog_topic(name)
+            if backlog:
+                jobs.append((backlog, name))
+                continue
+        # 从今天轮到的主题开始，跳过和已发文章重复的；全都重复就还用今天的，交给 check_topic 处理
+        rotation = [topics[(day + i) % len(topics)] for i in range(len(topics))]
+        fresh = next((t for t in rotation if TOPIC_DEDUP == "off" or not find_similar_topic(t)), rotation[0])
+        jobs.append((fresh, name))
+    for r in run_batch(jobs, workers=max(1, len(jobs))):
+        if r["error"]:
+            print(f"⚠️  {r['account']}：{r['error']}")
+
+# 常驻运行见下方 daemon()：python main.py daemon
 
-# schedule.every().day.at("09:00").do(scheduled_job)
+
+# ────────────────────────────────────────────────
+# 常驻进程
+# ────────────────────────────────────────────────
+
+# python main.py daemon：一个进程常驻，每天 DAEMON_AT 跑 scheduled_job。
+# 字体、封面底图、AI 客户端、access_token、skill 和模板都留在内存里跨任务复用，不用每次冷启动。
+# 本地 HTTP 服务提供 /healthz（JSON 状态，退出中返回 503）和 /metrics（Prometheus 文本）。
+# 收到 SIGTERM / SIGINT 后不再派新文章（还没开跑的进延后队列），等在跑的写完再退出；再收到一次立即退出。
+# ENV_FILE 和 ACCOUNTS_FILE 改了自动重新加载；skill 和 .pen 模板本来就按 mtime 缓存，下次用到时生效。
+DAEMON_HOST           = os.getenv("DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT           = int(os.getenv("DAEMON_PORT", "8787"))
+DAEMON_AT             = [t.strip() for t in os.getenv("DAEMON_AT", "09:00").split(",") if t.strip()]
+DAEMON_DRAIN_TIMEOUT  = float(os.getenv("DAEMON_DRAIN_TIMEOUT", "600"))
+DAEMON_WATCH_INTERVAL = float(os.getenv("DAEMON_WATCH_INTERVAL", "2"))
+ENV_FILE              = os.getenv("ENV_FILE", ".env")
+# 内存水位（MB，0 不限）：空闲时 RSS 超过它就排空退出，由 CLI 原地重启（os.execv），释放碎片化的堆
+WORKER_MAX_RSS_MB     = float(os.getenv("WORKER_MAX_RSS_MB", "0"))
+DAEMON_RECYCLE_EXIT   = 75   # daemon() 因内存水位退出时的返回值
+
+_DRAINING = threading.Event()
+_DAEMON   = {"started": 0.0, "port": None, "scheduler": None, "job": None, "last_job": None, "reloads": 0,
+             "rss_start_mb": 0.0}
+
+
+def reload_config(path: str = None):
+    """
+    重新读取 ENV_FILE（覆盖进程里的同名环境变量），刷新能热更新的配置：
+    各服务商的 key / base_url、ACTIVE_MODEL、质量门槛、图表、生成模式、预算与备用模型、
+    微信接口限额、署名、去重和选题库，最后重读账号（默认账号来自 WECHAT_APP_ID / WECHAT_APP_SECRET）。
+    文件里删掉的项保持当前值；STATE_DB、超时、METRICS_*、DAEMON_* 这类启动时就用掉的配置要重启才生效。
+    """
+    global ACTIVE_MODEL, QUALITY_MIN_SCORE, AUTO_CHARTS, CHART_MODEL, STRUCTURED_OUTPUT, REPAIR_MODEL
+    global ARTICLE_MODE, LLM_DAILY_TOKEN_BUDGET, LLM_FALLBACK_MODEL, WECHAT_APP_ID, WECHAT_APP_SECRET
+    global ACCOUNTS_FILE, WECHAT_RATE_LIMITS, WECHAT_DAILY_LIMITS, WECHAT_AUTHOR
+    global TOPIC_DEDUP, TOPIC_DEDUP_THRESHOLD, TOPIC_PILLARS, TOPIC_MODEL, TOPIC_BACKLOG_MIN
+    load_dotenv(path or ENV_FILE, override=True)
+    env = os.getenv
+    active = env("ACTIVE_MODEL", ACTIVE_MODEL)
+    if active not in MODELS:
+        raise ValueError(f"未知模型：{active}（可选：{', '.join(MODELS)}）")
+
+    for name, config in MODELS.items():
+        config["api_key"]  = env(f"{name.upper()}_API_KEY", config["api_key"])
+        config["base_url"] = env(f"{name.upper()}_BASE_URL", config["base_url"])
+    ACTIVE_MODEL          = active
+    QUALITY_MIN_SCORE     = int(env("QUALITY_MIN_SCORE", str(QUALITY_MIN_SCORE)))
+    AUTO_CHARTS           = env("AUTO_CHARTS", "1" if AUTO_CHARTS else "0") == "1"
+    CHART_MODEL           = env("CHART_MODEL", CHART_MODEL)
+    STRUCTURED_OUTPUT     = env("STRUCTURED_OUTPUT", "1" if STRUCTURED_OUTPUT else "0") == "1"
+    REPAIR_MODEL          = env("REPAIR_MODEL", REPAIR_MODEL)
+    ARTICLE_MODE          = env("ARTICLE_MODE", ARTICLE_MODE)
+    if env("LLM_DAILY_TOKEN_BUDGET") is not None:
+        LLM_DAILY_TOKEN_BUDGET = {k: int(v) for k, v in _parse_limits(env("LLM_DAILY_TOKEN_BUDGET")).items()}
+    LLM_FALLBACK_MODEL    = env("LLM_FALLBACK_MODEL", LLM_FALLBACK_MODEL)
+    WECHAT_APP_ID         = env("WECHAT_APP_ID", WECHAT_APP_ID)
+    WECHAT_APP_SECRET     = env("WECHAT_APP_SECRET", WECHAT_APP_SECRET)
+    ACCOUNTS_FILE         = env("ACCOUNTS_FILE", ACCOUNTS_FILE)
+    if env("WECHAT_RATE_LIMITS") is not None:
+        WECHAT_RATE_LIMITS = _parse_limits(env("WECHAT_RATE_LIMITS"))
+    if env("WECHAT_DAILY_LIMITS") is not None:
+        WECHAT_DAILY_LIMITS = _parse_limits(env("WECHAT_DAILY_LIMITS"))
+    WECHAT_AUTHOR         = env("WECHAT_AUTHOR", WECHAT_AUTHOR)
+    TOPIC_DEDUP           = env("TOPIC_DEDUP", TOPIC_DEDUP)
+    TOPIC_DEDUP_THRESHOLD = float(env("TOPIC_DEDUP_THRESHOLD", str(TOPIC_DEDUP_THRESHOLD)))
+    if env("TOPIC_PILLARS") is not None:
+        TOPIC_PILLARS = [p.strip() for p in env("TOPIC_PILLARS").split(",") if p.strip()] or TOPIC_PILLARS
+    TOPIC_MODEL           = env("TOPIC_MODEL", TOPIC_MODEL)
+    TOPIC_BACKLOG_MIN     = int(env("TOPIC_BACKLOG_MIN", str(TOPIC_BACKLOG_MIN)))
+    load_accounts()
+
+
+def check_reload(mtimes: dict) -> list:
+    """
+    比较 ENV_FILE / ACCOUNTS_FILE 的 mtime，变了就重新加载，返回这次重新加载的文件。
+    mtimes 记录上一次看到的 mtime（原地更新），第一次调用只记录不加载。
+    加载出错（比如 JSON 写了一半）时继续用旧配置，文件下次再变时重试；文件被删掉也保留内存里的配置。
+    """
+    reloaded = []
+    for path, loader in ((ENV_FILE, reload_config), (ACCOUNTS_FILE, load_accounts)):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if path not in mtimes or mtimes[path] == mtime:
+            mtimes[path] = mtime
+            continue
+        mtimes[path] = mtime
+        if mtime is None:
+            continue
+        try:
+            loader(path)
+        except Exception as e:
+            inc("daemon_reload_failures_total")
+            print(f"❌ 重新加载失败，继续用旧配置：{path}：{e}")
+            continue
+        _DAEMON["reloads"] += 1
+        inc("daemon_reloads_total")
+        reloaded.append(path)
+        print(f"🔄 配置已更新，重新加载：{path}")
+    return reloaded
+
+
+def _warm_up():
+    """启动时先把 skill、模板、字体和封面底图、AI 客户端加载好，第一篇文章不用冷启动（失败只提示）"""
+    steps = {
+        "skill": lambda: (system_prompt(), load_skill(SKILL_EVAL_PATH)),
+        "封面":  lambda: render_cover("预热", "预热", None, PEN_TEMPLATE_PATH),
+        "AI 客户端": get_ai_client,
+    }
+    for name, step in steps.items():
+        try:
+            with redirect_stdout(io.StringIO()):
+                step()
+        except Exception as e:
+            print(f"⚠️  预热 {name} 失败：{e}")
+
+
+def health() -> dict:
+    """/healthz 的内容"""
+    scheduler = _DAEMON["scheduler"]
+    job       = _DAEMON["job"]
+    next_run  = scheduler.next_run if scheduler else None
+    return {
+        "status":      "draining" if _DRAINING.is_set() else "ok",
+        "uptime_s":    round(time.time() - _DAEMON["started"], 1) if _DAEMON["started"] else 0.0,
+        "in_flight":   int(gauge_value("pipeline_runs_in_flight")),
+        "job_running": bool(job and job.is_alive()),
+        "last_job":    _DAEMON["last_job"],
+        "next_job":    next_run.isoformat(timespec="seconds") if next_run else None,
+        "reloads":     _DAEMON["reloads"],
+        "rss_mb":      round(rss_bytes() / 1024 / 1024, 1),
+        "max_rss_mb":  WORKER_MAX_RSS_MB,
+        "accounts":    list(ACCOUNTS),
+        "model":       ACTIVE_MODEL,
+    }
+
+
+class _DaemonHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/healthz":
+            status = health()
+            self._send(200 if status["status"] == "ok" else 503,
+                       json.dumps(status, ensure_ascii=False), "application/json; charset=utf-8")
+        elif path == "/metrics":
+            self._send(200, metrics_text(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self._send(404, "not found\n", "text/plain; charset=utf-8")
+
+    def _send(self, code: int, body: str, content_type: str):
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass   # 探针每隔几秒来一次，不刷屏
+
+
+def _daemon_job():
+    """定时触发：在后台线程跑 scheduled_job，主循环照常响应信号和热加载；上一轮还没跑完就跳过这次"""
+    if _DRAINING.is_set():
+        return
+    job = _DAEMON["job"]
+    if job and job.is_alive():
+        inc("daemon_jobs_total", status="skipped")
+        print("⏭️  上一轮定时任务还没跑完，跳过这次")
+        return
+    _DAEMON["job"] = threading.Thread(target=_daemon_job_body, name="daemon-job", daemon=True)
+    _DAEMON["job"].start()
+
+
+def _daemon_job_body():
+    t0, error = time.time(), None
+    try:
+        scheduled_job()
+    except Exception as e:
+        error = str(e)
+        print(f"❌ 定时任务失败：{e}")
+    _DAEMON["last_job"] = {"started": datetime.fromtimestamp(t0).isoformat(timespec="seconds"),
+                           "seconds": round(time.time() - t0, 1), "error": error}
+    inc("daemon_jobs_total", status="error" if error else "ok")
+    write_metrics()
+
+
+def _over_watermark() -> bool:
+    """定时任务没在跑、且 RSS 超过 WORKER_MAX_RSS_MB 时返回 True（任务跑到一半不打断）"""
+    if not WORKER_MAX_RSS_MB or _DAEMON["rss_start_mb"] >= WORKER_MAX_RSS_MB:
+        return False   # 刚启动就超水位，说明水位设得太低，重启也没用
+    job = _DAEMON["job"]
+    if job and job.is_alive():
+        return False
+    rss_mb = rss_bytes() / 1024 / 1024
+    if rss_mb <= WORKER_MAX_RSS_MB:
+        return False
+    print(f"♻️  内存 {rss_mb:.0f} MB 超过水位 {WORKER_MAX_RSS_MB:g} MB，退出后重启进程")
+    return True
+
+
+def daemon(host: str = None, port: int = None, at: list = None) -> int:
+    """
+    常驻运行：每天 at（默认 DAEMON_AT，可以多个时间点）跑一次 scheduled_job，
+    同时在 host:port 提供 /healthz 和 /metrics（port=0 随机分配，实际端口见 _DAEMON["port"]），
+    每 DAEMON_WATCH_INTERVAL 秒检查一次配置文件和内存水位。必须在主线程调用（要装信号处理）。
+    收到 SIGTERM / SIGINT 后排空再返回：正常退出返回 0，等了 DAEMON_DRAIN_TIMEOUT 还没写完返回 1；
+    空闲时内存超过 WORKER_MAX_RSS_MB 返回 DAEMON_RECYCLE_EXIT，由调用方重启进程。
+    """
+    host = host or DAEMON_HOST
+    port = DAEMON_PORT if port is None else port
+    _DRAINING.clear()
+    load_accounts()
+    _warm_up()
+
+    scheduler = schedule.Scheduler()
+    for t in at or DAEMON_AT:
+        scheduler.every().day.at(t).do(_daemon_job)
+    server = ThreadingHTTPServer((host, port), _DaemonHandler)
+    server.daemon_threads = True
+    _DAEMON.update(started=time.time(), port=server.server_port, scheduler=scheduler,
+                   job=None, last_job=None, reloads=0, rss_start_mb=rss_bytes() / 1024 / 1024)
+    if WORKER_MAX_RSS_MB and _DAEMON["rss_start_mb"] >= WORKER_MAX_RSS_MB:
+        print(f"⚠️  启动后内存 {_DAEMON['rss_start_mb']:.0f} MB 已超过水位 {WORKER_MAX_RSS_MB:g} MB，不会按水位重启")
+    threading.Thread(target=server.serve_forever, name="daemon-http", daemon=True).start()
+
+    def _on_signal(signum, frame):
+        if _DRAINING.is_set():
+            print("⛔ 再次收到退出信号，立即退出")
+            write_metrics()
+            os._exit(1)
+        print(f"🛑 收到 {signal.Signals(signum).name}，不再派新文章，等在跑的写完（最多 {DAEMON_DRAIN_TIMEOUT:g}s）")
+        _DRAINING.set()
+
+    previous = {sig: signal.signal(sig, _on_signal) for sig in (signal.SIGTERM, signal.SIGINT)}
+    print(f"🚀 常驻运行：每天 {', '.join(at or DAEMON_AT)} 跑定时任务，"
+          f"健康检查 http://{host}:{server.server_port}/healthz")
+    mtimes, recycle = {}, False
+    check_reload(mtimes)
+    try:
+        while not _DRAINING.is_set():
+            scheduler.run_pending()
+            check_reload(mtimes)
+            if _over_watermark():
+                recycle = True
+                break
+            _DRAINING.wait(DAEMON_WATCH_INTERVAL)
+        job = _DAEMON["job"]
+        if job:
+            job.join(DAEMON_DRAIN_TIMEOUT)
+        drained = not (job and job.is_alive())
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+        server.shutdown()
+        server.server_close()
+        write_metrics()
+    if recycle:
+        return DAEMON_RECYCLE_EXIT
+    print("👋 在跑的文章都写完了，已退出" if drained else f"⚠️  等了 {DAEMON_DRAIN_TIMEOUT:g}s 还有文章没写完，强制退出")
+    return 0 if drained else 1
 
 
 # ────────────────────────────────────────────────
@@ -600,6 +3385,54 @@ def scheduled_job():
 # ────────────────────────────────────────────────
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="微信公众号自动化发文")
+    parser.add_argument("command", nargs="?", default="run",
+                        choices=["run", "usage", "archive", "backlog", "daemon"],
+                        help="run 跑一篇示例文章（默认）；usage 查看 LLM 用量与成本；archive 检索归档文章；"
+                             "backlog 查看选题库；daemon 常驻运行定时任务")
+    parser.add_argument("query", nargs="*", help="archive：检索关键词（空格分隔，全部命中）")
+    parser.add_argument("--days", type=int, help="usage：统计最近 N 天（默认 1）；archive：只看最近 N 天")
+    parser.add_argument("--by", default="provider", choices=USAGE_GROUPS, help="usage：分组维度")
+    parser.add_argument("--id", type=int, help="archive：查看某篇归档的全文")
+    parser.add_argument("--trend", action="store_true", help="archive：按天汇总质量趋势")
+    parser.add_argument("--limit", type=int, default=20, help="archive / backlog：最多列出 N 条（默认 20）")
+    parser.add_argument("--build", action="store_true", help="backlog：先按内容方向生成一批新选题")
+    parser.add_argument("--host", help=f"daemon：健康检查监听地址（默认 {DAEMON_HOST}）")
+    parser.add_argument("--port", type=int, help=f"daemon：健康检查端口（默认 {DAEMON_PORT}）")
+    parser.add_argument("--at", action="append", help="daemon：每天几点跑定时任务，可重复（默认 DAEMON_AT）")
+    parser.add_argument("--profile", nargs="?", const="run", choices=["run", "render"],
+                        help="开启性能剖析：run 剖析整次运行（默认），render 剖析每次渲染")
+    parser.add_argument("--profile-dir", help=f"剖析结果目录（默认 {PROFILE_DIR}）")
+    parser.add_argument("--profile-top", type=int, help=f"摘要打印前 N 项（默认 {PROFILE_TOP_N}）")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILE = args.profile
+    if args.profile_dir:
+        PROFILE_DIR = args.profile_dir
+    if args.profile_top:
+        PROFILE_TOP_N = args.profile_top
+
+    if args.command == "usage":
+        print_usage_report(args.days or 1, args.by)
+        sys.exit(0)
+    if args.command == "archive":
+        print_archive(" ".join(args.query), args.id, args.trend, args.days, args.limit)
+        sys.exit(0)
+    if args.command == "backlog":
+        if args.build:
+            build_topic_backlog()
+        print(f"📚 选题库待用 {backlog_size()} 个")
+        for r in list_backlog(args.limit):
+            print(f"  {r['priority']:>5}  [{r['pillar']}] {r['topic']}")
+        sys.exit(0)
+    if args.command == "daemon":
+        code = daemon(args.host, args.port, args.at)
+        if code == DAEMON_RECYCLE_EXIT:
+            sys.stdout.flush()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        sys.exit(code)
+
     run(
         topic="刚开源2700 Star，这个Agent框架能让AI替你自动干活",
         comparison_data={
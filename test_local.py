@@ -10,6 +10,9 @@ mock 掉 OpenAI 和微信 API，只验证：
 import sys
 import os
 import re
+import shutil
+import tempfile
+from contextlib import contextmanager
 
 sys.path.insert(0, os.path.dirname(__file__))
 
@@ -355,6 +358,1115 @@ def test_image_rendering(article: dict):
     return tmpdir
 
 
+def _import_main():
+    """导入 main.py 测纯函数，不调用任何接口；微信配置给占位值"""
+    os.environ.setdefault("WECHAT_APP_ID", "test")
+    os.environ.setdefault("WECHAT_APP_SECRET", "test")
+    import main
+    return main
+
+
+def _import_bench(name: str):
+    """导入 bench/ 下的脚本模块（它们互相按同目录导入）"""
+    bench_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+    if bench_dir not in sys.path:
+        sys.path.insert(0, bench_dir)
+    _import_main()
+    return __import__(name)
+
+
+@contextmanager
+def _scratch(main, **overrides):
+    """
+    临时替换 main 的模块全局，STATE_DB 默认指到新建的临时目录，yield 这个目录；
+    退出时还原全部替换、关掉指向临时库的连接并删掉目录，测试跑完不在 /tmp 里留东西。
+    """
+    tmp = tempfile.mkdtemp(prefix="wechat_test_")
+    overrides.setdefault("STATE_DB", os.path.join(tmp, "state.db"))
+    saved = {name: getattr(main, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(main, name, value)
+    try:
+        yield tmp
+    finally:
+        for name, value in saved.items():
+            setattr(main, name, value)
+        conn = getattr(main._DB_LOCAL, "conn", None)
+        if conn is not None and main._DB_LOCAL.path.startswith(tmp):
+            conn.close()
+            main._DB_LOCAL.conn = None
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def test_metrics_export():
+    print("\n" + "="*50)
+    print("TEST 5: 阶段耗时 + Prometheus 指标导出")
+    print("="*50)
+
+    main = _import_main()
+    with main.span("unit_test"):
+        pass
+    try:
+        with main.span("unit_test_fail"):
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    main.inc("wechat_errcode_total", endpoint="draft/add", errcode=45009)
+
+    text = main.metrics_text()
+    assert 'pipeline_stage_seconds_count{stage="unit_test"} 1' in text, "❌ span 没有记入直方图"
+    assert 'pipeline_stage_failures_total{stage="unit_test_fail"} 1' in text, "❌ 失败阶段没有计数"
+    assert 'wechat_errcode_total{endpoint="draft/add",errcode="45009"} 1' in text, "❌ errcode 计数错误"
+    main.inc("unit_test_escape_total", account='a"b\\c\nd')
+    assert 'unit_test_escape_total{account="a\\"b\\\\c\\nd"} 1' in main.metrics_text(), "❌ 标签值没有转义"
+    assert "# TYPE pipeline_stage_seconds histogram" in text, "❌ 缺少 TYPE 声明"
+
+    print("✅ span 计时、失败计数、errcode 计数均已导出")
+
+
+def test_image_source():
+    print("\n" + "="*50)
+    print("TEST 6: 上传图片来源（路径 / 字节 / 文件对象）")
+    print("="*50)
+
+    import io
+    import tempfile
+    main = _import_main()
+    png = b"\x89PNG\r\n\x1a\nfake"
+
+    assert main._read_image_source(png, "cover.png") == ("cover.png", png), "❌ bytes 来源解析错误"
+    buf = io.BytesIO(png)
+    buf.read()  # 模拟已经被读过一次的缓冲区
+    assert main._read_image_source(buf) == ("image.png", png), "❌ 文件对象来源没有从头读"
+    with tempfile.NamedTemporaryFile(suffix=".png") as f:
+        f.write(png)
+        f.flush()
+        name, data = main._read_image_source(f.name)
+        assert data == png and name.endswith(".png"), "❌ 路径来源解析错误"
+
+    print("✅ 路径 / bytes / 文件对象三种来源都能上传")
+
+
+def test_image_encoding():
+    print("\n" + "="*50)
+    print("TEST 7: 图片编码（调色板 PNG / JPEG 降级）")
+    print("="*50)
+
+    from PIL import Image, ImageDraw
+    main = _import_main()
+
+    # 大色块图表 → 调色板 PNG，且比默认 PNG 小
+    chart = Image.new("RGB", (1200, 675), (15, 23, 42))
+    ImageDraw.Draw(chart).rectangle([60, 100, 1140, 600], fill=(99, 102, 241))
+    data, ext = main.encode_image(chart, fmt="auto")
+    assert ext == "png" and data[:4] == b"\x89PNG", "❌ 色块图应编码为 PNG"
+    assert len(data) <= len(main._encode(chart, "PNG")), "❌ 自动编码结果比默认 PNG 还大"
+
+    # 指定调色板 PNG 时只编码一次，不为了统计再编一份默认 PNG
+    encoded = []
+    def counting_encode(image, fmt, **kwargs):
+        encoded.append(fmt)
+        return orig_encode(image, fmt, **kwargs)
+    orig_encode = main._encode
+    with _scratch(main, _encode=counting_encode):
+        main.encode_image(chart, fmt="png-palette")
+    assert encoded == ["PNG"], f"❌ png-palette 不应额外编码默认 PNG：{encoded}"
+
+    # 噪点图超出预算 → 降级为 JPEG
+    noise = Image.effect_noise((400, 300), 80).convert("RGB")
+    data, ext = main.encode_image(noise, max_bytes=60_000)
+    assert ext == "jpg" and len(data) <= 60_000, "❌ 超预算时没有降级为 JPEG"
+    assert main._read_image_source(data, "chart.png")[0] == "chart.jpg", "❌ 上传文件名没有按内容修正"
+
+    # 起始质量低于 30 时也至少按它编一次 JPEG，不会因为没有候选而出错
+    with _scratch(main, IMAGE_JPEG_QUALITY=25):
+        low, ext = main.encode_image(noise, fmt="jpeg")
+    assert ext == "jpg" and low[:2] == b"\xff\xd8", "❌ 低质量配置下 JPEG 编码失败"
+
+    print(f"✅ 色块图走 PNG，超预算图降级为 JPEG（{len(data)//1024} KB）")
+
+
+def test_chart_layout():
+    print("\n" + "="*50)
+    print("TEST 8: 图表自适应版式（折行 / 多行卡片）")
+    print("="*50)
+
+    main = _import_main()
+    W = 1200
+
+    # 长单元格折行，列宽总和等于表格宽度
+    headers = ["对比项", "A", "B"]
+    rows    = [["适用场景", "通用链式调用，生态最完整，插件和集成数量最多，" * 6, "低"]]
+    lay = main._layout_comparison(headers, rows, W)
+    assert sum(lay["col_w"]) == W - 120, "❌ 列宽总和不等于表格宽度"
+    assert len(lay["body_cells"][0][1]) > 1, "❌ 长单元格没有折行"
+    assert lay["row_hs"][0] > 72, "❌ 折行后行高没有增加"
+
+    # 步数多时分多行，所有卡片都在画布内
+    steps = [("", f"步骤{i+1}", "自动拆解\n执行步骤") for i in range(12)]
+    lay = main._layout_workflow(steps, W, 675)
+    assert len(lay["cards"]) == 12, "❌ 卡片数量不对"
+    assert len({y for _, y in lay["cards"]}) > 1, "❌ 12 步没有分行"
+    for x, y in lay["cards"]:
+        assert 60 <= x and x + lay["card_w"] <= W - 60, "❌ 卡片超出画布"
+        assert y + lay["card_h"] <= lay["H"] - 60, "❌ 卡片压到底部"
+
+    # 底图按版式几何缓存：行数 / 步数相同、没有折行时，内容不同也复用同一张
+    main._comparison_base.cache_clear()
+    main._workflow_base.cache_clear()
+    main.render_comparison(["对比项", "A", "B"], [["内存", "394 MB", "30 MB"]], "第一张")
+    main.render_comparison(["维度", "甲", "乙"], [["速度", "慢", "快"]], "第二张")
+    main.render_workflow([("", "准备", "读取配置"), ("", "执行", "跑任务")], "流程一", "副标题一")
+    main.render_workflow([("", "收集", "拉取数据"), ("", "汇报", "推送结果")], "流程二", "副标题二")
+    for base in (main._comparison_base, main._workflow_base):
+        info = base.cache_info()
+        assert info.hits == 1 and info.currsize == 1, f"❌ 文字不同的两次渲染应复用底图：{info}"
+
+    print(f"✅ 长单元格折行，12 步分 {len({y for _, y in lay['cards']})} 行排布，底图跨内容复用")
+
+
+def test_chart_specs():
+    print("\n" + "="*50)
+    print("TEST 9: 配图需求 → 图表数据")
+    print("="*50)
+
+    main = _import_main()
+    raw = """```json
+{"comparison": {"title": "三框架对比", "headers": ["对比项", "OpenClaw", "OpenFang"],
+                "rows": [["内存", "394 MB", "~30 MB"], ["缺一列"], ["自主调度", "✗", "✓"]]},
+ "workflow": {"title": "Hands 工作流程", "steps": [{"title": "目标设定", "desc": "告诉Hand\\n要做什么"},
+                                                  {"title": "结果汇报", "desc": "推送Dashboard"}]}}
+```"""
+    specs = main.parse_chart_specs(raw)
+    comp, flow = specs["comparison"], specs["workflow"]
+    assert len(comp["rows"]) == 2, "❌ 列数不一致的行没有丢弃"
+    assert flow["steps"][0] == ("", "目标设定", "告诉Hand\n要做什么"), "❌ 流程步骤没有转成三元组"
+
+    # 只有一步的流程、缺表头的对比表都不画
+    specs = main.parse_chart_specs('{"comparison": {"rows": [["a"]]}, "workflow": {"steps": [{"title": "x"}]}}')
+    assert specs == {}, "❌ 不合格的图表数据没有丢弃"
+
+    # 配图需求里没有图表时不调用模型
+    assert main.extract_chart_specs({"image_requirements": "- 封面图（16:9）：深色科技风"}) == {}, "❌ 无图表需求时不应提取"
+
+    print(f"✅ 对比表 {len(comp['rows'])} 行，流程 {len(flow['steps'])} 步")
+
+
+def test_structured_output():
+    print("\n" + "="*50)
+    print("TEST 10: 结构化输出解析 + 格式修复")
+    print("="*50)
+
+    import json
+    main = _import_main()
+
+    # JSON 模式：代码块包裹也能解析
+    data = {"title": "标题", "hook": "钩子", "digest": "摘要", "body": "正文", "cta": "互动", "image_requirements": ""}
+    article = main._parse_article(f"```json\n{json.dumps(data, ensure_ascii=False)}\n```", structured=True)
+    assert article["title"] == "标题" and article["body"] == "正文", "❌ JSON 文章解析失败"
+
+    # 文本模式评分缺字段 → 走修复调用，而不是静默变成 0 分
+    repaired = []
+    def fake_repair(raw, schema, call):
+        repaired.append(call)
+        return {"title_score": 17, "hook_score": 16, "body_score": 24, "lang_score": 17,
+                "closing_score": 8, "total_score": 82, "conclusion": "小改再发", "issues": []}
+    with _scratch(main, _repair_json=fake_repair):
+        ok = main._parse_eval(MOCK_EVAL_RAW, structured=False)
+        assert not repaired and ok["total_score"] == 86, "❌ 格式正确时不应触发修复"
+        drifted = main._parse_eval("综合评分八十二分，整体不错", structured=False)
+        assert repaired == ["evaluate"] and drifted["total_score"] == 82, "❌ 解析失败没有走修复"
+
+        # JSON 评分里常见的非整数写法取开头的数字，不让一个分数字段拖垮整次运行
+        loose = {"title_score": "18/20", "hook_score": "16分", "body_score": 24.5, "lang_score": " 17 ",
+                 "closing_score": "N/A", "total_score": "85.5/100", "conclusion": "小改再发", "issues": []}
+        scores = main._parse_eval(json.dumps(loose, ensure_ascii=False), structured=True)
+        assert [scores[k] for k in loose if k.endswith("_score")] == [18, 16, 24, 17, 0, 85], f"❌ 分数解析错误：{scores}"
+        assert len(repaired) == 1, "❌ 字段齐全时不应再走修复"
+
+    print("✅ JSON 输出可解析，格式漂移时走修复调用，分数写法不规范也能取到数字")
+
+
+def test_usage_budget():
+    print("\n" + "="*50)
+    print("TEST 11: LLM 用量记账 + 每日预算")
+    print("="*50)
+
+    from types import SimpleNamespace
+    main = _import_main()
+
+    with _scratch(main, LLM_DAILY_TOKEN_BUDGET={}, LLM_FALLBACK_MODEL=main.LLM_FALLBACK_MODEL,
+                  ACTIVE_MODEL=main.ACTIVE_MODEL):
+        resp = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=1200, completion_tokens=800))
+        main._run_id.set("run-test")
+        main._record_llm_usage(resp, "generate", "deepseek", "deepseek-chat", seconds=4.0)
+        main._record_llm_usage(resp, "evaluate", "deepseek", "deepseek-chat", seconds=4.0)
+
+        report = main.usage_report(days=1, by="provider")
+        assert report[0]["key"] == "deepseek" and report[0]["calls"] == 2, "❌ 用量没有按服务商汇总"
+        assert report[0]["tokens_per_sec"] == 200.0, "❌ 生成速度计算错误"
+        assert main.run_usage("run-test")["prompt_tokens"] == 2400, "❌ 单次运行用量合计错误"
+
+        # 超预算 → 改用备用服务商；备用也超了 → BudgetExceeded
+        main.ACTIVE_MODEL, main.LLM_FALLBACK_MODEL = "deepseek", "openai"
+        main.LLM_DAILY_TOKEN_BUDGET.update({"deepseek": 1000})
+        assert main._pick_provider() == "openai", "❌ 超预算没有改道"
+        main._record_llm_usage(resp, "generate", "openai", "gpt-4o", seconds=1.0)
+        main.LLM_DAILY_TOKEN_BUDGET.update({"openai": 1000})
+        try:
+            main._pick_provider()
+            assert False, "❌ 预算全部用完时应拒绝调用"
+        except main.BudgetExceeded:
+            pass
+
+    print(f"✅ 用量入库可汇总（{report[0]['tokens_per_sec']} tok/s），超预算改道 / 拒绝")
+
+
+def test_prompt_cache():
+    print("\n" + "="*50)
+    print("TEST 12: skill 缓存加载 + 前缀缓存统计")
+    print("="*50)
+
+    from types import SimpleNamespace
+    main = _import_main()
+
+    # 内容不变时直接用缓存，文件修改后重新加载
+    with _scratch(main) as tmp:
+        path = os.path.join(tmp, "SKILL_test.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("版本一")
+        assert main.load_skill(path) == "版本一", "❌ skill 读取失败"
+        st = os.stat(path)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("版本二")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+        assert main.load_skill(path) == "版本二", "❌ skill 修改后没有重新加载"
+        assert main.load_skill(path + ".missing", "默认") == "默认", "❌ 文件不存在时应返回默认值"
+
+    # 三家服务商的缓存命中字段
+    openai_usage    = SimpleNamespace(prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    deepseek_usage  = SimpleNamespace(prompt_tokens_details=None, prompt_cache_hit_tokens=512)
+    anthropic_usage = SimpleNamespace(cache_read_input_tokens=256)
+    assert [main._cached_tokens(u) for u in (openai_usage, deepseek_usage, anthropic_usage)] == [1024, 512, 256], \
+        "❌ 缓存命中 token 解析错误"
+
+    # 显式缓存的服务商：system 内容标 cache_control，user 不动
+    msgs = main._mark_cacheable([{"role": "system", "content": "skill"}, {"role": "user", "content": "主题"}])
+    assert msgs[0]["content"][0]["cache_control"] == {"type": "ephemeral"}, "❌ system 没有标记缓存"
+    assert msgs[1]["content"] == "主题", "❌ user 消息不应改动"
+
+    print("✅ skill 按 mtime 重新加载，缓存命中字段解析正确")
+
+
+def test_single_call_mode():
+    print("\n" + "="*50)
+    print("TEST 13: 单次调用模式（生成 + 自评）")
+    print("="*50)
+
+    from types import SimpleNamespace
+    main = _import_main()
+
+    calls = []
+    def fake_chat(call, messages, temperature, model=None, schema=None):
+        calls.append(call)
+        text = MOCK_RAW + "\n【自评】\n" + MOCK_EVAL_RAW
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+    with _scratch(main, _chat=fake_chat):
+        article, evaluation = main.generate_and_evaluate("测试主题")
+
+    assert calls == ["generate_eval"], "❌ 单次调用模式应只调用一次模型"
+    assert article["title"] and "【自评】" not in article["image_requirements"], "❌ 自评混进了文章字段"
+    assert evaluation["total_score"] == 86 and evaluation["mode"] == "self", "❌ 自评分数解析错误"
+
+    # 模型漏了【自评】段：退回单独评估，而不是拿空文本去解析
+    calls.clear()
+    def forgetful_chat(call, messages, temperature, model=None, schema=None):
+        calls.append(call)
+        text = MOCK_RAW if call == "generate_eval" else MOCK_EVAL_RAW
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+    with _scratch(main, _chat=forgetful_chat):
+        article, fallback = main.generate_and_evaluate("测试主题")
+    assert calls == ["generate_eval", "evaluate"], f"❌ 没有自评时应单独评估一次：{calls}"
+    assert article["title"] and fallback["total_score"] == 86 and "mode" not in fallback, "❌ 单独评估结果不对"
+
+    print(f"✅ 一次调用得到文章和自评（综合 {evaluation['total_score']} 分），漏了自评时单独评估")
+
+
+def test_accounts():
+    print("\n" + "="*50)
+    print("TEST 14: 多账号配置 + token 缓存 + 配额 + 公平派发")
+    print("="*50)
+
+    import json
+    import threading
+    import time
+    main = _import_main()
+
+    calls = []
+    def fake_call(endpoint, method="POST", **kwargs):
+        calls.append((main._account.get(), kwargs["params"]["secret"]))
+        return {"access_token": f"tok_{len(calls)}", "expires_in": 7200}
+
+    os.environ["TEST_B_SECRET"] = "secret_b"
+    with _scratch(main, ACCOUNTS={}, _wechat_call=fake_call, run=main.run) as tmp:
+        path = os.path.join(tmp, "accounts.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"accounts": [
+                {"name": "a", "app_id": "wx_a", "app_secret": "secret_a", "daily_quota": 1, "max_concurrency": 1},
+                {"name": "b", "app_id": "wx_b", "app_secret_env": "TEST_B_SECRET", "max_concurrency": 2},
+            ]}, f)
+        main.load_accounts(path)
+
+        assert main.get_access_token("b") == main.get_access_token("b"), "❌ access_token 没有缓存"
+        main.get_access_token("a")
+        assert calls == [("b", "secret_b"), ("a", "secret_a")], f"❌ token 请求次数或账号不对：{calls}"
+
+        main._take_draft_quota("a")
+        try:
+            main._take_draft_quota("a")
+            raise AssertionError("❌ 超过 daily_quota 应抛 QuotaExceeded")
+        except main.QuotaExceeded:
+            pass
+        main._release_draft_quota("a")
+
+        active, peak, lock = {"a": 0, "b": 0}, {"a": 0, "b": 0}, threading.Lock()
+        def fake_run(topic, account=None, **kwargs):
+            with lock:
+                active[account] += 1
+                peak[account] = max(peak[account], active[account])
+            time.sleep(0.02)
+            with lock:
+                active[account] -= 1
+            return f"draft_{topic}"
+        main.run = fake_run
+        jobs = [(f"a{i}", "a") for i in range(4)] + [{"topic": f"b{i}", "account": "b"} for i in range(4)]
+        results = main.run_batch(jobs, workers=4)
+        # 账号名写错只算这一篇失败，不拖垮整批
+        mixed = main.run_batch([("x0", "nope"), ("a9", "a")], workers=2)
+
+    assert [r["topic"] for r in results] == [f"a{i}" for i in range(4)] + [f"b{i}" for i in range(4)], \
+        "❌ 结果顺序应与输入一致"
+    assert all(r["draft_id"] and not r["error"] for r in results), "❌ 批量任务有失败"
+    assert peak == {"a": 1, "b": 2}, f"❌ 账号并发上限没生效：{peak}"
+    assert "未知账号" in mixed[0]["error"] and mixed[1]["draft_id"] == "draft_a9", f"❌ 未知账号不应影响其它主题：{mixed}"
+
+    print(f"✅ 两个账号 token 各取一次，配额生效，并发峰值 {peak}")
+
+
+def test_rate_limits():
+    print("\n" + "="*50)
+    print("TEST 15: 接口限速 + 每日计数 + 延后队列")
+    print("="*50)
+
+    import json
+    import time
+    from types import SimpleNamespace
+    main = _import_main()
+
+    with _scratch(main, ACCOUNTS={}) as tmp:
+        path = os.path.join(tmp, "accounts.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"accounts": [{"name": "t", "app_id": "wx_t", "app_secret": "s",
+                                     "rate_limits": {"draft/add": 600}, "daily_limits": {"draft/add": 2}}]}, f)
+        main.load_accounts(path)
+
+        # 令牌桶：桶空时要排队等下一个令牌（600/分钟 → 0.1 秒），而不是报错
+        main._db().execute("INSERT OR REPLACE INTO rate_buckets VALUES ('t', 'draft/add', 0, ?)", (time.time(),))
+        t0 = time.perf_counter()
+        main._rate_acquire("t", "draft/add")
+        assert time.perf_counter() - t0 >= 0.05, "❌ 令牌不足时没有等待"
+
+        # 每日计数：draft/add 上限 2 次
+        main._count_call("t", "draft/add")
+        main._count_call("t", "draft/add")
+        assert main.api_calls_today("t")["draft/add"] == 2, "❌ 每日调用计数不对"
+        try:
+            main._count_call("t", "draft/add")
+            raise AssertionError("❌ 超过每日上限应抛 QuotaExceeded")
+        except main.QuotaExceeded:
+            pass
+
+        # 开跑前余量不够：不调 LLM，主题进延后队列
+        try:
+            main.run("延后主题", account="t")
+            raise AssertionError("❌ 余量不够时 run() 应抛 QuotaExceeded")
+        except main.QuotaExceeded:
+            pass
+        assert main.pop_deferred("t") == ["延后主题"], "❌ 主题没有进延后队列"
+        assert main.pop_deferred("t") == [], "❌ 延后主题取出后应出队"
+        assert main.api_calls_today("t").get("drafts", 0) == 0, "❌ 没跑成的草稿配额没有归还"
+
+    # 跑到一半微信才返回 45009（比如上传正文图片）：同样进延后队列，这个接口当天不再请求
+    sent = []
+    def fake_request(method, url, **kwargs):
+        sent.append(url.rsplit("/cgi-bin/", 1)[1])
+        return SimpleNamespace(json=lambda: {"errcode": 45009, "errmsg": "reach max api daily quota limit"})
+    fake_requests = SimpleNamespace(request=fake_request, Timeout=main.requests.Timeout,
+                                    ConnectionError=main.requests.ConnectionError)
+    def fake_run(topic, comparison_data, workflow_steps, min_score):
+        return main.upload_body_image("tok", b"\x89PNG fake", "comparison.png")
+    with _scratch(main, ACCOUNTS={}, requests=fake_requests, _run=fake_run) as tmp:
+        path = os.path.join(tmp, "accounts.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"accounts": [{"name": "u", "app_id": "wx_u", "app_secret": "s"}]}, f)
+        main.load_accounts(path)
+        try:
+            main.run("半路超限主题", account="u")
+            raise AssertionError("❌ 微信返回 45009 时 run() 应抛 QuotaExceeded")
+        except main.QuotaExceeded:
+            pass
+        assert main.pop_deferred("u") == ["半路超限主题"], "❌ 半路撞上 45009 的主题没有进延后队列"
+        try:
+            main.run("第二篇", account="u")
+        except main.QuotaExceeded:
+            pass
+        assert sent == ["media/uploadimg"], f"❌ 接口当天已超限不应再请求：{sent}"
+
+    print("✅ 桶空时排队等待，每日上限生效，超限主题（含半路 45009）进延后队列")
+
+
+def test_body_image_upload():
+    print("\n" + "="*50)
+    print("TEST 16: 正文图片走 uploadimg + URL 缓存")
+    print("="*50)
+
+    import io
+    from PIL import Image
+    main = _import_main()
+
+    calls = []
+    def fake_call(endpoint, method="POST", **kwargs):
+        name, payload = kwargs["files"]["media"]
+        calls.append((endpoint, name, len(payload)))
+        return {"url": f"http://mmbiz.qpic.cn/test/{len(calls)}/0"}
+    with _scratch(main, _wechat_call=fake_call):
+        chart = main.render_comparison(["A", "B"], [["x", "1"], ["y", "2"]], "Chart")
+        url1 = main.upload_body_image("tok", chart, "comparison.png")
+        url2 = main.upload_body_image("tok", chart, "comparison.png")
+
+        # 超过 1MB 的图先重新编码再上传
+        buf = io.BytesIO()
+        Image.frombytes("RGB", (900, 900), os.urandom(900 * 900 * 3)).save(buf, "PNG")
+        assert buf.tell() > main.BODY_IMAGE_MAX_BYTES
+        main.upload_body_image("tok", buf.getvalue(), "noise.png")
+
+    assert url1 == url2 and url1.startswith("http"), "❌ 同一张图应复用缓存的 URL"
+    assert [c[0] for c in calls] == ["media/uploadimg"] * 2, f"❌ 调用不对：{calls}"
+    assert calls[1][2] <= main.BODY_IMAGE_MAX_BYTES, "❌ 超大图片没有重新编码"
+
+    print(f"✅ 同图只上传一次，超大图重编码为 {calls[1][2]//1024} KB")
+
+
+def test_topic_dedupe():
+    print("\n" + "="*50)
+    print("TEST 17: 主题去重（MinHash + LSH）")
+    print("="*50)
+
+    import time
+    main = _import_main()
+
+    with _scratch(main, TOPIC_DEDUP=main.TOPIC_DEDUP):
+        for i, topic in enumerate(["用AI写代码，我踩过的5个坑", "订阅制产品为什么比买断更赚钱"] +
+                                  [f"历史主题{i}号：{'独立开发副业出海增长'[i % 7:i % 7 + 3]}" for i in range(200)]):
+            main.index_article(topic, {"title": f"标题{i}：{topic}", "digest": f"摘要{i}"})
+
+        t0 = time.perf_counter()
+        match = main.find_similar_topic("用AI写代码，我踩过的那5个坑")
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        assert match and match["topic"] == "用AI写代码，我踩过的5个坑", f"❌ 没找到近似重复：{match}"
+        assert main.find_similar_topic("用AI写代码：我踩过的5个坑！")["similarity"] == 1.0, "❌ 标点差异应视为相同"
+        assert main.find_similar_topic("Rust 重写之后内存只有 5MB") is None, "❌ 无关主题被判为重复"
+
+        main.TOPIC_DEDUP = "reject"
+        try:
+            main.check_topic("订阅制产品为什么比买断更赚钱？")
+            raise AssertionError("❌ reject 模式应抛 DuplicateTopic")
+        except main.DuplicateTopic:
+            pass
+
+    print(f"✅ 近似重复识别正确（相似度 {match['similarity']:.0%}，查询 {elapsed_ms:.2f} ms）")
+
+
+def test_article_archive():
+    print("\n" + "="*50)
+    print("TEST 18: 文章归档 + 全文检索")
+    print("="*50)
+
+    main = _import_main()
+    article     = main._parse_article(MOCK_RAW, structured=False)
+    eval_result = main._parse_eval(MOCK_EVAL_RAW, structured=False)
+
+    with _scratch(main):
+        images = [{"kind": "cover", "media_id": "M1", "sha256": "ab" * 32}]
+        aid = main.archive_article("测试主题", article, dict(eval_result, raw=MOCK_EVAL_RAW), "drafted",
+                                   draft_id="D1", images=images)
+        main.archive_article("另一个主题", dict(article, title="订阅制产品为什么更赚钱", body="买断和订阅的账"),
+                             dict(eval_result, total_score=60), "rejected")
+
+        hits = main.search_articles("ZeroClaw")
+        assert [h["id"] for h in hits] == [aid], f"❌ 全文检索结果不对：{hits}"
+        assert main.search_articles("订阅")[0]["status"] == "rejected", "❌ 两个字的关键词应退回 LIKE 检索"
+        assert main.search_articles("ZeroClaw 订阅") == [], "❌ 多个关键词应全部命中"
+        assert len(main.search_articles(min_score=80)) == 1, "❌ 分数过滤不对"
+
+        rec = main.get_article(aid)
+        assert rec["article"]["title"] == article["title"] and rec["draft_id"] == "D1", "❌ 归档内容不完整"
+        assert rec["evaluation"]["total_score"] == eval_result["total_score"] and rec["images"] == images, \
+            "❌ 评估结果或图片没有归档"
+        assert "raw" not in rec["evaluation"], "❌ 评估原文不应写进归档"
+        trend = main.score_trend(days=1)
+        assert trend[0]["articles"] == 2 and trend[0]["rejected"] == 1, f"❌ 质量趋势汇总不对：{trend}"
+
+    # SQLite 建不出 FTS5 trigram 索引时状态库照常可用，检索全部退回 LIKE
+    with _scratch(main, _DB_FTS=["CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING no_such_module(title)"]):
+        aid = main.archive_article("测试主题", article, eval_result, "drafted")
+        assert aid and not main._DB_LOCAL.fts, "❌ 没有全文索引时归档应照常写入"
+        assert [h["id"] for h in main.search_articles("ZeroClaw")] == [aid], "❌ 没有全文索引时应退回 LIKE 检索"
+
+    print("✅ 归档 2 篇，全文检索 / 详情 / 质量趋势正常，没有 FTS5 时退回 LIKE")
+
+
+def test_topic_backlog():
+    print("\n" + "="*50)
+    print("TEST 19: 选题库（批量出题 + 去重 + 按方向轮换）")
+    print("="*50)
+
+    import json
+    from types import SimpleNamespace
+    main = _import_main()
+
+    proposed = {"topics": [
+        {"pillar": "AI工具", "title": "我用Claude写了30天代码，账单是多少", "angle": "a", "reason": "r", "score": 9},
+        {"pillar": "AI工具", "title": "我用Claude写了30天代码，账单是多少？", "angle": "a", "reason": "r", "score": 8},
+        {"pillar": "AI工具", "title": "用AI写代码，我踩过的5个坑", "angle": "a", "reason": "r", "score": 10},
+        {"pillar": "副业", "title": "下班后3小时，副业第一年赚了多少", "angle": "a", "reason": "r", "score": 6},
+        {"pillar": "副业", "title": "", "angle": "a", "reason": "r", "score": 6},
+        {"pillar": "副业", "title": "副业记账用哪个工具最省事", "angle": "a", "reason": "r", "score": "很高"},
+    ]}
+    calls = []
+    def fake_chat(call, messages, temperature, model=None, schema=None):
+        calls.append(call)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(proposed)))])
+
+    outcomes = {}
+    def fake_run(topic, *args):
+        if outcomes[topic]:
+            raise outcomes[topic]
+        return "D1"
+
+    with _scratch(main, _chat=fake_chat, TOPIC_BACKLOG_MIN=0, ACCOUNTS={}, _run=fake_run) as tmp:
+        main.index_article("用AI写代码，我踩过的5个坑", {"title": "用AI写代码，我踩过的5个坑", "digest": ""})
+        added = main.build_topic_backlog(["AI工具", "副业"], per_pillar=3)
+        picked = [main.next_backlog_topic(), main.next_backlog_topic(), main.next_backlog_topic()]
+        status = lambda t: main._db().execute("SELECT status FROM topic_backlog WHERE topic = ?", (t,)).fetchone()[0]
+        assert [status(t) for t in picked[:2]] == ["claimed", "claimed"], "❌ 取出的选题应先标记为领走"
+
+        # 跑成功才算用过；中途失败放回库里，下次还能取到
+        path = os.path.join(tmp, "accounts.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"accounts": [{"name": "b", "app_id": "wx_b", "app_secret": "s"}]}, f)
+        main.load_accounts(path)
+        outcomes.update({picked[0]: None, picked[1]: RuntimeError("评估超时")})
+        main.run(picked[0], account="b")
+        try:
+            main.run(picked[1], account="b")
+        except RuntimeError:
+            pass
+        assert (status(picked[0]), status(picked[1])) == ("used", "pending"), "❌ 成功的应标记已用，失败的应放回库里"
+        assert main.next_backlog_topic() == picked[1], "❌ 放回库里的选题应能再次取到"
+
+    assert calls == ["topics"], f"❌ 两个方向应合并成一次调用：{calls}"
+    assert added == 2, f"❌ 应剩 2 个选题（重复标题、已发过的、空标题、分数格式不对的都丢掉），实际 {added}"
+    assert picked == ["我用Claude写了30天代码，账单是多少", "下班后3小时，副业第一年赚了多少", None], \
+        f"❌ 取选题顺序不对：{picked}"
+
+    print(f"✅ 1 次调用出 {len(proposed['topics'])} 个候选，去重后入库 {added} 个，按方向轮换取用")
+
+
+def test_idempotent_draft():
+    print("\n" + "="*50)
+    print("TEST 20: 幂等推草稿（draft/update + 内容哈希）")
+    print("="*50)
+
+    import json
+    import hashlib
+    from collections import OrderedDict
+    main = _import_main()
+
+    drafts, calls = set(), []
+    def fake_call(endpoint, method="POST", **kwargs):
+        body = json.loads(kwargs["data"])
+        calls.append(endpoint)
+        if endpoint == "draft/add":
+            drafts.add(f"D{len(calls)}")
+            return {"media_id": f"D{len(calls)}"}
+        if endpoint == "material/del_material":
+            deleted.append(body["media_id"])
+            return {"errcode": 0}
+        return {"errcode": 0} if body["media_id"] in drafts else {"errcode": 40007}
+
+    deleted, uploads = [], []
+    def fake_upload(token, data, name):
+        uploads.append(name)
+        return f"T{len(uploads)}"
+
+    with _scratch(main, _wechat_call=fake_call, _COVER_CACHE=OrderedDict(), upload_image=fake_upload,
+                  render_cover=lambda *a, **k: b"png"):
+        push = lambda html, key="主题": main.push_to_draft("tok", "标题", html, "THUMB", "摘要", key=key)
+        first = push("<p>v1</p>")
+        assert push("<p>v1</p>") == first and calls == ["draft/add"], "❌ 内容没变应跳过推送"
+        assert push("<p>v2</p>") == first and calls[-1] == "draft/update", "❌ 内容变了应更新原草稿"
+        drafts.clear()                       # 草稿在后台被手动删掉
+        assert push("<p>v3</p>") != first and calls[-2:] == ["draft/update", "draft/add"], "❌ 更新失败应改为新建"
+        assert push("<p>v3</p>", key=None) and calls[-1] == "draft/add", "❌ 不传 key 应每次新建"
+
+        # 内容哈希按封面图片算：同一张封面重新上传（media_id 变了）不算内容变化
+        sha = hashlib.sha256(b"png").hexdigest()
+        cover = lambda thumb, html, sha: main.push_to_draft("tok", "标题", html, thumb, "摘要", key="封面", cover_sha=sha)
+        first, n = cover("C1", "<p>v1</p>", sha), len(calls)
+        assert cover("C2", "<p>v1</p>", sha) == first and len(calls) == n, "❌ 封面图片没变应跳过推送"
+        assert main.draft_record("封面")["thumb_media_id"] == "C1", "❌ 跳过时应保留原封面"
+
+        # 重跑前先查草稿记录：渲染出的封面和原来一样就复用原素材，不上传
+        media_id, _, uploaded = main._render_and_upload_cover("tok", "标题", "副标题", main.draft_record("封面"))
+        assert (media_id, uploaded, uploads) == ("C1", False, []), "❌ 封面没变应复用原素材"
+
+        # 换了封面：更新成功后删掉被替换的旧封面素材
+        cover("C3", "<p>v2</p>", "ab" * 32)
+        assert calls[-1] == "material/del_material" and deleted == ["C1"], f"❌ 旧封面应删掉：{deleted}"
+        assert main.draft_record("封面")["thumb_media_id"] == "C3", "❌ 草稿记录应改成新封面"
+
+    print(f"✅ 跳过 / 更新 / 重建 / 封面复用都正确（共 {len(calls)} 次接口调用）")
+
+
+def test_draft_validator():
+    print("\n" + "="*50)
+    print("TEST 21: 草稿预检（转义 / 字形截断 / 禁用标签 / 图片地址）")
+    print("="*50)
+
+    main = _import_main()
+
+    # 只还原字面的 \uXXXX，正常的反斜杠和中文不动
+    assert main.decode_unicode_escapes(r"路径 C:\new \u4e2d\u6587 \ud83d\ude00") == "路径 C:\\new 中文 😀", "❌ 转义还原错误"
+    # 按字形截断：emoji / 国旗 / 组合字符不会被拆开，长度不超过上限
+    assert main.truncate_graphemes("标题👍🏽结尾", 3) == "标题", "❌ 截断拆开了 emoji"
+    assert main.truncate_graphemes("ab🇨🇳🇯🇵", 5) == "ab🇨🇳", "❌ 截断拆开了国旗"
+    assert main.truncate_graphemes("cafe\u0301s", 5) == "cafe\u0301", "❌ 截断拆开了组合字符"
+
+    img = '<img src="http://mmbiz.qpic.cn/mock/x/0" style="width:100%;" />'
+    ok = main.validate_draft("标" * 40, f"<p>正文</p>{img}", "摘" * 80, "作者", "THUMB")
+    assert len(ok["title"]) == main.DRAFT_TITLE_MAX and len(ok["digest"]) == main.DRAFT_DIGEST_MAX, "❌ 超长没有截断"
+
+    bad = ('<p onclick="x()">正文</p><script>alert(1)</script>'
+           '<img src="" data-mediaId="M1" /><img src="https://example.com/a.png" />')
+    try:
+        main.validate_draft("标题", bad, "", "", "THUMB")
+        raise AssertionError("❌ 不合格的草稿应抛 InvalidDraft")
+    except main.InvalidDraft as e:
+        problems = e.problems
+    assert len(problems) == 4, f"❌ 应一次列出全部 4 个问题：{problems}"
+    try:
+        main.validate_draft("", "x" * (main.DRAFT_CONTENT_MAX + 1))
+        raise AssertionError("❌ 空标题 / 超长正文应被拒绝")
+    except main.InvalidDraft as e:
+        assert len(e.problems) == 3, f"❌ 问题数不对：{e.problems}"
+        assert any("封面" in p for p in e.problems), "❌ 不传 thumb_media_id 时应报缺封面"
+
+    print(f"✅ 规整和拒绝都正确（示例问题：{problems[0]}）")
+
+
+def test_daemon():
+    print("\n" + "="*50)
+    print("TEST 22: 常驻进程（健康检查 / 热加载 / 优雅退出）")
+    print("="*50)
+
+    import json
+    import signal
+    import threading
+    import time
+    import urllib.error
+    import urllib.request
+    main = _import_main()
+
+    def write_accounts(*names):
+        with open(acc_file, "w", encoding="utf-8") as f:
+            json.dump({"accounts": [{"name": n, "app_id": f"wx_{n}", "app_secret": "s"} for n in names]}, f)
+    def touch(path, content):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))   # 保证 mtime 一定变
+    def get(path):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{main._DAEMON['port']}{path}", timeout=5) as r:
+                return r.status, r.read().decode("utf-8")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode("utf-8")
+    def wait_for(cond, msg):
+        for _ in range(200):
+            if cond():
+                return
+            time.sleep(0.02)
+        raise AssertionError(msg)
+
+    release, started, seen = threading.Event(), threading.Event(), {}
+    def slow_job():
+        started.set()
+        release.wait(10)
+
+    def driver():
+        try:
+            wait_for(lambda: main._DAEMON["port"] and main._DAEMON["started"], "❌ 常驻进程没有启动")
+            seen["health"] = get("/healthz")
+            main.inc("daemon_test_total")
+            seen["metrics"] = get("/metrics")
+            write_accounts("a", "b")
+            wait_for(lambda: "b" in main.ACCOUNTS, "❌ accounts.json 改了没有重新加载")
+            touch(env_file, "QUALITY_MIN_SCORE=77\n")
+            wait_for(lambda: main.QUALITY_MIN_SCORE == 77, "❌ .env 改了没有重新加载")
+            main._daemon_job()
+            started.wait(5)
+            os.kill(os.getpid(), signal.SIGTERM)
+            wait_for(main._DRAINING.is_set, "❌ 收到 SIGTERM 没有进入退出流程")
+            seen["draining"] = get("/healthz")
+        except Exception as e:
+            seen["error"] = e
+        finally:
+            release.set()
+
+    with _scratch(main, ACCOUNTS={}, ENV_FILE=None, ACCOUNTS_FILE=None, DAEMON_WATCH_INTERVAL=0.02,
+                  QUALITY_MIN_SCORE=main.QUALITY_MIN_SCORE, scheduled_job=slow_job, run=main.run) as tmp:
+        env_file, acc_file = os.path.join(tmp, ".env"), os.path.join(tmp, "accounts.json")
+        main.ENV_FILE, main.ACCOUNTS_FILE = env_file, acc_file
+        write_accounts("a")
+        touch(env_file, "")
+        try:
+            t = threading.Thread(target=driver)
+            t.start()
+            code = main.daemon("127.0.0.1", 0, ["03:00"])
+            t.join()
+            assert "error" not in seen, seen.get("error")
+            assert code == 0, "❌ 在跑的任务写完后应正常退出"
+            status, body = seen["health"]
+            assert status == 200 and json.loads(body)["status"] == "ok", f"❌ 健康检查异常：{body}"
+            assert json.loads(body)["next_job"], "❌ 健康检查应给出下次定时任务时间"
+            assert "daemon_test_total 1" in seen["metrics"][1], "❌ /metrics 没有导出指标"
+            status, body = seen["draining"]
+            assert status == 503 and json.loads(body)["job_running"], "❌ 退出中健康检查应返回 503 并显示任务在跑"
+            assert main._DAEMON["last_job"]["error"] is None and main._DAEMON["reloads"] == 2, "❌ 任务记录 / 热加载次数不对"
+
+            # 退出中 run_batch 不再开跑新文章，主题进延后队列
+            ran = []
+            main.run = lambda topic, account=None: ran.append(topic)
+            results = main.run_batch([("主题一", "a"), ("主题二", "b")])
+            assert not ran and all("延后" in r["error"] for r in results), "❌ 退出中不应派新文章"
+            assert main.pop_deferred("a") == ["主题一"], "❌ 没开跑的主题应进延后队列"
+        finally:
+            os.environ.pop("QUALITY_MIN_SCORE", None)
+            main._DRAINING.clear()
+
+    print(f"✅ /healthz /metrics 正常，热加载 {main._DAEMON['reloads']} 次，排空后退出")
+
+
+def test_bounded_memory():
+    print("\n" + "="*50)
+    print("TEST 23: 有界内存（图片关闭 / 封面缓存上限 / 内存水位）")
+    print("="*50)
+
+    from collections import OrderedDict
+    from PIL import Image
+    main = _import_main()
+
+    # 编码完图片就关闭，像素缓冲不等垃圾回收
+    img = Image.new("RGB", (64, 64), (10, 20, 30))
+    assert main._save_image(img)[:4] == b"\x89PNG", "❌ 编码结果不对"
+    try:
+        img.getpixel((0, 0))
+        raise AssertionError("❌ 编码后图片应已关闭")
+    except ValueError:
+        pass
+
+    # 封面缓存只留最近 COVER_CACHE_MAX 条，命中的挪到最新
+    uploads = []
+    def fake_upload(token, data, name):
+        uploads.append(name)
+        return f"M{len(uploads)}"
+
+    with _scratch(main, COVER_CACHE_MAX=2, render_cover=lambda *a, **k: b"png", upload_image=fake_upload,
+                  _COVER_CACHE=OrderedDict()):
+        for title in ("一", "二", "一", "三"):
+            main._render_and_upload_cover("tok", title, "副标题")
+        keys = [k[1] for k in main._COVER_CACHE]
+        assert keys == ["一", "三"] and len(uploads) == 3, f"❌ 封面缓存淘汰顺序不对：{keys}"
+
+    # 空闲时 RSS 超过水位：daemon 排空后返回 DAEMON_RECYCLE_EXIT，由 CLI 原地重启
+    # （启动时就超水位说明水位设得太低，不重启，免得一直重启）
+    assert main.rss_bytes() > 1024 * 1024, "❌ 读不到进程 RSS"
+    readings = iter([50, 50, 200])   # MB：启动后、第一次检查、第二次检查
+    with _scratch(main, ACCOUNTS={}, ENV_FILE=None, ACCOUNTS_FILE=None, WORKER_MAX_RSS_MB=100,
+                  DAEMON_WATCH_INTERVAL=0.01, rss_bytes=lambda: next(readings, 200) * 1024 * 1024) as tmp:
+        main.ENV_FILE, main.ACCOUNTS_FILE = os.path.join(tmp, ".env"), os.path.join(tmp, "none.json")
+        assert main.daemon("127.0.0.1", 0, ["03:00"]) == main.DAEMON_RECYCLE_EXIT, "❌ 超过内存水位应退出重启"
+        assert next(readings, None) is None, "❌ 没超水位之前不应重启"
+
+    print(f"✅ 图片已关闭，封面缓存保持 {main.COVER_CACHE_MAX} 条上限，超水位触发重启")
+
+
+def test_speculative_cover():
+    print("\n" + "="*50)
+    print("TEST 24: 投机上传封面（与评估并行 / 被拦下时删素材）")
+    print("="*50)
+
+    import json
+    import threading
+    from collections import OrderedDict
+    main = _import_main()
+
+    article  = main._finish_article(main._parse_article(MOCK_RAW, structured=False))
+    uploaded = threading.Event()
+    calls, seen = [], {}
+    def fake_upload(token, data, name):
+        uploaded.set()
+        return f"M{len(calls) + 1}"
+    def fake_evaluate(art):
+        seen["cover_started"] = uploaded.wait(5)   # 封面在评估返回之前就开始上传
+        return main._parse_eval(MOCK_EVAL_RAW.replace("86/100", "60/100"), structured=False)
+    def fake_call(endpoint, method="POST", **kwargs):
+        calls.append((endpoint, json.loads(kwargs["data"])["media_id"]))
+        return {"errcode": 0}
+    def failing_push(*args, **kwargs):
+        raise RuntimeError("draft/add 失败")
+
+    with _scratch(main, ACCOUNTS={}, ARTICLE_MODE="two-call", AUTO_CHARTS=False, _COVER_CACHE=OrderedDict(),
+                  generate_article=lambda topic: dict(article), evaluate_article=fake_evaluate,
+                  get_access_token=lambda account=None: "tok", render_cover=lambda *a, **k: b"png",
+                  upload_image=fake_upload, _wechat_call=fake_call, push_to_draft=failing_push) as tmp:
+        path = os.path.join(tmp, "accounts.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"accounts": [{"name": "c", "app_id": "wx_c", "app_secret": "s"}]}, f)
+        main.load_accounts(path)
+
+        assert main.run("投机主题", min_score=80, account="c") is None, "❌ 低分文章不应推草稿"
+        assert seen["cover_started"], "❌ 封面应与评估并行上传"
+        assert calls == [("material/del_material", "M1")], f"❌ 被拦下的文章应删掉刚上传的封面：{calls}"
+        assert not main._COVER_CACHE, "❌ 删掉的封面不应留在缓存里"
+
+        # 复用缓存的封面属于已推草稿的文章，被拦下时不删
+        key = ("c", article["title"], article["cover_subtitle"])
+        main._COVER_CACHE[key] = ("KEEP", "ab" * 32)
+        main.run("投机主题二", min_score=80, account="c")
+        assert len(calls) == 1 and key in main._COVER_CACHE, "❌ 复用的封面不应被删"
+
+        # 过了门槛但推草稿失败：投机上传的封面同样没有文章引用，要删
+        main._COVER_CACHE.clear()
+        try:
+            main.run("投机主题三", min_score=0, account="c")
+            raise AssertionError("❌ 推草稿失败应向上抛出")
+        except RuntimeError:
+            pass
+        assert calls[1:] == [("material/del_material", "M2")], f"❌ 推草稿失败后应删掉投机上传的封面：{calls}"
+        assert not main._COVER_CACHE, "❌ 删掉的封面不应留在缓存里"
+
+    print("✅ 封面与评估并行上传，低分 / 推草稿失败的封面已删除，复用的封面保留")
+
+
+def test_bench_suite():
+    print("\n" + "="*50)
+    print("TEST 25: 离线基准测试（分位数 / 基线对比 / 计时）")
+    print("="*50)
+
+    run_bench = _import_bench("run_bench")
+
+    assert run_bench.percentile([], 0.5) == 0.0, "❌ 空列表分位数应为 0"
+    assert run_bench.percentile([1.0, 2.0, 3.0, 4.0], 0.5) == 2.5, "❌ p50 应在中间两个数之间插值"
+    assert run_bench.percentile([1.0, 2.0, 3.0, 4.0], 1.0) == 4.0, "❌ p100 应为最大值"
+
+    results  = {"fast": {"p50_ms": 10.0}, "slow": {"p50_ms": 13.0}, "new": {"p50_ms": 5.0}}
+    baseline = {"fast": {"p50_ms": 10.0}, "slow": {"p50_ms": 10.0}}
+    regressions = run_bench.compare(results, baseline, threshold=0.15)
+    assert len(regressions) == 1 and regressions[0].startswith("slow"), f"❌ 退化判定不对：{regressions}"
+    assert results["slow"]["vs_baseline"] == 0.3 and "vs_baseline" not in results["new"], "❌ 基线对比比例不对"
+
+    calls = []
+    r = run_bench.bench_case(lambda: calls.append(1), iterations=5, warmup=2)
+    assert r["iterations"] == 5 and r["p50_ms"] <= r["p99_ms"], f"❌ 计时结果不对：{r}"
+    assert len(calls) == 2 + 5 + 1, f"❌ 应预热 2 次、计时 5 次、测内存 1 次，实际 {len(calls)} 次"
+
+    cases = run_bench.build_cases()
+    assert {"cover/short_title", "comparison/50_rows", "workflow/8_steps", "html/50k_chars"} <= set(cases), \
+        "❌ 基准用例不全"
+
+    print(f"✅ 分位数插值、+30% 判为退化、{len(cases)} 个用例就绪")
+
+
+def test_mock_server():
+    print("\n" + "="*50)
+    print("TEST 26: 本地 mock 微信接口（WECHAT_API_BASE / 错误注入）")
+    print("="*50)
+
+    import json
+    mock = _import_bench("mock_server")
+    main = _import_main()
+
+    server = mock.start_mock_server(throughput=True, quiet=True)
+    try:
+        with _scratch(main, ACCOUNTS={}, WECHAT_API_BASE=mock.server_url(server)) as tmp:
+            path = os.path.join(tmp, "accounts.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"accounts": [{"name": "m", "app_id": "wx_m", "app_secret": "s"}]}, f)
+            main.load_accounts(path)
+            ctx = main._account.set("m")
+
+            token = main.get_access_token("m")
+            thumb = main.upload_image(token, b"\x89PNG\r\n\x1a\n mock", "cover.png")
+            draft = main.push_to_draft(token, "标题", "<p>正文</p>", thumb, "摘要")
+            assert token.startswith("mock_") and thumb and draft, "❌ 流水线没有打到 mock 服务"
+            assert server.stats["token"] == 1 and server.stats["material/add_material"] == 1 \
+                and server.stats["draft/add"] == 1, f"❌ mock 接口调用次数不对：{dict(server.stats)}"
+
+            # 注入 40001：token 作废，下次重新获取
+            server.config.update(throughput=False, wechat_latency_ms=0, error_rate=1.0, errors=["40001"])
+            try:
+                main.push_to_draft(token, "标题二", "<p>正文</p>", thumb, "摘要")
+                error = ""
+            except Exception as e:
+                error = str(e)
+            assert "40001" in error, f"❌ 注入 40001 时推草稿应失败：{error}"
+            assert main._ACCOUNT_STATE["m"]["token"] is None, "❌ 40001 之后 token 缓存没有作废"
+            assert server.stats["injected:draft/add:40001"] == 1, "❌ 错误没有按配置注入"
+            main._account.reset(ctx)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(f"✅ token / 素材 / 草稿都走 mock，注入 40001 后 token 作废")
+
+
+def test_profiling():
+    print("\n" + "="*50)
+    print("TEST 27: 性能剖析（cProfile + tracemalloc）")
+    print("="*50)
+
+    import io
+    import pstats
+    import tracemalloc
+    from contextlib import redirect_stdout
+    main = _import_main()
+
+    def busy(n, scale=1):
+        return sum(i * scale for i in range(n))
+
+    outer = tracemalloc.is_tracing()   # 用 PYTHONTRACEMALLOC 跑测试时一直开着
+    with _scratch(main, PROFILE="", PROFILE_DIR=main.PROFILE_DIR) as tmp:
+        prof_dir = os.path.join(tmp, "profiles")
+        with redirect_stdout(io.StringIO()):
+            assert main.profile_call(busy, 1000, scale=2, profile_dir=prof_dir) == 999000, "❌ 应返回被剖析函数的结果"
+        files = sorted(os.listdir(prof_dir))
+        assert [os.path.splitext(f)[1] for f in files] == [".prof", ".snapshot", ".txt"], f"❌ 剖析输出不全：{files}"
+        assert all(f.startswith("busy_") for f in files), "❌ 输出文件应按函数名命名"
+        stats = pstats.Stats(os.path.join(prof_dir, files[0]))
+        assert any(fn == "busy" for _, _, fn in stats.stats), "❌ .prof 里没有被剖析的函数"
+        assert tracemalloc.is_tracing() == outer, "❌ 剖析结束后应关掉自己开的 tracemalloc"
+
+        # 外面已经开着 tracemalloc（PYTHONTRACEMALLOC / 外层剖析）时不能替人关掉
+        if not outer:
+            tracemalloc.start()
+        try:
+            with redirect_stdout(io.StringIO()):
+                main.profile_call(busy, 10, profile_dir=prof_dir)
+            assert tracemalloc.is_tracing(), "❌ 不是自己开的 tracemalloc 不应关掉"
+        finally:
+            if not outer:
+                tracemalloc.stop()
+
+        # PROFILE 不是 render 时 _profiled 直接执行；是 render 时按 run_id 分目录
+        main.PROFILE_DIR = os.path.join(tmp, "by_run")
+        assert main._profiled(busy, 10) == 45 and not os.path.exists(main.PROFILE_DIR), "❌ 没开剖析不应写文件"
+        main.PROFILE = "render"
+        ctx = main._run_id.set("run123")
+        with redirect_stdout(io.StringIO()):
+            main._profiled(busy, 10)
+        main._run_id.reset(ctx)
+        assert len(os.listdir(os.path.join(main.PROFILE_DIR, "run123"))) == 3, "❌ PROFILE=render 时应按 run_id 写剖析结果"
+
+    print("✅ 返回值透传，.prof / .snapshot / .txt 齐全，PROFILE=render 按 run_id 归档")
+
+
+def test_render_base_cache():
+    print("\n" + "="*50)
+    print("TEST 28: 封面 / 图表底图缓存")
+    print("="*50)
+
+    import io
+    from contextlib import redirect_stdout
+    main = _import_main()
+    for base in (main._cover_base, main._comparison_base, main._workflow_base):
+        base.cache_clear()
+
+    headers, rows = ["方案", "速度"], [["A", "快"], ["B", "慢"]]
+    with redirect_stdout(io.StringIO()):
+        # 标题用西文：本地缺 CJK 字体时中文字形都一样，比不出两张封面的差别
+        first  = main.render_cover("First Title", "subtitle one")
+        second = main.render_cover("Another Headline", "subtitle two")
+        main.render_comparison(headers, rows, "对比一")
+        main.render_comparison(headers, [["C", "稳"], ["D", "省"]], "对比二")
+        main.render_workflow([("", "准备", "读取配置"), ("", "执行", "跑任务")], "流程一", "副标题")
+        main.render_workflow([("", "选题", "挑主题"), ("", "发布", "推草稿")], "流程二", "副标题")
+
+    for base in (main._cover_base, main._comparison_base, main._workflow_base):
+        info = base.cache_info()
+        assert info.currsize == 1 and info.hits == 1, f"❌ {base.__name__} 同一版式第二次应命中缓存：{info}"
+    assert first != second, "❌ 不同标题的封面不应相同"
+
+    # 缓存的不只是背景：表头色块和流程卡片也在底图里，每次渲染只画文字
+    lay  = main._layout_comparison(headers, rows, 1200)
+    comp = main._comparison_base(1200, 100 + lay["header_h"] + sum(lay["row_hs"]) + 90, main.BG,
+                                 100, lay["header_h"], lay["row_hs"])
+    assert comp.getpixel((600, 100 + lay["header_h"] // 2)) == main._hex2rgb(main.ACCENT), "❌ 表头色块没有进底图"
+    assert main._comparison_base.cache_info().hits == 2, "❌ 同一版式应直接取缓存"
+
+    # 渲染在 copy() 上画字，缓存里的底图不能被改脏
+    cached = main._cover_base(1200, 675, main.BG)
+    main._cover_base.cache_clear()
+    assert cached.tobytes() == main._cover_base(1200, 675, main.BG).tobytes(), "❌ 缓存的封面底图被渲染改动了"
+
+    print("✅ 同一版式的底图（含表头 / 卡片）只画一次，文字画在副本上，缓存底图保持干净")
+
+
+def test_render_many():
+    print("\n" + "="*50)
+    print("TEST 29: 多进程批量渲染 render_many")
+    print("="*50)
+
+    main = _import_main()
+    failures = lambda: main._COUNTERS.get(("render_many_failures_total", (("kind", "bogus"),)), 0)
+    before = failures()
+
+    with _scratch(main) as tmp:
+        cover_path = os.path.join(tmp, "cover.png")
+        specs = [
+            {"kind": "cover", "args": {"title": "批量重刷", "subtitle": "封面"}, "output_path": cover_path},
+            {"kind": "bogus"},
+            {"kind": "comparison", "args": {"headers": ["方案", "速度"], "rows": [["A", "快"]], "chart_title": "对比"}},
+            {"kind": "workflow", "args": {"steps": [("", "准备", "读取配置"), ("", "执行", "跑任务")],
+                                          "chart_title": "流程", "subtitle": "副标题"}},
+        ]
+        # 生成器输入 + max_pending=2：边读边提交，一个 spec 失败不影响其余
+        results = {r["index"]: r for r in main.render_many((s for s in specs), workers=2, max_pending=2)}
+
+        assert sorted(results) == [0, 1, 2, 3], f"❌ 每个 spec 都应产出一条结果：{sorted(results)}"
+        assert all(results[i]["spec"] is specs[i] for i in results), "❌ index 与 spec 对不上"
+        assert results[1]["error"] and "bogus" in results[1]["error"] and results[1]["result"] is None, \
+            f"❌ 未知类型应记为该项的错误：{results[1]}"
+        for i in (0, 2, 3):
+            assert results[i]["error"] is None and results[i]["seconds"] is not None, f"❌ 第 {i} 项不应失败：{results[i]}"
+        assert results[0]["result"] == cover_path and os.path.getsize(cover_path) > 0, "❌ 传 output_path 时应写文件并返回路径"
+        assert isinstance(results[2]["result"], bytes) and results[2]["result"], "❌ 不传 output_path 时应返回编码后的字节"
+    assert failures() == before + 1, "❌ 失败的 spec 应计入 render_many_failures_total"
+
+    print("✅ 结果按序号对应 spec，单个失败只记在该项上，其余照常产出")
+
+
 # ── 主测试入口 ──────────────────────────────────────────
 if __name__ == "__main__":
     print("🧪 开始本地测试（mock 模式，不调用任何 API）")
@@ -363,6 +1475,31 @@ if __name__ == "__main__":
     eval_result = test_eval_parsing()
     test_html_assembly(article)
     test_image_rendering(article)
+    test_metrics_export()
+    test_image_source()
+    test_image_encoding()
+    test_chart_layout()
+    test_chart_specs()
+    test_structured_output()
+    test_usage_budget()
+    test_prompt_cache()
+    test_single_call_mode()
+    test_accounts()
+    test_rate_limits()
+    test_body_image_upload()
+    test_topic_dedupe()
+    test_article_archive()
+    test_topic_backlog()
+    test_idempotent_draft()
+    test_draft_validator()
+    test_daemon()
+    test_bounded_memory()
+    test_speculative_cover()
+    test_bench_suite()
+    test_mock_server()
+    test_profiling()
+    test_render_base_cache()
+    test_render_many()
 
     print("\n" + "="*50)
     print("🎉 全部测试通过！")